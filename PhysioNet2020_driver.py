@@ -1,15 +1,30 @@
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import argparse
+import multiprocessing
 import numpy as np, os, sys
 from wfdb import rdrecord
-from src.run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier
+from src.run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier, run_12ECG_classifier_batch
+from src.data.util import PredictionStore, read_predictions
+from src.data.signal_cache import SignalCache
+from src import instrument
+from src.backends import BACKENDS
+from src.ensemble import EnsembleModel
 
 def load_challenge_data(filepath: Path):
-    record = rdrecord(filepath)
-    data = record.p_signal.transpose()
+    with instrument.span("read", records=1) as span:
+        record = rdrecord(filepath)
+        data = record.p_signal.transpose()
 
-    headerpath = filepath.with_suffix('.hea')
-    with open(headerpath,'r') as f:
-        header_data=f.readlines()
+        headerpath = filepath.with_suffix('.hea')
+        with open(headerpath,'r') as f:
+            header_data=f.readlines()
+
+        if span:
+            signal_bytes = sum(os.path.getsize(filepath.parent / name) for name in set(record.file_name))
+            span.set(shape=data.shape, bytes=signal_bytes + os.path.getsize(headerpath))
 
     return data, header_data
 
@@ -23,44 +38,251 @@ def save_challenge_predictions(output_directory: Path, filename: str, scores,lab
     label_string = ','.join(str(i) for i in labels)
     score_string = ','.join(str(i) for i in scores)
 
-    with open(output_file, 'w') as f:
+    # Write to a temporary file first, so an interrupted run never leaves a
+    # partial CSV behind (which would be skipped when resuming).
+    with open(output_file + ".tmp", 'w') as f:
         f.write(recording_string + '\n' + class_string + '\n' + label_string + '\n' + score_string + '\n')
+    os.replace(output_file + ".tmp", output_file)
 
 
+def export_challenge_predictions(store_dir: Path, output_directory: Path):
+    """Write one challenge output CSV per record from a `PredictionStore`"""
+    scores, labels, records, classes = read_predictions(store_dir)
+    scores = scores.astype(np.float64)   # Same text as the float64 scores written by the driver
+    output_directory.mkdir(parents=True, exist_ok=True)
+    for f, current_score, current_label in zip(records, scores, labels):
+        save_challenge_predictions(output_directory,f,current_score,current_label,classes)
+
+
+# Parallel driver
+# ---------------
+
+# Ensemble shared by worker processes. With the "fork" start method, workers
+# inherit the parent's copy (copy-on-write), so it is only loaded once. The
+# parent loads it with a single PyTorch thread: forking a process whose
+# intra-op thread pool is running (e.g. after int8-static calibration) can
+# deadlock the children. Without "fork", each worker loads its own copy.
+_eval_list = None
+_signal_cache = None
+_micro_batch_size = None
+_worker_stats = None    # Instrumentation totals of a worker process, sent back with each batch
+
+def _init_worker(model_input, model_config, num_threads, backend=None, signal_cache=None,
+                 micro_batch_size=None, instrument_stats=False, instrument_log=None):
+    global _eval_list, _signal_cache, _micro_batch_size, _worker_stats
+    import torch
+    torch.set_num_threads(num_threads)
+    if _eval_list is None:
+        # Spawned: nothing was inherited from the parent
+        _signal_cache = signal_cache
+        _micro_batch_size = micro_batch_size
+        _eval_list = load_12ECG_model(model_input, model_config, backend=backend)
+        if instrument_stats and instrument_log is not None:
+            instrument.enable(instrument.JsonLinesSink(instrument_log))
+    if instrument_stats:
+        _worker_stats = instrument.Aggregator()
+        instrument.for_worker_process(_worker_stats)
+
+def _load_batch(input_directory: Path, names, io_threads: int):
+    if _signal_cache is not None:
+        with instrument.span("read", records=len(names)) as span:
+            data, headers = [_signal_cache[f] for f in names], [_signal_cache.header(f) for f in names]
+            if span:
+                span.set(bytes=sum(d.nbytes for d in data))
+        return data, headers
+    with ThreadPoolExecutor(io_threads) as executor:
+        loaded = list(executor.map(lambda f: load_challenge_data(input_directory / f), names))
+    data = [d for d, _ in loaded]
+    headers = [h for _, h in loaded]
+    return data, headers
+
+def _classify(names, data, headers):
+    labels, scores, classes = run_12ECG_classifier_batch(
+        data, headers, _eval_list, batch_size=len(names), micro_batch_size=_micro_batch_size
+    )
+    return names, scores, labels, classes
+
+def _classify_batch(args):
+    input_directory, names, io_threads = args
+    result = _classify(names, *_load_batch(input_directory, names, io_threads))
+    if _worker_stats is None:
+        return result, None
+    instrument.flush()
+    return result, _worker_stats.reset()
+
+def prefetch(fn, items, executor, depth: int=2):
+    """Like `map(fn, items)`, but runs up to `depth` calls ahead in `executor`"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def find_unprocessed_records(input_files, output_directory: Path, overwrite: bool=False,
+                             csv: bool=True, store: PredictionStore=None):
+    """Names of records in `input_files` without an output (yet)"""
+    if overwrite:
+        return input_files
+    stored = set(store.records) if store is not None else set()
+    return [
+        f for f in input_files
+        if (csv and not (output_directory / (Path(f).name+".csv")).exists()) or (store is not None and Path(f).name not in stored)
+    ]
+
+def run_driver(model_input, model_config: Path, input_directory: Path, output_directory: Path,
+               workers: int=1, threads: int=None, batch_size: int=32, io_threads: int=4, overwrite: bool=False,
+               output_format: str="csv", signal_cache: Path=None, micro_batch_size: int=None,
+               instrument_stats: bool=False, instrument_log: Path=None, profile_trace: Path=None,
+               backend: str=None):
+    """Classify every record in `input_directory`.
+
+    `output_format` is one of:
+    - "csv"   one challenge output CSV per record (default)
+    - "store" every prediction in one `PredictionStore`, at `output_directory / "predictions"`
+    - "both"
+
+    If `signal_cache` is given (see `src.data.signal_cache`), signals are read
+    from the cache instead of decoding WFDB files in `input_directory`.
+
+    If `micro_batch_size` is given, at most that many chunks of a recording
+    are evaluated at once (bounded memory for long recordings).
+
+    `backend` overrides the inference backend in `model_config/backend.json`
+    (see `src.backends`), e.g. "int8-static".
+
+    Records that already have an output are skipped, so an interrupted run
+    can be resumed. With `workers > 1`, batches of records are classified by
+    a pool of processes that share one loaded ensemble (forked from this
+    process; where "fork" isn't available, each worker loads its own).
+
+    Instrumentation (see `src.instrument`) is off by default:
+    - `instrument_stats` prints the time spent in each stage at the end
+    - `instrument_log` appends every timed event to a JSON-lines file
+    - `profile_trace` writes a `torch.profiler` Chrome trace (main process only)
+    """
+    global _eval_list, _signal_cache, _micro_batch_size
+    _micro_batch_size = micro_batch_size
+    stats = None
+    if instrument_stats or instrument_log is not None or profile_trace is not None:
+        stats = instrument.enable(instrument.Aggregator())[0]
+    if instrument_log is not None:
+        instrument.enable(instrument.JsonLinesSink(instrument_log))
+    if profile_trace is not None:
+        instrument.enable(instrument.TorchProfilerSink(profile_trace))
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
 
-if __name__ == '__main__':
-    # Parse arguments.
-    if len(sys.argv) != 5:
-        raise Exception('Include the input and output directories as arguments, e.g., python driver.py model_input model_config input output.')
-
-    model_input = sys.argv[1]
-    model_config = Path(sys.argv[2])
-    input_directory = Path(sys.argv[3])
-    output_directory = Path(sys.argv[4])
-
-    # Find files.
-    input_files = []
-    for f in input_directory.iterdir():
-        if f.suffix == ".hea":
-            input_files.append(f.stem)
-    
     if not output_directory.exists():
         output_directory.mkdir()
 
     # Load model.
-    print('Loading 12ECG model...')
-    model = load_12ECG_model(model_input, model_config)
-
-    # Iterate over files.
-    print('Extracting 12ECG features...')
-    num_files = len(input_files)
-
-    for i, f in enumerate(input_files):
-        print('    {}/{}...'.format(i+1, num_files))
-        data,header_data = load_challenge_data( input_directory / f )
-        current_label, current_score,classes = run_12ECG_classifier(data,header_data, model)
-        # Save results.
-        save_challenge_predictions(output_directory,f,current_score,current_label,classes)
+    fork = workers > 1 and "fork" in multiprocessing.get_all_start_methods()
+    if workers > 1 and not fork:
+        import dsail.config as config
+        classes = config.DataConfig(Path(model_config) / "data.json").scored_classes
+    else:
+        import torch
+        torch.set_num_threads(1 if fork else threads)
+        print('Loading 12ECG model...')
+        _eval_list = load_12ECG_model(model_input, model_config, backend=backend)
+        classes = _eval_list[0].scored_classes
+        if fork and isinstance(_eval_list[3], EnsembleModel):
+            _eval_list[3].eval()
+            _eval_list[3].stack()   # Shared by the workers too
+
+    with ExitStack() as stack:
+        # Find files.
+        csv = output_format in ("csv", "both")
+        store = None
+        if output_format in ("store", "both"):
+            store = stack.enter_context(PredictionStore(output_directory / "predictions", classes))
+        if signal_cache is not None:
+            _signal_cache = SignalCache(signal_cache)
+            input_files = list(_signal_cache.names)
+        else:
+            input_files = sorted(f.stem for f in input_directory.iterdir() if f.suffix == ".hea")
+        input_files = find_unprocessed_records(input_files, output_directory, overwrite, csv, store)
+
+        # Iterate over files.
+        print('Extracting 12ECG features...')
+        num_files = len(input_files)
+        batches = [
+            (input_directory, input_files[i:i+batch_size], io_threads)
+            for i in range(0, num_files, batch_size)
+        ]
+
+        if workers > 1:
+            instrument.flush()
+            pool = stack.enter_context(multiprocessing.get_context("fork" if fork else "spawn").Pool(
+                workers, initializer=_init_worker,
+                initargs=(model_input, model_config, threads, backend, _signal_cache, micro_batch_size,
+                          stats is not None, instrument_log),
+            ))
+            results = pool.imap_unordered(_classify_batch, batches)
+        else:
+            # Read the next batch from disk while the current one is classified
+            loader = stack.enter_context(ThreadPoolExecutor(1))
+            loaded = prefetch(lambda b: (b[1], *_load_batch(*b)), batches, loader)
+            results = ((_classify(*batch), None) for batch in loaded)
+
+        done = 0
+        for (names, scores, labels, classes), worker_stats in results:
+            names = [Path(f).name for f in names]
+            if worker_stats:
+                stats.merge(worker_stats)
+            # Save results.
+            with instrument.span("write", records=len(names)):
+                if csv:
+                    for f, current_score, current_label in zip(names, scores, labels):
+                        save_challenge_predictions(output_directory,f,current_score,current_label,classes)
+                if store is not None:
+                    store.append(names, scores, labels)
+            done += len(names)
+            print('    {}/{}...'.format(done, num_files))
+
+    if stats is not None:
+        instrument.disable()
+        print('Time spent in each stage (summed over workers):')
+        stats.print_summary()
+
+
+if __name__ == '__main__':
+    # Parse arguments.
+    parser = argparse.ArgumentParser(
+        description='Run the 12ECG classifier on every record in a directory, e.g. python driver.py model_input model_config input output.'
+    )
+    parser.add_argument('model_input', help='directory with finalized_model_*.sav checkpoints')
+    parser.add_argument('model_config', type=Path, help='directory with data.json, model.json etc.')
+    parser.add_argument('input_directory', type=Path)
+    parser.add_argument('output_directory', type=Path)
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=None, help='PyTorch threads per worker (default: cores / workers)')
+    parser.add_argument('--batch-size', type=int, default=32, help='records classified together')
+    parser.add_argument('--io-threads', type=int, default=4, help='threads reading records from disk')
+    parser.add_argument('--overwrite', action='store_true', help='rerun records that already have an output')
+    parser.add_argument('--format', choices=['csv', 'store', 'both'], default='csv',
+                        help='one CSV per record, and/or one consolidated prediction store')
+    parser.add_argument('--signal-cache', type=Path, default=None,
+                        help='read signals from a cache built by src.data.signal_cache.build_signal_cache')
+    parser.add_argument('--micro-batch-size', type=int, default=None,
+                        help='evaluate long recordings this many chunks at a time (bounded memory)')
+    parser.add_argument('--instrument', action='store_true', help='print the time spent in each stage at the end')
+    parser.add_argument('--instrument-log', type=Path, default=None, help='append timing events to this JSON-lines file')
+    parser.add_argument('--profile-trace', type=Path, default=None,
+                        help='write a torch.profiler Chrome trace of the main process to this file')
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help='inference backend (default: from model_config/backend.json, else eager)')
+    args = parser.parse_args()
 
+    run_driver(
+        args.model_input, args.model_config, args.input_directory, args.output_directory,
+        workers=args.workers, threads=args.threads, batch_size=args.batch_size,
+        io_threads=args.io_threads, overwrite=args.overwrite, output_format=args.format,
+        signal_cache=args.signal_cache, micro_batch_size=args.micro_batch_size,
+        instrument_stats=args.instrument, instrument_log=args.instrument_log, profile_trace=args.profile_trace,
+        backend=args.backend,
+    )
 
     print('Done.')
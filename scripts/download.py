@@ -0,0 +1,254 @@
+"""Download PhysioNet projects (or single files), verified against SHA256 sums.
+
+PhysioNet publishes a `SHA256SUMS.txt` manifest at the root of every project
+(e.g. https://physionet.org/files/norwegian-athlete-ecg/1.0.0/SHA256SUMS.txt).
+Every file in the manifest is downloaded by a pool of threads, hashed while
+it streams, and only moved into place if the hash matches. Interrupted
+downloads are kept as `.part` files and resumed with HTTP range requests.
+The size and mtime of every verified file are recorded in `.sha256-stamps.json`
+in the project directory, so files that haven't changed since aren't hashed
+again on the next run (unless `--verify` is given).
+
+Example usage:
+```
+python scripts/download.py https://physionet.org/files/norwegian-athlete-ecg/1.0.0/ ./data
+python scripts/download.py https://physionet.org/files/challenge-2020/1.0.2/ ./data --include "training/ptb/*"
+```
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+from urllib.parse import quote, urljoin, urlparse
+
+import requests
+
+MANIFEST = "SHA256SUMS.txt"
+STAMPS_FILE = ".sha256-stamps.json"
+CHUNK_SIZE = 1 << 18    # 256 KiB
+
+
+class ManifestEntry(NamedTuple):
+    path: str       # Relative to the project URL, e.g. "training/ptb/g1/S0001.hea"
+    sha256: str
+
+
+# HTTP sessions
+# -------------
+
+_local = threading.local()
+
+def get_session(pool_size: int=8) -> requests.Session:
+    """One `requests.Session` per thread (connections are kept alive)"""
+    if getattr(_local, "session", None) is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return _local.session
+
+
+# Manifest
+# --------
+
+def parse_manifest(text: str) -> List[ManifestEntry]:
+    """Lines of `sha256sum` output: "<hash> <path>" (path may start with '*')"""
+    entries = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        sha256, path = line.strip().split(maxsplit=1)
+        path = path.lstrip('*')
+        if path.startswith('./'):
+            path = path[2:]
+        entries.append(ManifestEntry(path, sha256.lower()))
+    return entries
+
+def read_manifest(project_url: str, timeout: float=60) -> List[ManifestEntry]:
+    response = get_session().get(urljoin(project_url, MANIFEST), timeout=timeout)
+    response.raise_for_status()
+    return parse_manifest(response.text)
+
+def project_dir(project_url: str, data_dir: Path) -> Path:
+    """Where a project is saved, e.g. .../files/challenge-2020/1.0.2/ -> data_dir/challenge-2020/1.0.2
+    (same layout as `wget -nH --cut-dirs=1`)
+    """
+    parts = [p for p in urlparse(project_url).path.split('/') if p]
+    if parts and parts[0] == "files":
+        parts = parts[1:]
+    return Path(data_dir).joinpath(*parts)
+
+
+# Files
+# -----
+
+def sha256_file(path: Path, hasher=None):
+    """Hash of a file (or `hasher` updated with its contents)"""
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher
+
+def file_stamp(path: Path) -> Tuple[int, int]:
+    """(size, mtime in ns) of a file"""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def download_file(url: str, destination: Path, sha256: Optional[str]=None, retries: int=3,
+                  timeout: float=60, pool_size: int=8, stamp: Optional[Tuple[int, int]]=None) -> Tuple[str, int]:
+    """Download `url` to `destination`, resuming a previous partial download.
+
+    Data is written to `destination.part` and hashed as it arrives. If the
+    connection drops, the download continues from where it stopped (HTTP
+    `Range`). The file is only moved to `destination` once complete, and if
+    `sha256` is given, once its hash matches.
+
+    An existing `destination` is hashed again, unless it still has `stamp`
+    (its `file_stamp` when it last matched `sha256`).
+
+    Returns ("skipped" | "downloaded", bytes transferred). Raises `IOError`
+    if the hash doesn't match.
+    """
+    destination = Path(destination)
+    if destination.exists():
+        if sha256 is None or (stamp is not None and file_stamp(destination) == tuple(stamp)):
+            return "skipped", 0
+        if sha256_file(destination).hexdigest() == sha256:
+            return "skipped", 0
+        destination.unlink()    # Corrupt or outdated
+
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    part = destination.with_name(destination.name + ".part")
+    session = get_session(pool_size)
+    transferred = 0
+
+    for attempt in range(retries + 1):
+        # Continue hashing from whatever is already on disk
+        offset = part.stat().st_size if part.exists() else 0
+        hasher = sha256_file(part) if offset else hashlib.sha256()
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    pass    # Range not satisfiable: the part file is already complete
+                elif offset and response.status_code != 206:
+                    # Server ignored the range request: start again
+                    response.raise_for_status()
+                    offset, hasher = 0, hashlib.sha256()
+                else:
+                    response.raise_for_status()
+                if response.status_code != 416:
+                    with open(part, 'ab' if offset else 'wb') as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                            hasher.update(chunk)
+                            transferred += len(chunk)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+    if sha256 is not None and hasher.hexdigest() != sha256:
+        part.unlink()
+        raise IOError(f"SHA256 mismatch for {url}")
+    part.replace(destination)
+    return "downloaded", transferred
+
+def _read_stamps(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+def _write_stamps(path: Path, stamps: dict):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(stamps))
+    os.replace(tmp, path)
+
+def download_project(project_url: str, data_dir: Path, workers: int=8, include: List[str]=None,
+                     verify_manifest: bool=True, verify: bool=False) -> List[str]:
+    """Download every file listed in a project's `SHA256SUMS.txt`.
+
+    `include` is a list of glob patterns (e.g. "training/ptb/*") to download
+    only part of a project. Files that already exist with the right hash are
+    skipped, so this can be run again to resume or repair a download. Files
+    whose size and mtime haven't changed since their hash was last checked
+    (`STAMPS_FILE`) are trusted, unless `verify` is set.
+
+    Returns the paths of files that failed (empty if everything is verified).
+    """
+    if not project_url.endswith('/'):
+        project_url += '/'
+    entries = read_manifest(project_url)
+    if include:
+        entries = [e for e in entries if any(fnmatch.fnmatch(e.path, pattern) for pattern in include)]
+    output_dir = project_dir(project_url, data_dir)
+    print(f"Downloading {len(entries)} files from {project_url} to {output_dir} ({workers} connections)")
+
+    # {path: [sha256, size, mtime_ns]} of files whose hash matched
+    stamps_file = output_dir / STAMPS_FILE
+    stamps = _read_stamps(stamps_file) if verify_manifest else {}
+
+    def stamp(entry: ManifestEntry) -> Optional[Tuple[int, int]]:
+        recorded = stamps.get(entry.path)
+        if verify or not recorded or recorded[0] != entry.sha256:
+            return None
+        return recorded[1], recorded[2]
+
+    failed = []
+    done, transferred, start = 0, 0, time.time()
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            futures = {
+                executor.submit(
+                    download_file, urljoin(project_url, quote(e.path)), output_dir / e.path,
+                    e.sha256 if verify_manifest else None, pool_size=workers, stamp=stamp(e),
+                ): e
+                for e in entries
+            }
+            for future in as_completed(futures):
+                entry = futures[future]
+                done += 1
+                try:
+                    transferred += future.result()[1]
+                    if verify_manifest:
+                        stamps[entry.path] = [entry.sha256, *file_stamp(output_dir / entry.path)]
+                except (IOError, requests.RequestException) as e:
+                    stamps.pop(entry.path, None)
+                    failed.append(entry.path)
+                    print(f"WARNING: {entry.path} failed ({e})")
+                if done % 500 == 0 or done == len(entries):
+                    rate = transferred / max(time.time() - start, 1e-9) / 1e6
+                    print(f"    {done}/{len(entries)} files, {transferred / 1e6:.1f} MB ({rate:.1f} MB/s)")
+    finally:
+        if verify_manifest and output_dir.exists():
+            _write_stamps(stamps_file, stamps)
+
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download a PhysioNet project, verified against its SHA256SUMS.txt.')
+    parser.add_argument('url', help='project URL, e.g. https://physionet.org/files/norwegian-athlete-ecg/1.0.0/')
+    parser.add_argument('data_dir', type=Path, help='files are saved to data_dir/<project>/<version>/')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent connections')
+    parser.add_argument('--include', action='append', default=None,
+                        help='only download files matching this glob pattern (can be repeated)')
+    parser.add_argument('--verify', action='store_true',
+                        help='hash every existing file again, even if it is unchanged since it was last verified')
+    args = parser.parse_args()
+
+    failed = download_project(args.url, args.data_dir, workers=args.workers, include=args.include,
+                              verify=args.verify)
+    if failed:
+        raise SystemExit(f"{len(failed)} files failed, run again to retry")
@@ -1,30 +1,21 @@
 from pathlib import Path
 from os.path import expanduser
-import os
+import argparse
 import configparser
 
 import git
 
-data_dir = Path(expanduser("./data"))
+from download import download_project
 
-def wget(url, to_path):
-    # TODO: Check if wget is available first. Suggest how to install if not.
+data_dir = Path(expanduser("./data"))
+workers = 8
 
-    # https://www.man7.org/linux/man-pages/man1/wget.1.html
-    # Mirroring
-    # ---------
-    # -r        Turns on recursive retrieval (default depth 5)
-    # -N        Turn on timestamps
-    # -l inf    Infinite recursion depth
-    # -c    Continue to download partially-downloaded files
-    # -np   Never recursively ascend to parent directories
-    #
-    # Output directory
-    # ----------------
-    # -nH   Disable creation of hostname directory (e.g. physionet.org)
-    # --cut-dirs=1  Ignore first part of url in directory structure (e.g. physionet.org/files)
-    # -P    Prefix for output directory
-    os.system(f"wget -r -N -c -np -nH --cut-dirs=1 -P {to_path} {url}")
+def download(url, to_path):
+    # Every file in the project's SHA256SUMS.txt, downloaded by `workers`
+    # connections and verified. Run again to resume an interrupted download.
+    failed = download_project(url, to_path, workers=workers)
+    if failed:
+        print(f"WARNING: {len(failed)} files failed to download, run again to retry")
     
 
 # PhysioNet Challenge 2020 - Training data (7.5 GB)
@@ -38,7 +29,7 @@ def wget(url, to_path):
 # - ptb-xl (electrocardiography Database), 21,837 recordings
 # - georgia (12-Lead ECG Challenge Database), 10,344 recordings
 def download_physionet2020():
-    wget(
+    download(
         url="https://physionet.org/files/challenge-2020/1.0.2/",
         to_path=data_dir
     )
@@ -46,7 +37,7 @@ def download_physionet2020():
 
 # MIMIC-IV ECG Matched Subset (90.4 GB)
 def download_mimiciv():
-    wget(
+    download(
         url="https://physionet.org/files/mimic-iv-ecg/1.0/",
         to_path=data_dir
     )
@@ -55,7 +46,7 @@ def download_mimiciv():
 # Norwegian Endurance Athletes (3.2 MB)
 # https://physionet.org/content/norwegian-athlete-ecg/1.0.0/
 def download_norwegian():
-    wget(
+    download(
         url="https://physionet.org/files/norwegian-athlete-ecg/1.0.0/", 
         to_path=data_dir
     )
@@ -73,6 +64,15 @@ def download_pf12red_dataset():
     print("Finished downloading pf12red")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the datasets used in this project.")
+    parser.add_argument("--data-dir", type=Path, default=None,
+                        help="where to save datasets (default: from config.ini, or ask)")
+    parser.add_argument("--mimic", choices=["yes", "no"], default=None,
+                        help="also download MIMIC-IV-ECG, 90.4 GB (default: ask)")
+    parser.add_argument("--workers", type=int, default=workers, help="concurrent connections")
+    args = parser.parse_args()
+    workers = args.workers
+
     # Read current data_dir location from config file, if available.
     config = configparser.ConfigParser()
     if Path("./config.ini").exists():
@@ -80,15 +80,18 @@ if __name__ == "__main__":
         data_dir = Path(expanduser(config["datasets"]["path"]))
 
     # Check if user is happy with DATA_DIR location
-    while True:
-        print(f"DATA_DIR is {data_dir}")
-        if input("Change directory? [y/n] ").lower() == "y":
-            new_dir = input("Enter new location for DATA_DIR: ")
-            data_dir = Path(expanduser(new_dir))
-        else:
-            break
+    if args.data_dir is not None:
+        data_dir = Path(expanduser(args.data_dir))
+    else:
+        while True:
+            print(f"DATA_DIR is {data_dir}")
+            if input("Change directory? [y/n] ").lower() == "y":
+                new_dir = input("Enter new location for DATA_DIR: ")
+                data_dir = Path(expanduser(new_dir))
+            else:
+                break
     if not data_dir.exists():
-        data_dir.mkdir()
+        data_dir.mkdir(parents=True)
     
     # Save path to configuration file `config.ini`
     with open("config.ini", 'w') as file:
@@ -98,11 +101,14 @@ if __name__ == "__main__":
     # Downloads
     print("Starting downloads...")
     download_pf12red_dataset() if not (data_dir / "pf12red").exists() else print("pf12red already downloaded")
-    download_norwegian() if not (data_dir / "norwegian-athlete-ecg").exists() else print("norwegian-athlete-ecg already downloaded")
-    download_physionet2020() if not (data_dir / "challenge-2020").exists() else print("challenge-2020 already downloaded")
+    # Already downloaded files are verified and skipped (interrupted downloads resume)
+    download_norwegian()
+    download_physionet2020()
 
     # TODO: consider if we need MIMIC-IV, and whether we need slightly better 
     # data management than "just wget everything".
-    if input("Do you need MIMIC-IV-ECG? (90.4 GB) [y/n] ").lower() == "y":
-        download_mimiciv() if not (data_dir / "mimic-iv-ecg").exists() else print("mimic-iv-ecg already downloaded")
+    if args.mimic is None:
+        args.mimic = "yes" if input("Do you need MIMIC-IV-ECG? (90.4 GB) [y/n] ").lower() == "y" else "no"
+    if args.mimic == "yes":
+        download_mimiciv()
     
\ No newline at end of file
@@ -1,7 +1,7 @@
 from pathlib import Path
 from zipfile import ZipFile
 
-import requests
+from download import download_file
 
 sources_url = "https://physionet.org/static/published-projects/challenge-2020/1.0.2/sources/"
 destination_dir = Path("./entries")
@@ -15,14 +15,11 @@ teams = [
 
 def download_zip(url, save_path):
     print(f"Downloading file from: {url}")
-    response = requests.get(url, stream=True)  # Stream the response to handle large files
-    if response.status_code == 200:
-        with open(save_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=1024):  
-                file.write(chunk)
+    try:
+        download_file(url, save_path)   # Resumes a partial download, if any
         print(f"File downloaded successfully: {save_path}")
-    else:
-        print(f"Failed to download file. Status code: {response.status_code}")
+    except Exception as e:
+        print(f"Failed to download file ({e})")
 
 def extract_zip(file, out_dir):
     with ZipFile(file, 'r') as zip:
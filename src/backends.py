@@ -0,0 +1,391 @@
+# Alternative CPU inference backends for the DSAIL_SNU ensemble
+#
+# Each network of the ensemble loaded by `load_12ECG_model` is converted to
+# one of:
+# - "eager"         the float32 PyTorch networks, unchanged (default)
+# - "torchscript"   `torch.jit.script` + `torch.jit.freeze` (constant folding, conv-bn fusion)
+# - "int8-dynamic"  dynamic INT8 quantization of Linear/LSTM/GRU layers
+# - "int8-static"   static INT8 quantization (FX graph mode) of every traceable
+#                   submodule, calibrated on a sample of local records
+# - "onnx"          exported to ONNX, run with onnxruntime (optional dependency)
+# - "onnx-int8"     the same, with onnxruntime's dynamic INT8 quantization
+#
+# The backend is chosen with `backend.json` in the config directory (next to
+# data.json etc.), or the `backend` argument of `load_12ECG_model`:
+# ```
+# {"backend": "int8-static", "calibration_dir": "data/challenge-2020/1.0.2/training/ptb-xl", "calibration_records": 64}
+# ```
+#
+# `python -m src.backends` checks a backend against the float ensemble
+# (agreement on the `diagnosis_codes` classes, F1 and challenge score) and
+# measures its throughput and size.
+
+import argparse
+import copy
+import inspect
+import io
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import torch
+import wfdb
+from dsail.data import collate_into_block, collate_into_list, get_dataset_from_configs
+
+from src.data.metrics import challenge_score, confusion_counts, f1_score, load_weights
+from src.data.records import iter_records
+from src.data.util import diagnosis_codes
+from src.preprocess import preprocess_config
+
+BACKENDS = ("eager", "torchscript", "int8-dynamic", "int8-static", "onnx", "onnx-int8")
+BACKEND_CONFIG = "backend.json"
+
+
+class ConvertedEnsemble(torch.nn.Module):
+    """Converted networks of every fold, used like `EnsembleModel`
+    (returns (folds, records, classes)). Runs on the CPU only.
+    """
+    cpu_only = True
+
+    def __init__(self, nets: List[torch.nn.Module], backend: str):
+        super().__init__()
+        self.nets = torch.nn.ModuleList(nets)
+        self.backend = backend
+
+    def __len__(self):
+        return len(self.nets)
+
+    def __iter__(self):
+        return iter(self.nets)
+
+    def __getitem__(self, idx):
+        return self.nets[idx]
+
+    def forward(self, inputs, flags):
+        return torch.stack([net(inputs, flags) for net in self.nets])
+
+    def _apply(self, fn, *args, **kwargs):
+        # Quantized and ONNX networks can't be moved to another device
+        return self
+
+
+def _fold_copy(net: torch.nn.Module) -> torch.nn.Module:
+    """Deep copy of one network of an ensemble, in evaluation mode and
+    without gradients, so converting it leaves the float ensemble as is.
+    """
+    net = copy.deepcopy(net).eval()
+    net.requires_grad_(False)
+    return net
+
+def _quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError("PyTorch was built without a quantized engine")
+
+
+# Conversions of one network
+# --------------------------
+
+def to_torchscript(net: torch.nn.Module) -> torch.jit.ScriptModule:
+    """Scripted (not traced: chunks are grouped into records with
+    data-dependent shapes) and frozen copy of a network.
+    """
+    scripted = torch.jit.script(net.eval())
+    return torch.jit.freeze(scripted)
+
+def quantize_dynamic(net: torch.nn.Module) -> torch.nn.Module:
+    """INT8 weights for Linear/LSTM/GRU layers (activations quantized on the fly).
+
+    Convolutions aren't supported by dynamic quantization and stay float32.
+    """
+    from torch.ao.quantization import quantize_dynamic as _quantize_dynamic
+    torch.backends.quantized.engine = _quantized_engine()
+    return _quantize_dynamic(net.eval(), {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}, dtype=torch.qint8)
+
+def quantize_static(net: torch.nn.Module, calibration: List[Tuple[torch.Tensor, torch.Tensor]]) -> torch.nn.Module:
+    """INT8 weights and activations, calibrated on `calibration` (inputs, flags) batches.
+
+    The top level `forward` groups chunks into records (data-dependent), so
+    it can't be traced. Instead every direct submodule that can be traced by
+    FX (e.g. the convolutional stages) is quantized on its own, with
+    conv-bn-relu fusion; submodules that can't be traced stay float32 (with a
+    warning). Raises `RuntimeError` if no submodule could be quantized.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+    engine = _quantized_engine()
+    torch.backends.quantized.engine = engine
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+
+    net = net.eval()
+    examples = {}
+    hooks = [
+        child.register_forward_pre_hook(lambda module, args, name=name: examples.setdefault(name, args))
+        for name, child in net.named_children()
+    ]
+    with torch.no_grad():
+        net(*calibration[0])
+    for hook in hooks:
+        hook.remove()
+
+    prepared = []
+    for name, child in list(net.named_children()):
+        args = examples.get(name)
+        if args is None or not any(True for _ in child.parameters()):
+            continue
+        if not all(isinstance(a, torch.Tensor) and a.is_floating_point() for a in args):
+            continue
+        try:
+            setattr(net, name, prepare_fx(child, qconfig_mapping, args))
+            prepared.append(name)
+        except Exception as e:
+            # Not traceable (e.g. data dependent control flow): keep float32
+            print(f"WARNING: Couldn't quantize submodule {name} ({type(e).__name__}: {e}); keeping it float32")
+    if not prepared:
+        raise RuntimeError("int8-static: no submodule of the network could be quantized")
+
+    with torch.no_grad():
+        for inputs, flags in calibration:
+            net(inputs, flags)
+    for name in prepared:
+        setattr(net, name, convert_fx(getattr(net, name)))
+    return net
+
+class OnnxNet(torch.nn.Module):
+    """A network exported to ONNX, run with onnxruntime"""
+    def __init__(self, path: Path, threads: int=None):
+        super().__init__()
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        self.path = Path(path)
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+
+    def forward(self, inputs, flags):
+        outputs = self.session.run(None, {'inputs': inputs.cpu().numpy(), 'flags': flags.cpu().numpy()})[0]
+        return torch.from_numpy(outputs)
+
+def export_onnx(net: torch.nn.Module, example: Tuple[torch.Tensor, torch.Tensor], path: Path,
+                quantize: bool=False) -> OnnxNet:
+    """Export a network (scripted, so chunk grouping stays dynamic) to `path`"""
+    path = Path(path)
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False    # TorchScript based exporter (supports scripted control flow)
+    torch.onnx.export(
+        torch.jit.script(net.eval()), example, str(path), input_names=['inputs', 'flags'], output_names=['outputs'],
+        dynamic_axes={'inputs': {0: 'chunks', 2: 'samples'}, 'flags': {0: 'chunks'}, 'outputs': {0: 'records'}},
+        opset_version=17, **kwargs,
+    )
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic as _quantize_onnx
+        quantized_path = path.with_name(path.stem + ".int8.onnx")
+        _quantize_onnx(str(path), str(quantized_path), weight_type=QuantType.QInt8)
+        path = quantized_path
+    return OnnxNet(path)
+
+
+# Ensembles
+# ---------
+
+def load_batches(records: Iterable[Path], eval_list, batch_size: int=8) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Preprocessed and chunked (inputs, flags) batches of some records"""
+    data_cfg, preprocess_cfg = copy.copy(eval_list[0]), preprocess_config(eval_list[1])
+    batches, samples = [], []
+    records = list(records)
+    for i, record in enumerate(records):
+        data_cfg.data = wfdb.rdrecord(record).p_signal.transpose()
+        with open(Path(record).with_suffix('.hea'), 'r') as f:
+            data_cfg.header = f.readlines()
+        dataset = get_dataset_from_configs(data_cfg, preprocess_cfg)
+        samples.extend(dataset[j] for j in range(len(dataset)))
+        if len(samples) >= batch_size or i == len(records) - 1:
+            inputs, flags, _ = collate_into_block(collate_into_list(samples), 2048, 1536)
+            batches.append((inputs, flags))
+            samples = []
+    return batches
+
+def convert_ensemble(models, backend: str, calibration: List[Tuple[torch.Tensor, torch.Tensor]]=None,
+                     export_dir: Path=None) -> torch.nn.Module:
+    """Every network of `models` (e.g. an `EnsembleModel`) converted to `backend`.
+
+    "int8-static" needs `calibration` batches (see `load_batches`); the ONNX
+    backends need an example batch and write the models to `export_dir`.
+    """
+    if backend == "eager":
+        return models
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend} (expected one of {', '.join(BACKENDS)})")
+    if backend in ("int8-static", "onnx", "onnx-int8") and not calibration:
+        raise ValueError(f"The {backend} backend needs calibration records")
+
+    nets = []
+    for fold, net in enumerate(models):
+        net = _fold_copy(net)
+        if backend == "torchscript":
+            nets.append(to_torchscript(net))
+        elif backend == "int8-dynamic":
+            nets.append(quantize_dynamic(net))
+        elif backend == "int8-static":
+            nets.append(quantize_static(net, calibration))
+        else:
+            if export_dir is None:
+                export_dir = Path(tempfile.mkdtemp(prefix="dsail-onnx-"))
+            Path(export_dir).mkdir(parents=True, exist_ok=True)
+            nets.append(export_onnx(net, calibration[0], Path(export_dir) / f"model_{fold}.onnx",
+                                    quantize=backend == "onnx-int8"))
+    return ConvertedEnsemble(nets, backend)
+
+def read_backend_config(config_dir: Path) -> dict:
+    """Contents of `backend.json` in a config directory ({"backend": "eager"} if missing)"""
+    path = Path(config_dir) / BACKEND_CONFIG
+    if not path.exists():
+        return {"backend": "eager"}
+    with open(path, 'r') as f:
+        return {"backend": "eager", **json.load(f)}
+
+def apply_backend(eval_list, config_dir: Path, backend: str=None, export_dir: Path=None):
+    """`eval_list` from `load_12ECG_model`, with the ensemble converted to the
+    backend in `backend.json` (or `backend`, if given).
+    """
+    options = read_backend_config(config_dir)
+    backend = backend or options["backend"]
+    if backend == "eager":
+        return eval_list
+
+    calibration = None
+    if backend in ("int8-static", "onnx", "onnx-int8"):
+        if "calibration_dir" not in options:
+            raise ValueError(f"The {backend} backend needs \"calibration_dir\" in {Path(config_dir) / BACKEND_CONFIG}")
+        num_records = options.get("calibration_records", 64)
+        records = [r.path for _, r in zip(range(num_records), iter_records(options["calibration_dir"]))]
+        calibration = load_batches(records, eval_list)
+
+    models = convert_ensemble(eval_list[3], backend, calibration, export_dir or options.get("export_dir"))
+    return [*eval_list[:3], models, eval_list[4]]
+
+
+# Parity check
+# ------------
+
+def model_size(models) -> int:
+    """Bytes of the serialized networks"""
+    total = 0
+    for net in models:
+        if isinstance(net, OnnxNet):
+            total += net.path.stat().st_size
+            continue
+        buffer = io.BytesIO()
+        if isinstance(net, torch.jit.ScriptModule):
+            torch.jit.save(net, buffer)
+        else:
+            torch.save(net.state_dict(), buffer)
+        total += buffer.tell()
+    return total
+
+def parity_check(float_eval_list, eval_list, records: List[Path], labels: np.ndarray=None,
+                 weights: np.ndarray=None, codes: Iterable[int]=diagnosis_codes, batch_size: int=32) -> dict:
+    """Compare a converted ensemble with the float ensemble on `records`.
+
+    Reports, for every class in `codes`: how often both give the same label,
+    the largest score difference, and (with `labels`, shape (records,
+    classes)) both F1 scores. With `weights` too, the challenge score of
+    both. Also throughput (records/s) and serialized model size.
+    """
+    from PhysioNet2020_driver import load_challenge_data
+    from src.run_12ECG_classifier import run_12ECG_classifier_batch
+
+    loaded = [load_challenge_data(Path(r)) for r in records]
+    data, headers = [d for d, _ in loaded], [h for _, h in loaded]
+    classes = list(float_eval_list[0].scored_classes)
+
+    results = {}
+    for name, el in (("float", float_eval_list), ("backend", eval_list)):
+        run_12ECG_classifier_batch(data[:1], headers[:1], el)     # Warm up
+        start = time.perf_counter()
+        predicted, scores, _ = run_12ECG_classifier_batch(data, headers, el, batch_size=batch_size)
+        results[name] = {
+            'labels': predicted.astype(bool),
+            'scores': scores,
+            'records_per_s': len(records) / (time.perf_counter() - start),
+            'size_mb': model_size(el[3]) / 2**20,
+        }
+
+    report = {
+        'records': len(records),
+        'speedup': results['backend']['records_per_s'] / results['float']['records_per_s'],
+        'classes': {},
+    }
+    for name in ("float", "backend"):
+        report[name] = {'records_per_s': results[name]['records_per_s'], 'size_mb': results[name]['size_mb']}
+
+    f1 = {}
+    if labels is not None:
+        for name in ("float", "backend"):
+            f1[name] = f1_score(confusion_counts(labels, results[name]['labels']))
+            if weights is not None:
+                report[name]['challenge_score'] = challenge_score(labels, results[name]['labels'], weights, classes)
+    for code in codes:
+        if str(code) not in classes:
+            continue
+        c = classes.index(str(code))
+        row = {
+            'agreement': float(np.mean(results['float']['labels'][:, c] == results['backend']['labels'][:, c])),
+            'max_score_diff': float(np.max(np.abs(results['float']['scores'][:, c] - results['backend']['scores'][:, c]))),
+        }
+        for name in f1:
+            row[f'f1_{name}'] = float(f1[name][c])
+        report['classes'][str(code)] = row
+    return report
+
+def print_report(report: dict, backend: str):
+    print(f"{backend} vs float on {report['records']} records:")
+    print(f"    throughput: {report['float']['records_per_s']:.2f} -> {report['backend']['records_per_s']:.2f} "
+          f"records/s ({report['speedup']:.2f}x)")
+    print(f"    model size: {report['float']['size_mb']:.1f} -> {report['backend']['size_mb']:.1f} MB")
+    if 'challenge_score' in report['float']:
+        print(f"    challenge score: {report['float']['challenge_score']:.4f} -> {report['backend']['challenge_score']:.4f}")
+    for code, row in report['classes'].items():
+        line = f"    {code:>10} {diagnosis_codes.get(int(code), ''):<38} agreement {row['agreement']:7.2%}  " \
+               f"max |diff| {row['max_score_diff']:.4f}"
+        if 'f1_float' in row:
+            line += f"  F1 {row['f1_float']:.3f} -> {row['f1_backend']:.3f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check an inference backend against the float ensemble.')
+    parser.add_argument('checkpoint_dir', type=Path, help='directory with finalized_model_*.sav checkpoints')
+    parser.add_argument('config_dir', type=Path, help='directory with data.json, model.json etc.')
+    parser.add_argument('dataset_dir', type=Path, help='records to compare on (labels read from the headers)')
+    parser.add_argument('--backend', choices=BACKENDS[1:], default=None, help='default: from backend.json')
+    parser.add_argument('--weights', type=Path, default=None, help='challenge weights.csv (to compare challenge scores)')
+    parser.add_argument('--records', type=int, default=500, help='number of records to compare on')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--output', type=Path, default=None, help='write the report as JSON')
+    args = parser.parse_args()
+
+    from src.run_12ECG_classifier import load_12ECG_model
+    from src.thresholds import scored_labels
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    float_eval_list = load_12ECG_model(args.checkpoint_dir, args.config_dir, backend="eager")
+    backend = args.backend or read_backend_config(args.config_dir)["backend"]
+    eval_list = apply_backend(float_eval_list, args.config_dir, backend)
+
+    records = [r.path for _, r in zip(range(args.records), iter_records(args.dataset_dir))]
+    classes = list(float_eval_list[0].scored_classes)
+    labels = scored_labels(records, classes)
+    weights = load_weights(args.weights, classes)[1] if args.weights is not None else None
+
+    report = parity_check(float_eval_list, eval_list, records, labels, weights)
+    print_report(report, backend)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'backend': backend, **report}, f, indent=1)
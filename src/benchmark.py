@@ -0,0 +1,401 @@
+# Inference benchmark for the DSAIL_SNU ensemble
+#
+# Times each stage of `PhysioNet2020_driver.py` on synthetic 12-lead records
+# (written locally as WFDB files) with a randomly initialized ensemble, so it
+# runs without datasets or checkpoints. Records go through the driver's own
+# functions (`load_challenge_data`, `run_12ECG_classifier_batch`), so the
+# inference backend, batched preprocessing and micro-batching are measured
+# too; stages are timed by the pipeline's `instrument` spans. Every
+# combination of batch size, PyTorch threads and worker processes is run,
+# and the results are written as JSON, to track regressions between commits.
+#
+# Example usage:
+# ```
+# python -m src.benchmark config --records 64 --lengths 10 30 60 --batch-sizes 1 8 32 --threads 1 4 --output bench.json
+# python -m src.benchmark config --backend int8-dynamic --micro-batch-size 64
+# python -m src.benchmark config --baseline bench.json     # compare with an earlier run
+# ```
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+import wfdb
+
+import dsail.config as config
+from dsail.model.model_utils import get_model
+
+from src import instrument
+from src.backends import BACKENDS, apply_backend
+from src.ensemble import NUM_FOLDS, EnsembleModel
+from src.preprocess import apply_preprocess
+from src.run_12ECG_classifier import run_12ECG_classifier_batch
+
+STAGES = ['read', 'preprocess', 'collate', 'forward', 'average', 'write']
+LEADS = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+
+
+# Synthetic inputs
+# ----------------
+
+def synthesize_records(output_dir: Path, num_records: int, lengths: List[float], fs: int=500,
+                       seed: int=0) -> List[Path]:
+    """Write `num_records` random 12-lead WFDB records to `output_dir`.
+
+    Record lengths (seconds) cycle through `lengths`. Signals are a 1-1.7 Hz
+    "heartbeat" plus noise, in mV, with challenge style header comments.
+    Returns the record paths (without suffix).
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(num_records):
+        num_samples = int(lengths[i % len(lengths)] * fs)
+        t = np.arange(num_samples) / fs
+        rate = rng.uniform(1.0, 1.7)
+        phases = rng.uniform(0, 2 * np.pi, len(LEADS))
+        signal = np.sin(2 * np.pi * rate * t[:, None] + phases) ** 15 + 0.05 * rng.standard_normal((num_samples, len(LEADS)))
+        name = f"B{i:05d}"
+        wfdb.wrsamp(
+            name, fs=fs, units=['mV'] * len(LEADS), sig_name=LEADS, p_signal=signal,
+            fmt=['16'] * len(LEADS), adc_gain=[1000] * len(LEADS), baseline=[0] * len(LEADS),
+            comments=[f"Age: {rng.integers(18, 90)}", f"Sex: {rng.choice(['Male', 'Female'])}", "Dx: 426783006",
+                      "Rx: Unknown", "Hx: Unknown", "Sx: Unknown"],
+            write_dir=str(output_dir),
+        )
+        paths.append(output_dir / name)
+    return paths
+
+def random_eval_list(config_dir: Path, folds: int=NUM_FOLDS, seed: int=0, backend: str=None,
+                     batch_preprocess: bool=False, fused: bool=True):
+    """Same as `load_12ECG_model`, with randomly initialized networks (no checkpoints).
+
+    If not `fused`, the networks are a list run in turn (like the original
+    list of models) instead of one `EnsembleModel`.
+    """
+    data_cfg = config.DataConfig(config_dir / "data.json")
+    preprocess_cfg = config.PreprocessConfig(config_dir / "preprocess.json")
+    model_cfg = config.ModelConfig(config_dir / "model.json")
+    run_cfg = config.RunConfig(config_dir / "run.json")
+
+    torch.manual_seed(seed)
+    models = [get_model(model_cfg, data_cfg.num_channels, len(data_cfg.scored_classes))[0] for _ in range(folds)]
+    thresholds = np.full(len(data_cfg.scored_classes), 0.5)
+    eval_list = [data_cfg, preprocess_cfg, run_cfg, EnsembleModel(models), thresholds]
+    eval_list = apply_backend(eval_list, config_dir, backend)
+    if batch_preprocess:
+        eval_list = apply_preprocess(eval_list, config_dir)
+    if not fused:
+        eval_list[3] = list(eval_list[3])
+    return eval_list
+
+
+# Measurements
+# ------------
+
+def current_rss() -> int:
+    """Resident set size of this process (bytes)"""
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # No /proc (e.g. macOS): peak so far is the best available
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+class StageTimer():
+    """`instrument` sink: latency samples, busy time and peak RSS of each
+    pipeline stage.
+
+    Every record of a span gets the span's duration as its latency (records
+    in a batch wait for the whole batch). RSS is sampled by a background
+    thread while a stage is running. Stages not in `STAGES` are ignored.
+    """
+    def __init__(self, sample_interval: float=0.002):
+        self.latencies = {name: [] for name in STAGES}
+        self.busy = {name: 0. for name in STAGES}
+        self.records = {name: 0 for name in STAGES}
+        self.peak_rss = {name: 0 for name in STAGES}
+        self._sample_interval = sample_interval
+        self._active = None
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.wait(self._sample_interval):
+            name = self._active
+            if name is not None:
+                self.peak_rss[name] = max(self.peak_rss[name], current_rss())
+
+    @contextmanager
+    def span_context(self, name: str):
+        if name not in self.peak_rss:
+            yield
+            return
+        outer, self._active = self._active, name
+        self.peak_rss[name] = max(self.peak_rss[name], current_rss())
+        try:
+            yield
+        finally:
+            self.peak_rss[name] = max(self.peak_rss[name], current_rss())
+            self._active = outer
+
+    def record(self, event: dict):
+        name, records = event['stage'], event.get('records', 0)
+        if name not in self.busy:
+            return
+        self.latencies[name].extend([event['duration']] * records)
+        self.busy[name] += event['duration']
+        self.records[name] += records
+
+    def close(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def state(self) -> dict:
+        return {
+            'latencies': self.latencies, 'busy': self.busy,
+            'records': self.records, 'peak_rss': self.peak_rss,
+        }
+
+def summarize_stages(states: List[dict], workers: int) -> Dict[str, dict]:
+    """Per-stage statistics from the `StageTimer.state()` of every worker.
+
+    Throughput of a stage is records / busy time, times the number of
+    workers running it in parallel. Latencies are per record, in ms.
+    """
+    summary = {}
+    for name in STAGES:
+        latencies = np.concatenate([np.asarray(s['latencies'][name], dtype=np.float64) for s in states]) * 1000
+        busy = sum(s['busy'][name] for s in states)
+        records = sum(s['records'][name] for s in states)
+        if records == 0:
+            continue
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        summary[name] = {
+            'records_per_s': records * workers / busy if busy > 0 else float('inf'),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'mean_ms': float(latencies.mean()),
+            'busy_s': busy,
+            'peak_rss_mb': max(s['peak_rss'][name] for s in states) / 2**20,
+        }
+    return summary
+
+
+# Pipeline
+# --------
+
+def run_pipeline(paths: List[Path], eval_list, batch_size: int, output_dir: Path, micro_batch_size: int=None):
+    """Classify `paths` with the driver's functions, `batch_size` records at a time"""
+    from PhysioNet2020_driver import load_challenge_data, save_challenge_predictions
+
+    for start in range(0, len(paths), batch_size):
+        batch_paths = paths[start:start + batch_size]
+        loaded = [load_challenge_data(path) for path in batch_paths]
+        labels, scores, classes = run_12ECG_classifier_batch(
+            [d for d, _ in loaded], [h for _, h in loaded], eval_list,
+            batch_size=len(batch_paths), micro_batch_size=micro_batch_size,
+        )
+        for path, score, label in zip(batch_paths, scores, labels):
+            with instrument.span("write", records=1):
+                save_challenge_predictions(output_dir, path.name, score, label, classes)
+
+# Ensemble of this process (built once per process, see `_init_worker`)
+_eval_list = None
+_eval_list_key = None
+
+def _init_worker(config_dir: Path, folds: int, seed: int, backend: str=None, batch_preprocess: bool=False,
+                 fused: bool=True):
+    global _eval_list, _eval_list_key
+    key = (config_dir, folds, seed, backend, batch_preprocess, fused)
+    if _eval_list_key != key:
+        _eval_list = random_eval_list(*key)
+        _eval_list_key = key
+
+def _run_worker(args) -> dict:
+    paths, batch_size, threads, output_dir, micro_batch_size, warmup = args
+    torch.set_num_threads(threads)
+    if warmup:
+        run_pipeline(paths[:batch_size], _eval_list, batch_size, output_dir, micro_batch_size)
+
+    timer = StageTimer()
+    instrument.enable(timer)
+    start = time.time()
+    try:
+        run_pipeline(paths, _eval_list, batch_size, output_dir, micro_batch_size)
+    finally:
+        instrument.disable()    # Closes `timer`
+    return {**timer.state(), 'start': start, 'stop': time.time()}
+
+def benchmark(paths: List[Path], config_dir: Path, batch_size: int, threads: int, workers: int,
+              folds: int=NUM_FOLDS, seed: int=0, fused: bool=True, warmup: bool=True, backend: str=None,
+              batch_preprocess: bool=False, micro_batch_size: int=None) -> dict:
+    """Run every record through the pipeline once, with `workers` processes
+    (each classifying a contiguous share of the records) of `threads`
+    PyTorch threads. Returns the per-stage summary and overall throughput.
+
+    Workers are started with "spawn": forking a process whose PyTorch thread
+    pool is already running can deadlock the child. Start-up and the warm-up
+    batch of each worker aren't timed.
+    """
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_dir = Path(output_dir)
+        shares = [list(share) for share in np.array_split(np.array(paths, dtype=object), workers) if len(share)]
+        jobs = [(share, batch_size, threads, output_dir, micro_batch_size, warmup) for share in shares]
+        initargs = (config_dir, folds, seed, backend, batch_preprocess, fused)
+        if len(jobs) > 1:
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(len(jobs), initializer=_init_worker, initargs=initargs) as pool:
+                states = pool.map(_run_worker, jobs, chunksize=1)
+        else:
+            _init_worker(*initargs)
+            states = [_run_worker(job) for job in jobs]
+
+    wall = max(s['stop'] for s in states) - min(s['start'] for s in states)
+    return {
+        'batch_size': batch_size,
+        'threads': threads,
+        'workers': len(jobs),
+        'fused': fused,
+        'backend': backend,
+        'batch_preprocess': batch_preprocess,
+        'micro_batch_size': micro_batch_size,
+        'records': len(paths),
+        'wall_s': wall,
+        'records_per_s': len(paths) / wall,
+        'stages': summarize_stages(states, len(jobs)),
+    }
+
+
+# Reporting
+# ---------
+
+def environment() -> dict:
+    """Commit, versions and hardware, stored with the results"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def print_run(run: dict):
+    print(f"batch_size={run['batch_size']} threads={run['threads']} workers={run['workers']}: "
+          f"{run['records_per_s']:.2f} records/s")
+    for name, s in run['stages'].items():
+        print(f"    {name:<10} {s['records_per_s']:10.1f} rec/s   p50 {s['p50_ms']:8.2f} ms   "
+              f"p95 {s['p95_ms']:8.2f} ms   p99 {s['p99_ms']:8.2f} ms   RSS {s['peak_rss_mb']:7.1f} MB")
+
+def compare_results(baseline: dict, results: dict, tolerance: float=0.1) -> List[str]:
+    """Stages whose throughput dropped by more than `tolerance` since `baseline`.
+
+    Runs are matched on (batch_size, threads, workers, fused, backend,
+    batch_preprocess, micro_batch_size).
+    """
+    def key(run):
+        return (run['batch_size'], run['threads'], run['workers'], run.get('fused', True), run.get('backend'),
+                run.get('batch_preprocess', False), run.get('micro_batch_size'))
+
+    for field in ('records', 'lengths_s', 'fs', 'folds'):
+        if baseline.get(field) != results.get(field):
+            print(f"WARNING: Different workload ({field}: {baseline.get(field)} vs {results.get(field)})")
+
+    old_runs = {key(run): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        old = old_runs.get(key(run))
+        if old is None:
+            continue
+        for name in ['total'] + list(run['stages']):
+            new_rate = run['records_per_s'] if name == 'total' else run['stages'][name]['records_per_s']
+            old_rate = old['records_per_s'] if name == 'total' else old['stages'].get(name, {}).get('records_per_s')
+            if not old_rate:
+                continue
+            change = new_rate / old_rate - 1
+            label = "batch_size={} threads={} workers={} fused={} backend={} batch_preprocess={} " \
+                    "micro_batch_size={} {}".format(*key(run), name)
+            print(f"    {label}: {old_rate:.1f} -> {new_rate:.1f} records/s ({change:+.1%})")
+            if change < -tolerance:
+                regressions.append(label)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the driver on synthetic records.')
+    parser.add_argument('config_dir', type=Path, help='directory with data.json, model.json etc.')
+    parser.add_argument('--records', type=int, default=64, help='number of synthetic records')
+    parser.add_argument('--lengths', type=float, nargs='+', default=[10.], help='record lengths (seconds)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[32])
+    parser.add_argument('--threads', type=int, nargs='+', default=[max(1, os.cpu_count() or 1)])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1])
+    parser.add_argument('--folds', type=int, default=NUM_FOLDS)
+    parser.add_argument('--unfused', action='store_true', help='run each fold in turn instead of one EnsembleModel call')
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help='inference backend (default: from backend.json, see src.backends)')
+    parser.add_argument('--batch-preprocess', action='store_true', help='preprocess whole batches (see src.preprocess)')
+    parser.add_argument('--micro-batch-size', type=int, default=None,
+                        help='evaluate chunks in micro-batches of this size (see src.train.evaluate_stream)')
+    parser.add_argument('--data-dir', type=Path, default=None, help='keep the synthetic records here (default: temporary)')
+    parser.add_argument('--output', type=Path, default=None, help='write results as JSON')
+    parser.add_argument('--baseline', type=Path, default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='throughput drop reported as a regression')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or Path(tmp_dir)
+        paths = synthesize_records(data_dir, args.records, args.lengths)
+
+        runs = []
+        for batch_size, threads, workers in itertools.product(args.batch_sizes, args.threads, args.workers):
+            run = benchmark(paths, args.config_dir, batch_size, threads, workers, args.folds, fused=not args.unfused,
+                            backend=args.backend, batch_preprocess=args.batch_preprocess,
+                            micro_batch_size=args.micro_batch_size)
+            print_run(run)
+            runs.append(run)
+
+    results = {
+        'environment': environment(),
+        'records': args.records,
+        'lengths_s': args.lengths,
+        'fs': 500,
+        'folds': args.folds,
+        'runs': runs,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.baseline} (commit {baseline['environment'].get('commit')}):")
+        regressions = compare_results(baseline, results, args.tolerance)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} regressions")
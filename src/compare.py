@@ -0,0 +1,179 @@
+# Compare checkpoint variants (original, reweight_1, finetune_6, ...) on the
+# same datasets
+#
+# Running `PhysioNet2020_driver.py` once per variant reads and preprocesses
+# every dataset once per variant. Here each batch of records is read and
+# preprocessed once, then classified by every variant's ensemble. The stages
+# run in a pipeline: reading (`io_threads` threads) and preprocessing (one
+# thread) work up to `depth` batches ahead of the networks (main thread).
+#
+# Every variant must use the same config directory (so the same
+# preprocessing). Results of each dataset go in one `PredictionStore` with a
+# block of columns per variant, named "<variant>:<SNOMED-CT code>";
+# `read_comparison` splits them again.
+#
+# ```
+# python -m src.compare config output --checkpoints checkpoints/original checkpoints/reweight_1 \
+#     --datasets data/pf12red/extracted_NSR data/norwegian-athlete-ecg/1.0.0
+# ```
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from src.data.records import iter_records
+from src.data.util import PredictionStore, read_predictions
+from src.run_12ECG_classifier import ensemble_outputs, load_12ECG_model, preprocess_batch
+from src import instrument
+
+
+# Variants
+# --------
+
+def parse_variant(spec: str) -> Tuple[str, Path]:
+    """"name=checkpoint_dir", or just "checkpoint_dir" (named after the directory)"""
+    if '=' in spec:
+        name, path = spec.split('=', 1)
+        return name, Path(path)
+    return Path(spec).name, Path(spec)
+
+def load_variants(variants: List[Tuple[str, Path]], config_dir: Path, backend: str=None) -> List[list]:
+    """`eval_list` of each (name, checkpoint directory)"""
+    names = [name for name, _ in variants]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Variant names must be unique: {names}")
+    return [load_12ECG_model(path, Path(config_dir), backend=backend) for _, path in variants]
+
+def variant_columns(names: List[str], classes: List[str]) -> List[str]:
+    """Column names of a comparison store: every class of each variant"""
+    return [f"{name}:{c}" for name in names for c in classes]
+
+def read_comparison(store_dir: Path, records: List[str]=None
+                    ) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], List[str], List[str]]:
+    """Results of a comparison store, split by variant.
+
+    Returns ({variant: (scores, labels)}, records, classes), where `scores`
+    and `labels` have shape (records, classes), as in `read_predictions`.
+    """
+    scores, labels, records, columns = read_predictions(store_dir, records)
+    variants = list(dict.fromkeys(column.rsplit(':', 1)[0] for column in columns))
+    classes = [column.rsplit(':', 1)[1] for column in columns[:len(columns) // len(variants)]]
+    results = {}
+    for i, name in enumerate(variants):
+        block = slice(i * len(classes), (i + 1) * len(classes))
+        results[name] = (scores[:, block], labels[:, block])
+    return results, records, classes
+
+
+# Pipeline
+# --------
+
+def compare_dataset(eval_lists: List[list], names: List[str], dataset_dir: Path, store_dir: Path,
+                    batch_size: int=32, io_threads: int=4, depth: int=2, micro_batch_size: int=None,
+                    overwrite: bool=False) -> int:
+    """Classify every record of `dataset_dir` with every variant, appending to
+    the comparison store at `store_dir`. Records already in the store are
+    skipped (unless `overwrite`). Returns the number of records classified.
+    """
+    from PhysioNet2020_driver import load_challenge_data, prefetch
+
+    classes = list(eval_lists[0][0].scored_classes)
+    for name, eval_list in zip(names, eval_lists):
+        if list(eval_list[0].scored_classes) != classes:
+            raise ValueError(f"Variant {name} has different classes")
+
+    with PredictionStore(store_dir, variant_columns(names, classes)) as store:
+        done = set() if overwrite else set(store.records)
+        records = [r for r in iter_records(dataset_dir) if Path(r.name).name not in done]
+        batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+        readers = ThreadPoolExecutor(io_threads)
+        loader, preprocessor = ThreadPoolExecutor(1), ThreadPoolExecutor(1)
+
+        def load(batch):
+            loaded = list(readers.map(lambda r: load_challenge_data(r.path), batch))
+            return [Path(r.name).name for r in batch], [d for d, _ in loaded], [h for _, h in loaded]
+
+        def preprocess(loaded):
+            record_names, data, headers = loaded
+            return record_names, preprocess_batch(data, headers, eval_lists[0])
+
+        count = 0
+        try:
+            loaded = prefetch(load, batches, loader, depth)
+            for record_names, batch in prefetch(preprocess, loaded, preprocessor, depth):
+                scores, labels = [], []
+                for eval_list in eval_lists:
+                    outputs = ensemble_outputs(batch, eval_list, micro_batch_size)
+                    with instrument.span("average", records=len(record_names), shape=tuple(outputs.shape)):
+                        variant_scores = outputs.mean(dim=0).cpu().numpy()
+                    scores.append(variant_scores)
+                    labels.append((variant_scores > eval_list[4]).astype(int))
+                with instrument.span("write", records=len(record_names)):
+                    store.append(record_names, np.concatenate(scores, axis=1), np.concatenate(labels, axis=1))
+                count += len(record_names)
+                print('    {}/{}...'.format(count, len(records)))
+        finally:
+            for executor in (preprocessor, loader, readers):
+                executor.shutdown(wait=True)
+    return count
+
+def compare(variants: List[Tuple[str, Path]], config_dir: Path, dataset_dirs: List[Path], output_dir: Path,
+            batch_size: int=32, io_threads: int=4, threads: int=None, micro_batch_size: int=None,
+            backend: str=None, overwrite: bool=False) -> Dict[Path, Path]:
+    """Classify every record of each dataset with every variant.
+
+    Each dataset gets a comparison store in `output_dir`, named after the
+    dataset directory and its parent (e.g. "pf12red_extracted_NSR").
+    Returns {dataset directory: store directory}.
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    print(f"Loading {len(variants)} ensembles...")
+    eval_lists = load_variants(variants, config_dir, backend)
+    names = [name for name, _ in variants]
+
+    stores = {}
+    for dataset_dir in dataset_dirs:
+        dataset_dir = Path(dataset_dir)
+        store_dir = Path(output_dir) / '_'.join(dataset_dir.resolve().parts[-2:])
+        print(f"Comparing on {dataset_dir} -> {store_dir}")
+        start = time.perf_counter()
+        count = compare_dataset(eval_lists, names, dataset_dir, store_dir, batch_size, io_threads,
+                                micro_batch_size=micro_batch_size, overwrite=overwrite)
+        seconds = time.perf_counter() - start
+        if count:
+            print(f"    {count} records x {len(names)} variants in {seconds:.1f} s ({count / seconds:.1f} records/s)")
+        stores[dataset_dir] = store_dir
+    return stores
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify datasets with several checkpoint variants, '
+                                                 'reading and preprocessing each record once.')
+    parser.add_argument('config_dir', type=Path, help='directory with data.json, model.json etc. (shared by every variant)')
+    parser.add_argument('output_dir', type=Path, help='one comparison store per dataset is written here')
+    parser.add_argument('--checkpoints', nargs='+', required=True,
+                        help='checkpoint directories, optionally named as name=directory')
+    parser.add_argument('--datasets', nargs='+', type=Path, required=True)
+    parser.add_argument('--batch-size', type=int, default=32, help='records classified together')
+    parser.add_argument('--io-threads', type=int, default=4, help='threads reading records from disk')
+    parser.add_argument('--threads', type=int, default=None, help='PyTorch threads')
+    parser.add_argument('--micro-batch-size', type=int, default=None,
+                        help='evaluate long recordings this many chunks at a time (bounded memory)')
+    parser.add_argument('--backend', default=None, help='inference backend of every variant (see src.backends)')
+    parser.add_argument('--overwrite', action='store_true', help='rerun records that are already in a store')
+    parser.add_argument('--instrument', action='store_true', help='print the time spent in each stage at the end')
+    args = parser.parse_args()
+
+    stats = instrument.enable(instrument.Aggregator())[0] if args.instrument else None
+    compare([parse_variant(spec) for spec in args.checkpoints], args.config_dir, args.datasets, args.output_dir,
+            args.batch_size, args.io_threads, args.threads, args.micro_batch_size, args.backend, args.overwrite)
+    if stats is not None:
+        instrument.disable()
+        stats.print_summary()
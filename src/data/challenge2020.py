@@ -2,11 +2,14 @@
 # - PhysioNet Challenge 2020 datasets
 
 from src.data.util import diagnosis_codes
+from src.data.header_index import read_header
 
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
-from typing import List, TypedDict
+from typing import Iterable, List, NamedTuple, Tuple, TypedDict
 
-import wfdb
+import numpy as np
 import pandas as pd
 
 def extract_snomed_ct_codes_from_comment(dx_comment: str) -> List[int]:
@@ -39,50 +42,75 @@ class DemographicInfo(TypedDict):
     age: int
     sex: str
 
-def generate_labels_table(records: List[Path]) -> pd.DataFrame:
+class LabelsMatrix(NamedTuple):
+    """Demographics and multi-hot labels for the records of a dataset"""
+    records: List[Path]
+    age: np.ndarray         # int16, -1 if unknown
+    sex: pd.Categorical
+    labels: np.ndarray      # uint8, shape (records, codes)
+    codes: List[int]        # SNOMED-CT code of each column in `labels`
+
+def _read_demographics_and_diagnoses(record) -> Tuple[int, str, List[int]]:
+    info = read_header(Path(record))
+    age = info['age'] if info['age'] is not None else -1
+    return age, info['sex'], info['dx']
+
+def generate_labels_matrix(records: List[Path], codes: Iterable[int]=diagnosis_codes,
+                           min_age: int=18, max_age: int=90, processes: int=None) -> LabelsMatrix:
+    """Demographics and multi-hot labels for every record in a PhysioNet
+    Challenge 2020 dataset.
+
+    Headers are parsed by a pool of `processes` (default: one per core), and
+    diagnoses are encoded into a (records, codes) uint8 matrix over the code
+    vocabulary `codes`. Records with a known age outside [min_age, max_age] 
+    are left out (e.g. 300 year old is a typo, kids).
+    """
+    records = list(records)
+    codes = [int(code) for code in codes]
+
+    if processes == 1 or len(records) < 1024:
+        parsed = list(map(_read_demographics_and_diagnoses, records))
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            parsed = list(executor.map(_read_demographics_and_diagnoses, records, chunksize=256))
+
+    age = np.array([p[0] for p in parsed], dtype=np.int16)
+    keep = (age == -1) | ((age >= min_age) & (age <= max_age))
+    keep_idx = np.flatnonzero(keep)
+
+    # Encode diagnoses: look up every code of every record in one go
+    diagnoses = [parsed[i][2] for i in keep_idx]
+    row = np.repeat(np.arange(len(keep_idx)), [len(d) for d in diagnoses])
+    flat = np.fromiter(chain.from_iterable(diagnoses), dtype=np.int64, count=len(row))
+    vocab = np.array(codes, dtype=np.int64)
+    order = np.argsort(vocab)
+    pos = np.searchsorted(vocab[order], flat).clip(max=max(len(vocab) - 1, 0))
+    hit = vocab[order][pos] == flat if len(vocab) else np.zeros(len(flat), dtype=bool)
+    labels = np.zeros((len(keep_idx), len(codes)), dtype=np.uint8)
+    labels[row[hit], order[pos[hit]]] = 1
+
+    return LabelsMatrix(
+        records=[records[i] for i in keep_idx],
+        age=age[keep],
+        sex=pd.Categorical([parsed[i][1] for i in keep_idx]),
+        labels=labels,
+        codes=codes,
+    )
+
+def generate_labels_table(records: List[Path], codes: Iterable[int]=diagnosis_codes, processes: int=None) -> pd.DataFrame:
     """Demographics and binary labels for every record in a PhysioNet Challenge 
     2020 dataset.
+
+    One row per record, with columns `age` (Int16), `sex` (category) and one 
+    boolean column per SNOMED-CT code (e.g. "426783006"). See 
+    `generate_labels_matrix`.
     """
-    data = []
-    for record in records:
-        header = wfdb.rdheader(record)
-
-        # Extract demographic info
-        age_str = header.comments[0].split(': ')[1]
-        age = int( age_str ) if age_str.isnumeric() else None
-        sex = header.comments[1].split(': ')[1]
-        demographics: DemographicInfo = {
-            'age': age,
-            'sex': sex,
-        }
-
-        # Filter out some records by age (e.g. 300 year old is a typo, kids)
-        if not age == None:
-            if (age > 90) or (age < 18):
-                continue
-        
-        # Extract ECG diagnostic info (labels)
-        diagnoses = extract_snomed_ct_codes_from_comment( header.comments[2] )
-        relevant_findings = {
-            # Sinus rhythm
-            "426177001":  False,  # "Sinus bradycardia",
-            "426783006":  False,  # "Normal sinus rhythm",
-            "427084000":  False,  # "Sinus tachycardia",
-            "427393009":  False,  # "Sinus arrhythmia",
-
-            # Conduction pathway (specifically right bundle branch)
-            "713427006":  False,  # "Complete right bundle branch block",
-            "713426002":  False,  # "Incomplete right bundle branch block",
-
-            # T-wave (TODO: should be for each lead)
-            "164934002":  False,  # "T-wave abnormal",
-            "59931005":   False,  # "T-wave inversion",
-        }
-        for code in diagnoses:
-            if code in diagnosis_codes:
-                relevant_findings[f"{code}"] = True
-        
-        # Save data
-        data.append( {**demographics, **relevant_findings} )
-
-    return pd.DataFrame(data)
\ No newline at end of file
+    matrix = generate_labels_matrix(records, codes, processes=processes)
+    demographics = pd.DataFrame({
+        'age': pd.array(np.where(matrix.age == -1, None, matrix.age), dtype='Int16'),
+        'sex': matrix.sex,
+    })
+    relevant_findings = pd.DataFrame(
+        matrix.labels.astype(bool), columns=[f"{code}" for code in matrix.codes]
+    )
+    return pd.concat([demographics, relevant_findings], axis=1)
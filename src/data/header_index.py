@@ -0,0 +1,242 @@
+# Header-only metadata index for PhysioNet-style (WFDB) datasets
+#
+# Labels and demographics live in the comments of each `.hea` file, so
+# scanning them never needs the signal files. The index is a SQLite database
+# that is refreshed incrementally (only headers whose mtime/size changed).
+
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, TypedDict
+
+import pandas as pd
+
+
+# Parsing `.hea` files
+# --------------------
+
+class HeaderInfo(TypedDict):
+    fs: float
+    num_samples: Optional[int]
+    leads: List[str]
+    age: Optional[int]
+    sex: Optional[str]
+    dx: List[int]
+    report: Optional[str]
+    machine_report: Optional[str]
+    comments: List[str]
+
+def _parse_age(value: str) -> Optional[int]:
+    try:
+        return int(float(value))
+    except (ValueError, OverflowError):
+        return None     # e.g. "NaN", "inf" or "Unknown"
+
+def parse_header(text: str) -> HeaderInfo:
+    """Parse the text of a WFDB `.hea` file (single segment records).
+
+    A lot faster than `wfdb.rdheader`, and understands the comment formats of
+    the datasets used in this project:
+    - PhysioNet Challenge 2020: "Age: 53", "Sex: Male", "Dx: code1,code2"
+    - PF12RED (converted): "age: 25", "gender: Male", "Dx: code1,code2"
+    - norwegian-athlete-ecg: machine (SL12) report, then cardiologist report
+    """
+    lines = text.splitlines()
+    comments = [line[1:].strip() for line in lines if line.startswith('#')]
+    fields = [line.split() for line in lines if line.strip() and not line.startswith('#')]
+
+    # Record line: name n_sig fs[/counter][(base)] n_samples ...
+    record_line = fields[0]
+    num_leads = int(record_line[1])
+    fs = 250.0
+    if len(record_line) > 2:
+        fs = float(record_line[2].split('/')[0].split('(')[0])
+    num_samples = int(record_line[3]) if len(record_line) > 3 else None
+
+    # Signal lines: the description (lead name) is the 9th field
+    leads = [' '.join(f[8:]) if len(f) > 8 else '' for f in fields[1:1 + num_leads]]
+
+    info: HeaderInfo = {
+        'fs': fs,
+        'num_samples': num_samples,
+        'leads': leads,
+        'age': None,
+        'sex': None,
+        'dx': [],
+        'report': None,
+        'machine_report': None,
+        'comments': comments,
+    }
+    has_dx = False
+    for comment in comments:
+        key, _, value = comment.partition(':')
+        key, value = key.strip().lower(), value.strip()
+        if key == 'age':
+            info['age'] = _parse_age(value)
+        elif key in ('sex', 'gender'):
+            info['sex'] = value or None
+        elif key == 'dx':
+            has_dx = True
+            info['dx'] = [int(code) for code in value.split(',') if code.strip()]
+
+    # Norwegian athlete dataset: single line reports instead of labels
+    if not has_dx and len(comments) >= 2:
+        info['machine_report'] = comments[0]
+        info['report'] = comments[1]
+
+    return info
+
+def read_header(path: Path) -> HeaderInfo:
+    """Parse a record's `.hea` file (`path` with or without the suffix)"""
+    with open(Path(path).with_suffix('.hea'), 'r') as f:
+        return parse_header(f.read())
+
+
+# Finding headers
+# ---------------
+
+def scan_headers(dataset_dir: Path) -> Iterator[Tuple[str, os.stat_result]]:
+    """Yields (record name, stat) for every `.hea` file below `dataset_dir`.
+
+    Record names are relative to `dataset_dir`, without the suffix (e.g.
+    "g1/E00001"). Any depth of nesting is searched.
+    """
+    stack = [(Path(dataset_dir), '')]
+    while stack:
+        directory, prefix = stack.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append((Path(entry.path), prefix + entry.name + '/'))
+                elif entry.name.endswith('.hea'):
+                    yield prefix + entry.name[:-4], entry.stat()
+
+
+# Index
+# -----
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    dataset TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    fs REAL,
+    num_samples INTEGER,
+    leads TEXT,
+    age INTEGER,
+    sex TEXT,
+    report TEXT,
+    machine_report TEXT,
+    comments TEXT,
+    PRIMARY KEY (dataset, name)
+);
+CREATE TABLE IF NOT EXISTS dx (
+    dataset TEXT NOT NULL,
+    name TEXT NOT NULL,
+    code INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dx_record ON dx (dataset, name);
+CREATE INDEX IF NOT EXISTS dx_code ON dx (code);
+"""
+
+class HeaderIndex():
+    """Persistent index of header metadata (SQLite).
+
+    ```python
+    index = HeaderIndex(data_dir / "headers.sqlite")
+    index.refresh(ptbxl_dir)            # Only re-reads changed headers
+    df = index.table(ptbxl_dir)         # age, sex, dx, report, fs, ...
+    ```
+    """
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db = sqlite3.connect(self.db_path)
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _key(dataset_dir: Path) -> str:
+        return str(Path(dataset_dir).resolve())
+
+    def refresh(self, dataset_dir: Path, io_threads: int=8) -> Tuple[int, int]:
+        """Bring the index up to date with the headers in `dataset_dir`.
+
+        Returns the number of (updated, removed) records.
+        """
+        dataset = self._key(dataset_dir)
+        known = {
+            name: (mtime_ns, size) for name, mtime_ns, size in
+            self.db.execute("SELECT name, mtime_ns, size FROM records WHERE dataset = ?", (dataset,))
+        }
+
+        found, changed = set(), []
+        for name, stat in scan_headers(dataset_dir):
+            found.add(name)
+            if known.get(name) != (stat.st_mtime_ns, stat.st_size):
+                changed.append((name, stat))
+        removed = [name for name in known if name not in found]
+
+        def read(item):
+            name, stat = item
+            return name, stat, read_header(Path(dataset) / name)
+
+        with self.db, ThreadPoolExecutor(io_threads) as executor:
+            for name in removed:
+                self._delete(dataset, name)
+            for name, stat, info in executor.map(read, changed):
+                self._delete(dataset, name)
+                self.db.execute(
+                    "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (dataset, name, stat.st_mtime_ns, stat.st_size, info['fs'], info['num_samples'],
+                     ','.join(info['leads']), info['age'], info['sex'], info['report'],
+                     info['machine_report'], json.dumps(info['comments']))
+                )
+                self.db.executemany(
+                    "INSERT INTO dx VALUES (?, ?, ?)", [(dataset, name, code) for code in info['dx']]
+                )
+
+        return len(changed), len(removed)
+
+    def _delete(self, dataset: str, name: str):
+        self.db.execute("DELETE FROM records WHERE dataset = ? AND name = ?", (dataset, name))
+        self.db.execute("DELETE FROM dx WHERE dataset = ? AND name = ?", (dataset, name))
+
+    def datasets(self) -> List[str]:
+        return [row[0] for row in self.db.execute("SELECT DISTINCT dataset FROM records ORDER BY dataset")]
+
+    def dx_codes(self, dataset_dir: Path) -> Dict[str, List[int]]:
+        """SNOMED-CT codes of every record, by record name"""
+        codes = {name: [] for name in self.names(dataset_dir)}
+        query = "SELECT name, code FROM dx WHERE dataset = ?"
+        for name, code in self.db.execute(query, (self._key(dataset_dir),)):
+            codes[name].append(code)
+        return codes
+
+    def names(self, dataset_dir: Path) -> List[str]:
+        query = "SELECT name FROM records WHERE dataset = ? ORDER BY name"
+        return [row[0] for row in self.db.execute(query, (self._key(dataset_dir),))]
+
+    def table(self, dataset_dir: Path) -> pd.DataFrame:
+        """Metadata of every record in a dataset, one row per record (sorted by name)"""
+        df = pd.read_sql_query(
+            "SELECT name, fs, num_samples, leads, age, sex, report, machine_report "
+            "FROM records WHERE dataset = ? ORDER BY name",
+            self.db, params=(self._key(dataset_dir),)
+        )
+        codes = self.dx_codes(dataset_dir)
+        df['dx'] = [codes[name] for name in df.name]
+        df['age'] = df.age.astype('Int16')
+        df['sex'] = df.sex.astype('category')
+        df['leads'] = df.leads.str.split(',')
+        return df
@@ -0,0 +1,241 @@
+# Classification metrics over whole result sets
+#
+# Everything works on (records, classes) matrices of labels and scores (e.g.
+# from `read_predictions` and `generate_labels_matrix`), without looping
+# over records. Threshold sweeps sort the scores once per class, then count
+# true/false positives for every threshold with `searchsorted`.
+
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+NORMAL_CLASS = "426783006"  # Normal sinus rhythm (the "inactive" output of the challenge score)
+
+# Codes that are scored as the same class (e.g. "713427006|59118001" in weights.csv)
+EQUIVALENT_CLASSES = {
+    "59118001": "713427006",    # Right bundle branch block -> Complete RBBB
+    "63593006": "284470004",    # Supraventricular premature beats -> Premature atrial contraction
+    "17338001": "427172004",    # Ventricular premature beats -> Premature ventricular contractions
+}
+
+
+# Confusion counts
+# ----------------
+
+class ConfusionCounts(NamedTuple):
+    """Per-class counts, each with shape (..., classes)"""
+    tp: np.ndarray
+    fp: np.ndarray
+    fn: np.ndarray
+    tn: np.ndarray
+
+    def micro(self) -> "ConfusionCounts":
+        """Counts summed over classes, shape (...)"""
+        return ConfusionCounts(*(c.sum(axis=-1) for c in self))
+
+    def ravel(self) -> Tuple[np.ndarray, ...]:
+        """(tn, fp, fn, tp) like `sklearn.metrics.confusion_matrix(...).ravel()`"""
+        return self.tn, self.fp, self.fn, self.tp
+
+def confusion_counts(labels: np.ndarray, outputs: np.ndarray) -> ConfusionCounts:
+    """Counts for (records, classes) binary label and output matrices"""
+    labels = np.asarray(labels, dtype=bool)
+    outputs = np.asarray(outputs, dtype=bool)
+    tp = np.count_nonzero(labels & outputs, axis=0)
+    fp = np.count_nonzero(~labels & outputs, axis=0)
+    fn = np.count_nonzero(labels & ~outputs, axis=0)
+    tn = len(labels) - tp - fp - fn
+    return ConfusionCounts(tp, fp, fn, tn)
+
+def threshold_confusion_counts(labels: np.ndarray, scores: np.ndarray, thresholds: np.ndarray) -> ConfusionCounts:
+    """Counts for `scores > threshold`, for many thresholds at once.
+
+    `thresholds` has shape (T,) (same for every class) or (T, classes).
+    Returns counts with shape (T, classes).
+    """
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores)
+    num_records, num_classes = scores.shape
+    thresholds = np.broadcast_to(
+        np.asarray(thresholds, dtype=scores.dtype).reshape(len(thresholds), -1),
+        (len(thresholds), num_classes),
+    )
+
+    # Sort each class by score, with the number of positives at or below
+    # each position. Then `scores > t` are the records after `searchsorted`.
+    # (Class-major copies, so each class is contiguous.)
+    scores_t = np.ascontiguousarray(scores.T)
+    order = np.argsort(scores_t, axis=1)
+    sorted_scores = np.take_along_axis(scores_t, order, axis=1)
+    positives_below = np.zeros((num_classes, num_records + 1), dtype=np.int64)
+    np.cumsum(np.take_along_axis(np.ascontiguousarray(labels.T), order, axis=1), axis=1, out=positives_below[:, 1:])
+    total_positives = positives_below[:, -1]
+
+    tp = np.empty(thresholds.shape, dtype=np.int64)
+    predicted = np.empty(thresholds.shape, dtype=np.int64)
+    for c in range(num_classes):
+        below = np.searchsorted(sorted_scores[c], thresholds[:, c], side='right')
+        predicted[:, c] = num_records - below
+        tp[:, c] = total_positives[c] - positives_below[c, below]
+
+    fp = predicted - tp
+    fn = total_positives - tp
+    tn = num_records - tp - fp - fn
+    return ConfusionCounts(tp, fp, fn, tn)
+
+
+# Metrics from counts
+# -------------------
+
+def _divide(numerator, denominator) -> np.ndarray:
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), np.nan)
+
+def _average(counts: ConfusionCounts, metric, average: str):
+    if average is None:
+        return metric(counts)
+    if average == 'micro':
+        return metric(counts.micro())
+    if average == 'macro':
+        return np.nanmean(metric(counts), axis=-1)
+    raise ValueError(f"Unknown average: {average}")
+
+def f1_score(counts: ConfusionCounts, average: str=None) -> np.ndarray:
+    """Per-class F1 (NaN without any positives), or "micro"/"macro" averaged"""
+    return _average(counts, lambda c: _divide(2 * c.tp, 2 * c.tp + c.fp + c.fn), average)
+
+def false_positive_rate(counts: ConfusionCounts, average: str=None) -> np.ndarray:
+    return _average(counts, lambda c: _divide(c.fp, c.fp + c.tn), average)
+
+def false_negative_rate(counts: ConfusionCounts, average: str=None) -> np.ndarray:
+    return _average(counts, lambda c: _divide(c.fn, c.fn + c.tp), average)
+
+def precision(counts: ConfusionCounts, average: str=None) -> np.ndarray:
+    return _average(counts, lambda c: _divide(c.tp, c.tp + c.fp), average)
+
+def accuracy(counts: ConfusionCounts, average: str=None) -> np.ndarray:
+    return _average(counts, lambda c: _divide(c.tp + c.tn, c.tp + c.fp + c.fn + c.tn), average)
+
+
+# PhysioNet/CinC Challenge 2020 score
+# -----------------------------------
+
+def load_weights(weights_file: Path, classes: List[str]=None) -> Tuple[List[str], np.ndarray]:
+    """Read the challenge's `weights.csv` (reward for each (label, output) pair).
+
+    Classes that are scored as equivalent are written as "code1|code2"; the
+    first code is used. If `classes` is given (e.g. `data_cfg.scored_classes`)
+    the matrix is reordered to match.
+    """
+    with open(weights_file, 'r') as f:
+        rows = [line.strip().split(',') for line in f if line.strip()]
+    weight_classes = [c.split('|')[0].strip() for c in rows[0][1:]]
+    weights = np.array([[float(w) for w in row[1:]] for row in rows[1:]], dtype=np.float64)
+
+    if classes is None:
+        return weight_classes, weights
+    order = [weight_classes.index(str(c)) for c in classes]
+    return list(classes), weights[np.ix_(order, order)]
+
+def modified_confusion_matrix(labels: np.ndarray, outputs: np.ndarray) -> np.ndarray:
+    """(classes, classes) matrix A of the challenge score.
+
+    A[j, k] counts records with label j and output k, each record divided by
+    the number of classes in the union of its labels and outputs.
+    """
+    labels = np.asarray(labels, dtype=np.float64)
+    outputs = np.asarray(outputs, dtype=np.float64)
+    normalization = np.maximum(np.maximum(labels, outputs).sum(axis=-1), 1)
+    return (labels / normalization[:, None]).T @ outputs
+
+def _reward(labels: np.ndarray, label_weights: np.ndarray, outputs: np.ndarray) -> np.ndarray:
+    # sum(weights * A) without building A: each record contributes
+    # (labels @ weights) . outputs, divided by its normalization
+    labels_per_record = labels.sum(axis=-1, dtype=np.int32)
+    outputs_per_record = outputs.sum(axis=-1, dtype=np.int32)
+    both = (labels & outputs).sum(axis=-1, dtype=np.int32)
+    normalization = np.maximum(labels_per_record + outputs_per_record - both, 1)
+    rewards = np.einsum('...nc,nc->...n', outputs.astype(label_weights.dtype), label_weights)
+    return np.sum(rewards / normalization, axis=-1)
+
+def challenge_score(labels: np.ndarray, outputs: np.ndarray, weights: np.ndarray, classes: List[str],
+                    normal_class: str=NORMAL_CLASS) -> float:
+    """Normalized challenge score (1 for perfect outputs, 0 for always normal)
+
+    `outputs` may have leading batch dimensions, e.g. (thresholds, records,
+    classes), in which case an array of scores is returned.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    outputs = np.asarray(outputs, dtype=bool)
+    label_weights = labels @ np.asarray(weights, dtype=np.float64)
+
+    inactive_outputs = np.zeros(labels.shape, dtype=bool)
+    inactive_outputs[:, list(map(str, classes)).index(str(normal_class))] = True
+
+    observed = _reward(labels, label_weights, outputs)
+    correct = _reward(labels, label_weights, labels)
+    inactive = _reward(labels, label_weights, inactive_outputs)
+
+    if correct == inactive:
+        return np.zeros(observed.shape) if np.ndim(observed) else 0.0
+    return (observed - inactive) / (correct - inactive)
+
+def _reward_curve(labels: np.ndarray, label_weights: np.ndarray, scores: np.ndarray):
+    # Reward of `scores > t` for any scalar t. Within each record, outputs
+    # switch on in order of decreasing score, so its reward only depends on
+    # how many are on. Spread each record's reward over its scores as
+    # increments, then reward(t) = sum of the increments of scores > t.
+    num_records, num_classes = scores.shape
+    order = np.argsort(-scores, axis=1)
+    gains = np.cumsum(np.take_along_axis(label_weights, order, axis=1), axis=1)
+    hits = np.cumsum(np.take_along_axis(labels, order, axis=1), axis=1)
+    on = np.arange(1, num_classes + 1)
+    normalization = np.maximum(labels.sum(axis=1, keepdims=True) + on - hits, 1)
+    reward = gains / normalization
+    increments = np.diff(reward, axis=1, prepend=0)
+
+    values = np.take_along_axis(scores, order, axis=1).ravel()
+    increments = increments.ravel()
+    by_value = np.argsort(values)
+    values = values[by_value]
+    cumulative = np.concatenate([[0], np.cumsum(increments[by_value])])
+
+    def reward_at(thresholds):
+        below = np.searchsorted(values, thresholds, side='right')
+        return cumulative[-1] - cumulative[below]
+    return reward_at
+
+def challenge_score_sweep(labels: np.ndarray, scores: np.ndarray, thresholds: np.ndarray, weights: np.ndarray,
+                          classes: List[str], normal_class: str=NORMAL_CLASS, chunk_size: int=16) -> np.ndarray:
+    """Challenge score of `scores > threshold`, for every row of `thresholds`.
+
+    `thresholds` has shape (T,) (same for every class) or (T, classes). 
+    Returns an array of shape (T,).
+
+    With one threshold for every class, the scores are sorted once and any
+    number of thresholds is evaluated with `searchsorted`. Per-class 
+    thresholds are evaluated `chunk_size` rows at a time.
+    """
+    scores = np.asarray(scores)
+    thresholds = np.asarray(thresholds, dtype=scores.dtype)
+    if thresholds.ndim == 2:
+        results = []
+        for start in range(0, len(thresholds), chunk_size):
+            outputs = scores[None] > thresholds[start:start + chunk_size, None]
+            results.append(challenge_score(labels, outputs, weights, classes, normal_class))
+        return np.concatenate(results)
+
+    labels = np.asarray(labels, dtype=bool)
+    label_weights = labels @ np.asarray(weights, dtype=np.float64)
+    inactive_outputs = np.zeros(labels.shape, dtype=bool)
+    inactive_outputs[:, list(map(str, classes)).index(str(normal_class))] = True
+    correct = _reward(labels, label_weights, labels)
+    inactive = _reward(labels, label_weights, inactive_outputs)
+    if correct == inactive:
+        return np.zeros(len(thresholds))
+
+    observed = _reward_curve(labels, label_weights, scores)(thresholds)
+    return (observed - inactive) / (correct - inactive)
@@ -1,12 +1,19 @@
 # Utility functions for extracting labels from:
 # - Norwegian endurance athlete dataset (Single line cardiologist report)
 
-from typing import List
+import re
+from typing import Iterable, List, NamedTuple, Optional, Tuple
 from enum import Enum
 
+import numpy as np
+
 # Parsing single-line cardiologist reports
 # ----------------------------------------
 
+# Whole words only, so e.g. "standard" isn't split
+_AND = re.compile(r'\band\b')
+_COMMENT_SEPARATOR = re.compile(r', |\band\b')
+
 def extract_findings(report: str, follow_on: bool=True, split_and=True) -> List[str]:
     """Extract a list of all findings in a single line cardiologist report
     """
@@ -17,12 +24,12 @@ def extract_findings(report: str, follow_on: bool=True, split_and=True) -> List[
     if split_and:
         temp = []
         for comment in comments:
-            for segment in comment.split('and'):
+            for segment in _AND.split(comment):
                 temp.append(segment)
         comments = temp
 
-    # Cleanup (e.g. remove leading/trailing whitespace)
-    comments[:] = list(map(str.strip, comments))
+    # Cleanup (e.g. remove leading/trailing whitespace, empty comments)
+    comments[:] = [c for c in map(str.strip, comments) if c]
 
     if not follow_on:
         return comments     # i.e. assume every comment is a new finding
@@ -33,7 +40,7 @@ def extract_findings(report: str, follow_on: bool=True, split_and=True) -> List[
     # e.g. ST elevation, consider early repolarization, pericarditis, or injury
     findings = []
     for i, comment in enumerate(comments):
-        if comment[0].isupper() or comment[0] == '*':
+        if not findings or comment[0].isupper() or comment[0] == '*':
             findings.append(comment)
         else:
             findings[-1] = ''.join([findings[-1], ", ", comment])
@@ -96,3 +103,128 @@ def classifyOverallFinding(findings: List[str]) -> OverallFinding:
         return OverallFinding.Normal
     else:
         return OverallFinding.Unknown
+
+
+# Batch labelling
+# ---------------
+
+class FindingRule(NamedTuple):
+    """A SNOMED-CT code is assigned to a finding (one comment in a report) if
+    it contains every string in `all` and none of the strings in `none`
+    (case insensitive).
+    """
+    code: int
+    all: Tuple[str, ...]
+    none: Tuple[str, ...] = ()
+
+# Same labels as `classify_relevant_findings`
+RELEVANT_FINDING_RULES = [
+    # Sinus rhythm
+    FindingRule(427393009, ("sinus", "arrhythmia")),
+    FindingRule(426177001, ("sinus", "bradycardia")),
+    FindingRule(427084000, ("sinus", "tachycardia")),
+    FindingRule(426783006, ("sinus", "normal"), ("abnormal",)),
+
+    # Right bundle branch block
+    FindingRule(713426002, ("right bundle branch block", "incomplete")),
+    FindingRule(713427006, ("right bundle branch block", "complete"), ("incomplete",)),
+]
+
+# e.g. classify_reports(reports, RELEVANT_FINDING_RULES + T_WAVE_RULES)
+T_WAVE_RULES = [
+    FindingRule(164934002, ("t-wave", "abnormal")),
+    FindingRule(164934002, ("t wave", "abnormal")),
+    FindingRule(59931005, ("t-wave", "inver")),
+    FindingRule(59931005, ("t wave", "inver")),
+    FindingRule(59931005, ("inverted t",)),
+]
+
+_OVERALL_PATTERNS = [
+    (OverallFinding.Abnormal, "abnormal"),
+    (OverallFinding.Borderline, "borderline"),
+    (OverallFinding.Normal, "normal"),
+]
+
+def classify_reports(reports: Iterable[Optional[str]], rules: List[FindingRule]=RELEVANT_FINDING_RULES,
+                     follow_on: bool=True) -> Tuple[np.ndarray, List[int], np.ndarray]:
+    """Label many single line reports at once.
+
+    Equivalent to `classify_relevant_findings(extract_findings(report))` and
+    `classifyOverallFinding(...)` for every report, but the search terms of
+    every rule are compiled into one regex, which scans the comments of all
+    reports in a single pass. The alternation sits in a lookahead, so
+    overlapping terms (e.g. "normal" in "abnormal") are all found. Reports can come straight from 
+    `HeaderIndex.table()` (`report` or `machine_report` columns), so no 
+    signals need to be read. Missing reports (`None`) get no labels and an 
+    `Unknown` overall finding.
+
+    Returns:
+    - (reports, codes) uint8 multi-hot label matrix
+    - codes, the SNOMED-CT code of each column (in order of first rule)
+    - (reports,) int8 array of `OverallFinding` values
+    """
+    reports = list(reports)
+    codes = list(dict.fromkeys(rule.code for rule in rules))
+    column = {code: i for i, code in enumerate(codes)}
+    labels = np.zeros((len(reports), len(codes)), dtype=np.uint8)
+    overall = np.full(len(reports), OverallFinding.Unknown.value, dtype=np.int8)
+
+    # Split every report into comments (same as `extract_findings`)
+    comments, owner, starts = [], [], []
+    for i, report in enumerate(reports):
+        if not report or ': ' not in report:
+            continue
+        first = True
+        for comment in _COMMENT_SEPARATOR.split(report.split(': ', maxsplit=1)[1]):
+            comment = comment.strip()
+            if not comment:
+                continue
+            # Follow-on comments (lower case) continue the previous finding
+            starts.append(first or not follow_on or comment[0].isupper() or comment[0] == '*')
+            comments.append(comment.lower())
+            owner.append(i)
+            first = False
+    if not comments:
+        return labels, codes, overall
+    owner = np.array(owner, dtype=np.int64)
+    starts = np.flatnonzero(starts)
+    finding_owner = owner[starts]
+
+    # Which comments contain each term
+    terms = list(dict.fromkeys(
+        [s for rule in rules for s in rule.all + rule.none] + [s for _, s in _OVERALL_PATTERNS]
+    ))
+    term_index = {term: i for i, term in enumerate(terms)}
+    text = '\n'.join(comments)
+    offsets = np.cumsum([0] + [len(c) + 1 for c in comments[:-1]])
+    present = np.zeros((len(terms), len(comments)), dtype=bool)
+    # Longest terms first: terms matching at the same position are prefixes of the longest one
+    pattern = re.compile('(?=(' + '|'.join(re.escape(t) for t in sorted(terms, key=len, reverse=True)) + '))')
+    prefixes = {t: [term_index[s] for s in terms if t.startswith(s)] for t in terms}
+    rows, positions = [], []
+    for m in pattern.finditer(text):
+        found = prefixes[m.group(1)]
+        rows.extend(found)
+        positions.extend([m.start()] * len(found))
+    present[rows, np.searchsorted(offsets, positions, side='right') - 1] = True
+
+    # Does any comment of each finding contain the term?
+    present = np.logical_or.reduceat(present, starts, axis=1)
+
+    for rule in rules:
+        matched = np.ones(len(starts), dtype=bool)
+        for s in rule.all:
+            matched &= present[term_index[s]]
+        for s in rule.none:
+            matched &= ~present[term_index[s]]
+        labels[finding_owner[matched], column[rule.code]] = 1
+
+    # The final finding of each report comments on the whole recording
+    last = np.flatnonzero(np.append(finding_owner[1:] != finding_owner[:-1], True))
+    overall[finding_owner[last]] = np.select(
+        [present[term_index[s], last] for _, s in _OVERALL_PATTERNS],
+        [finding.value for finding, _ in _OVERALL_PATTERNS],
+        OverallFinding.Unknown.value,
+    )
+
+    return labels, codes, overall
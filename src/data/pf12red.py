@@ -0,0 +1,287 @@
+# Conversion of the PF12RED dataset (professional footballers) to WFDB
+#
+# PF12RED recordings are GE CardiologyXML files, with diagnoses in a separate
+# `labels.csv`. Each XML file is streamed with `iterparse` (the waveforms are
+# decoded straight into NumPy arrays), files are converted by a process pool,
+# and only files that changed since the last conversion are converted again.
+# Records can be written as WFDB files (like pf12red-dataset.ipynb) or into a
+# signal cache (see `src.data.signal_cache`).
+
+import argparse
+import configparser
+import json
+import os
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import wfdb
+
+from src.data.signal_cache import SignalCache, SignalCacheWriter
+
+LEADS = ['I', 'II', 'III', 'aVR', 'aVL', 'aVF', 'V1', 'V2', 'V3', 'V4', 'V5', 'V6']
+
+# Columns of labels.csv that are marked with "X"
+LABEL_CODES = {
+    'SR': 426783006,    # Normal sinus rhythm (TODO: What does SR label mean?)
+    'SB': 426177001,    # Sinus bradycardia
+    'iRBBB': 713426002, # Incomplete right bundle branch block
+}
+
+MANIFEST_FILE = "conversion.json"
+
+
+# Reading XML files
+# -----------------
+
+class CardiologyRecord(NamedTuple):
+    signal: np.ndarray      # (leads, samples) float32, mV
+    fs: float
+    resolution: float       # uV per LSB
+    age: Optional[str]
+    gender: Optional[str]
+
+def read_cardiology_xml(path: Path) -> CardiologyRecord:
+    """Rhythm strip and demographics of a GE CardiologyXML file.
+
+    The file is parsed incrementally; each lead's `WaveformData` is decoded
+    into an array as soon as it is read, then freed.
+    """
+    fs, resolution = 500.0, 5.0     # Hz, uV per LSB (defaults if not in the file)
+    age = gender = None
+    waveforms = {}
+    path_stack = []
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            path_stack.append(elem.tag)
+            continue
+        parent = path_stack[-2] if len(path_stack) > 1 else None
+        if parent == 'PatientInfo':
+            if elem.tag == 'Age':
+                age = (elem.text or '').strip() or None
+            elif elem.tag == 'Gender':
+                gender = (elem.text or '').strip() or None
+        elif parent == 'StripData':
+            if elem.tag == 'SampleRate':
+                fs = float(elem.text)
+            elif elem.tag == 'Resolution':
+                resolution = float(elem.text)
+            elif elem.tag == 'WaveformData':
+                lead = elem.get('lead') or LEADS[len(waveforms)]
+                waveforms[lead] = np.fromstring(elem.text, dtype=np.int32, sep=',')
+        path_stack.pop()
+        if parent != 'PatientInfo':
+            elem.clear()
+
+    length = min(len(waveforms[lead]) for lead in LEADS)
+    signal = np.stack([waveforms[lead][:length] for lead in LEADS]).astype(np.float32)
+    signal *= resolution / 1000     # uV -> mV
+    return CardiologyRecord(signal, fs, resolution, age, gender)
+
+def athlete_id(path: Path) -> int:
+    """e.g. "2_1819Pst.XML" -> 2"""
+    return int(Path(path).stem.split('_')[0])
+
+def read_labels(labels_file: Path) -> Dict[int, List[int]]:
+    """SNOMED-CT codes of each athlete in labels.csv"""
+    labels_df = pd.read_csv(labels_file)
+    codes = {}
+    for _, row in labels_df.iterrows():
+        codes[int(row.AthleteID)] = [
+            code for column, code in LABEL_CODES.items() if str(row.get(column, '')).strip() == 'X'
+        ]
+    return codes
+
+def _comments(record: CardiologyRecord, codes: List[int]) -> List[str]:
+    return [f"age: {record.age}", f"gender: {record.gender}", "Dx: " + ",".join(map(str, codes))]
+
+
+# Conversion
+# ----------
+
+def _source_key(path: Path, codes: List[int]) -> list:
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size, codes]
+
+def _load_manifest(path: Path) -> dict:
+    if path.exists():
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def _save_manifest(path: Path, manifest: dict):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def _find_sources(xml_dir: Path, labels: Dict[int, List[int]]) -> Dict[str, Tuple[Path, list]]:
+    sources = {}
+    for file in sorted(Path(xml_dir).iterdir()):
+        if file.suffix.upper() != '.XML':
+            continue
+        sources[file.stem] = (file, _source_key(file, labels.get(athlete_id(file), [])))
+    return sources
+
+def _write_record(args) -> Tuple[str, Optional[str]]:
+    file, output_dir, codes = args
+    try:
+        record = read_cardiology_xml(file)
+        # Same gain as the XML file, so samples are stored exactly
+        wfdb.wrsamp(
+            file.stem,
+            fs=record.fs,
+            units=['mV'] * len(LEADS),
+            sig_name=LEADS,
+            p_signal=record.signal.T.astype(np.float64),
+            fmt=['16'] * len(LEADS),
+            adc_gain=[1000 / record.resolution] * len(LEADS),
+            baseline=[0] * len(LEADS),
+            comments=_comments(record, codes),
+            write_dir=str(output_dir),
+        )
+        return file.stem, None
+    except Exception as e:
+        for suffix in ('.hea', '.dat'):
+            (Path(output_dir) / file.stem).with_suffix(suffix).unlink(missing_ok=True)
+        return file.stem, str(e)
+
+def convert_to_wfdb(xml_dir: Path, labels_file: Path, output_dir: Path, processes: int=None,
+                    force: bool=False) -> Tuple[List[str], List[str]]:
+    """Convert every XML file in `xml_dir` to a WFDB record in `output_dir`.
+
+    Only files that are new, modified or whose labels changed since the last
+    conversion are converted (unless `force`), and records whose XML file
+    was removed are deleted. Returns the names of (converted, removed)
+    records.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir / MANIFEST_FILE
+    manifest = {} if force else _load_manifest(manifest_path)
+    labels = read_labels(labels_file)
+    sources = _find_sources(xml_dir, labels)
+
+    removed = [name for name in manifest if name not in sources]
+    for name in removed:
+        for suffix in ('.hea', '.dat'):
+            (output_dir / name).with_suffix(suffix).unlink(missing_ok=True)
+        del manifest[name]
+
+    changed = [
+        (file, output_dir, key[2]) for name, (file, key) in sources.items()
+        if manifest.get(name) != key or not (output_dir / name).with_suffix('.hea').exists()
+    ]
+    converted = []
+    with ProcessPoolExecutor(processes) as executor:
+        for name, error in executor.map(_write_record, changed):
+            if error is not None:
+                print(f"WARNING: Couldn't convert {name} ({error})")
+                manifest.pop(name, None)
+                continue
+            converted.append(name)
+            manifest[name] = sources[name][1]
+    _save_manifest(manifest_path, manifest)
+    return converted, removed
+
+def _header_text(name: str, record: CardiologyRecord, comments: List[str]) -> str:
+    # The `.hea` file `convert_to_wfdb` would write for this record
+    num_leads, num_samples = record.signal.shape
+    gain = 1000 / record.resolution
+    lines = [f"{name} {num_leads} {record.fs:g} {num_samples}"]
+    digital = np.round(record.signal * gain).astype(np.int64)
+    for lead, samples in zip(LEADS, digital):
+        checksum = int(np.sum(samples) % 65536)
+        lines.append(f"{name}.dat 16 {float(gain)}(0)/mV 16 0 {samples[0] if num_samples else 0} {checksum} 0 {lead}")
+    lines += ["# " + comment for comment in comments]
+    return "\n".join(lines) + "\n"
+
+def _read_for_cache(args):
+    file, codes = args
+    try:
+        record = read_cardiology_xml(file)
+    except Exception as e:
+        return file.stem, None, str(e)
+    comments = _comments(record, codes)
+    metadata = {
+        'fs': record.fs,
+        'sig_name': LEADS,
+        'units': ['mV'] * len(LEADS),
+        'comments': comments,
+        'header': _header_text(file.stem, record, comments),
+        'source': _source_key(file, codes),
+    }
+    return file.stem, record.signal, metadata
+
+def convert_to_signal_cache(xml_dir: Path, labels_file: Path, cache_dir: Path, processes: int=None,
+                            force: bool=False) -> List[str]:
+    """Convert every XML file in `xml_dir` straight into a signal cache.
+
+    Records whose XML file and labels didn't change are copied from the
+    existing cache in `cache_dir` instead of being parsed again. Returns
+    the names of records that were converted. If anything fails (or no
+    record at all could be converted), the existing cache is left as is.
+    """
+    labels = read_labels(labels_file)
+    sources = _find_sources(xml_dir, labels)
+
+    old = None
+    if not force and (Path(cache_dir) / "index.npz").exists():
+        old = SignalCache(cache_dir)
+    reusable = {
+        name for name in sources
+        if old is not None and name in old and old.metadata[old.index(name)].get('source') == sources[name][1]
+    }
+    changed = [(file, key[2]) for name, (file, key) in sources.items() if name not in reusable]
+
+    converted, reused = [], 0
+    with ProcessPoolExecutor(processes) as executor:
+        parsed = {name: (signal, metadata) for name, signal, metadata in executor.map(_read_for_cache, changed)}
+    with SignalCacheWriter(cache_dir) as writer:
+        for name in sources:
+            if name in reusable:
+                i = old.index(name)
+                metadata = {k: v for k, v in old.metadata[i].items() if k != 'name'}
+                writer.append(name, np.array(old[i]), metadata)
+                reused += 1
+                continue
+            signal, metadata = parsed[name]
+            if signal is None:
+                print(f"WARNING: Couldn't convert {name} ({metadata})")
+                continue
+            writer.append(name, signal, metadata)
+            converted.append(name)
+        if sources and not (converted or reused):
+            raise RuntimeError(f"None of the {len(sources)} XML files in {xml_dir} could be converted")
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert PF12RED XML files to WFDB records (only files that changed).')
+    parser.add_argument('--data-dir', type=Path, default=None, help='datasets directory (default: from config.ini)')
+    parser.add_argument('--output', type=Path, default=None,
+                        help='output directory (default: <data-dir>/pf12red/extracted_NSR)')
+    parser.add_argument('--signal-cache', action='store_true', help='write a signal cache instead of WFDB files')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='convert every file again')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir
+    if data_dir is None:
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+        data_dir = Path(config["datasets"]["path"]).expanduser()
+    xml_dir = data_dir / "pf12red" / "5 163XML"
+    labels_file = data_dir / "pf12red" / "labels.csv"
+
+    if args.signal_cache:
+        output = args.output or data_dir / "pf12red" / "signal_cache"
+        converted = convert_to_signal_cache(xml_dir, labels_file, output, args.processes, args.force)
+        print(f"Converted {len(converted)} records into {output}")
+    else:
+        output = args.output or data_dir / "pf12red" / "extracted_NSR"
+        converted, removed = convert_to_wfdb(xml_dir, labels_file, output, args.processes, args.force)
+        print(f"Converted {len(converted)} records, removed {len(removed)} ({output})")
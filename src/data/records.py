@@ -0,0 +1,83 @@
+# Lazy iteration over the records of PhysioNet-style (WFDB) datasets
+#
+# Replacement for `get_all_records`: records are found at any depth with
+# `os.scandir`, one directory at a time, in a deterministic (sorted) order.
+# Records can be filtered on their header (age, diagnoses, sampling rate)
+# and split into shards for parallel workers.
+
+import os
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from src.data.header_index import HeaderInfo, read_header
+
+
+class Record(NamedTuple):
+    """A record in a dataset.
+
+    `name` is relative to the dataset directory, without a suffix (e.g.
+    "g1/E00001"). `path` is the full path without a suffix, as expected by
+    `wfdb.rdrecord`. A `Record` can be used as a path (`os.PathLike`), so
+    `wfdb.rdrecord(record)` and `dataset_dir / record` both work.
+    """
+    name: str
+    path: Path
+    header: Optional[HeaderInfo] = None     # Parsed header, if it was needed for filtering
+
+    def __fspath__(self) -> str:
+        return str(self.path)
+
+    def read_header(self) -> HeaderInfo:
+        return self.header if self.header is not None else read_header(self.path)
+
+def _walk(directory: Path, prefix: str) -> Iterator[Record]:
+    # Depth-first, sorted by name. Only one directory listing is held per level.
+    with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir():
+            yield from _walk(Path(entry.path), prefix + entry.name + '/')
+        elif entry.name.endswith('.hea'):
+            yield Record(prefix + entry.name[:-4], Path(entry.path[:-4]))
+
+def iter_records(dataset_dir: Path, min_age: int=None, max_age: int=None, codes: Iterable[int]=None,
+                 fs: float=None, where: Callable[[HeaderInfo], bool]=None, keep_unknown_age: bool=True,
+                 shard: int=0, num_shards: int=1) -> Iterator[Record]:
+    """Yields every record below `dataset_dir` (any depth), sorted by name.
+
+    Filters are checked on the header of each record (signals aren't read):
+    - `min_age`, `max_age`: known age in [min_age, max_age] (records with an
+      unknown age are kept if `keep_unknown_age`)
+    - `codes`: has at least one of these SNOMED-CT diagnoses
+    - `fs`: sampling frequency
+    - `where`: any other condition on the `HeaderInfo`
+
+    With `num_shards > 1`, only every `num_shards`-th record (starting at
+    `shard`) is considered, e.g. `shard=rank, num_shards=world_size` gives
+    each worker a disjoint, deterministic part of the dataset. Sharding
+    happens before filtering, so each worker only reads its own headers.
+    """
+    codes = None if codes is None else {int(code) for code in codes}
+    filtered = any(f is not None for f in (min_age, max_age, codes, fs, where))
+
+    for i, record in enumerate(_walk(Path(dataset_dir), '')):
+        if i % num_shards != shard:
+            continue
+        if not filtered:
+            yield record
+            continue
+
+        info = read_header(record.path)
+        age = info['age']
+        if age is None:
+            if not keep_unknown_age and (min_age is not None or max_age is not None):
+                continue
+        elif (min_age is not None and age < min_age) or (max_age is not None and age > max_age):
+            continue
+        if codes is not None and codes.isdisjoint(info['dx']):
+            continue
+        if fs is not None and info['fs'] != fs:
+            continue
+        if where is not None and not where(info):
+            continue
+        yield record._replace(header=info)
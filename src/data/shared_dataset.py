@@ -0,0 +1,222 @@
+# Batched DataLoader pipeline over a signal cache
+#
+# `ECGRecordDataset` (src/train.py) returns one preprocessed record at a time,
+# so with DataLoader workers every sample is pickled back to the main
+# process, which then collates and chunks the batch. Here a worker builds a
+# whole batch:
+# - signals are zero-copy slices of the memory-mapped `SignalCache` (every
+#   worker maps the same file, so the page cache is shared)
+# - the batch is preprocessed at once (`BatchPreprocessor` of src.preprocess,
+#   if it's in use) and chunked by `collate_into_block` in the worker
+# - the chunks travel to the main process as one tensor in shared memory
+#   (`BlockBatch`), instead of one pickle per record
+# `LengthBucketSampler` batches records of similar length, so batches have a
+# similar number of chunks and little padding when resampled together.
+# `PinnedBatches` copies batches to the GPU through a few preallocated pinned
+# buffers. `train` and `evaluate` (src/train.py) accept a `BlockBatch` as is.
+#
+# ```python
+# dataset = SignalPoolDataset(SignalCache(cache_dir), names, data_cfg, preprocess_cfg, targets)
+# iterator = PinnedBatches(get_batch_iterator(dataset, batch_size=32, num_workers=8), device)
+# train_ensemble(models, iterator, device, classes, athlete_labels)
+# ```
+
+from typing import Iterator, List, NamedTuple
+
+import numpy as np
+import torch
+from dsail.data import collate_into_block, collate_into_list
+
+from src.data.signal_cache import SignalCache
+from src.preprocess import BatchPreprocessor, dataset_samples, resample_ratio
+
+
+class BlockBatch(NamedTuple):
+    """A batch already chunked by `collate_into_block`"""
+    inputs: torch.Tensor    # (chunks, leads, chunk length)
+    flags: torch.Tensor     # Record of each chunk (as returned by `collate_into_block`)
+    labels: torch.Tensor
+    records: torch.Tensor   # Dataset index of each record in the batch
+
+    def blocks(self) -> list:
+        """[inputs, flags, labels], like `collate_into_block`"""
+        return [self.inputs, self.flags, self.labels]
+
+    def to(self, device, non_blocking: bool=False) -> 'BlockBatch':
+        return BlockBatch(*(t.to(device, non_blocking=non_blocking) for t in self))
+
+
+# Sampler
+# -------
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """Yields lists of dataset indices (whole batches) of similar length.
+
+    Each epoch, records are shuffled, split into pools of `bucket_batches`
+    batches, and sorted by length within a pool before being cut into
+    batches; the order of the batches is shuffled again. Every pass uses the
+    next epoch's order (or the one set with `set_epoch`).
+    """
+    def __init__(self, lengths, batch_size: int, shuffle: bool=True, bucket_batches: int=50, seed: int=0,
+                 drop_last: bool=False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _batches(self) -> List[np.ndarray]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(order), pool_size):
+            pool = order[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._batches()
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        pool_size = self.batch_size * self.bucket_batches
+        full, rest = divmod(len(self.lengths), pool_size)
+        return full * self.bucket_batches + -(-rest // self.batch_size)
+
+
+# Dataset
+# -------
+
+class SignalPoolDataset(torch.utils.data.Dataset):
+    """Records of a `SignalCache`, indexed by whole batches (lists of indices,
+    e.g. from `LengthBucketSampler`). Returns (`BlockBatch`, targets).
+
+    `preprocess_cfg` is dsail's `PreprocessConfig`, or a `BatchPreprocessor`
+    (e.g. `eval_list[1]` of `load_12ECG_model`). `targets` has shape
+    (records, athlete labels); without it, targets are empty.
+    """
+    def __init__(self, cache: SignalCache, names: List[str], data_cfg, preprocess_cfg, targets=None,
+                 chunk_length: int=2048, chunk_stride: int=1536):
+        self.cache = cache
+        self.names = list(names)
+        self.keys = np.array([cache.index(name) for name in self.names], dtype=np.int64)
+        if targets is None:
+            targets = np.zeros((len(self.names), 0))
+        self.targets = torch.as_tensor(np.asarray(targets), dtype=torch.float32)
+        self.data_cfg = data_cfg
+        self.preprocess_cfg = preprocess_cfg
+        self.chunk_length = chunk_length
+        self.chunk_stride = chunk_stride
+
+        # Check batched preprocessing of every (sampling rate, leads) group once, rather than in every worker
+        if isinstance(preprocess_cfg, BatchPreprocessor):
+            groups = {}
+            for i, key in enumerate(self.keys):
+                groups.setdefault((cache.fs(int(key)), int(cache.num_leads[key])), []).append(i)
+            for members in groups.values():
+                if preprocess_cfg.verified is False:
+                    break
+                self[members[:preprocess_cfg.check_records]]
+
+    def __len__(self):
+        return len(self.names)
+
+    def lengths(self, fs: float=None) -> np.ndarray:
+        """Length of each record (samples), after resampling to `fs` if given"""
+        lengths = self.cache.lengths[self.keys]
+        if fs is None:
+            return lengths
+        ratios = {}
+        resampled = np.empty_like(lengths)
+        for i, key in enumerate(self.keys):
+            record_fs = self.cache.fs(int(key))
+            if record_fs not in ratios:
+                ratios[record_fs] = resample_ratio(record_fs, fs)
+            up, down = ratios[record_fs]
+            resampled[i] = -(-lengths[i] * up // down)
+        return resampled
+
+    def __getitem__(self, indices) -> tuple:
+        indices = [int(i) for i in np.atleast_1d(indices)]
+        data = [self.cache[int(self.keys[i])] for i in indices]     # Zero-copy views of the memory map
+        headers = [self.cache.header(int(self.keys[i])) for i in indices]
+
+        if isinstance(self.preprocess_cfg, BatchPreprocessor):
+            samples = self.preprocess_cfg.samples(data, headers, self.data_cfg)
+        else:
+            samples = dataset_samples(data, headers, self.data_cfg, self.preprocess_cfg)
+        inputs, flags, labels = collate_into_block(collate_into_list(samples), self.chunk_length, self.chunk_stride)
+        batch = BlockBatch(inputs.contiguous(), flags, labels, torch.tensor(indices, dtype=torch.long))
+        return batch, self.targets[indices]
+
+def _no_collate(batch):
+    return batch
+
+def get_batch_iterator(dataset: SignalPoolDataset, batch_size: int=16, shuffle: bool=True, num_workers: int=0,
+                       seed: int=0, bucket_batches: int=50, prefetch_factor: int=2) -> torch.utils.data.DataLoader:
+    """DataLoader of (`BlockBatch`, targets), `batch_size` records of
+    similar length at a time, built by `num_workers` worker processes
+    """
+    fs = getattr(getattr(dataset.preprocess_cfg, 'spec', None), 'fs', None)
+    sampler = LengthBucketSampler(dataset.lengths(fs), batch_size, shuffle, bucket_batches, seed)
+    options = {'prefetch_factor': prefetch_factor, 'persistent_workers': True} if num_workers > 0 else {}
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=None, sampler=sampler, collate_fn=_no_collate, num_workers=num_workers, **options,
+    )
+
+
+# Pinned buffers
+# --------------
+
+class PinnedBatches():
+    """Iterates over (`BlockBatch`, targets) on `device`.
+
+    For CUDA, chunks are copied into one of `num_buffers` preallocated
+    pinned buffers (grown when a batch doesn't fit) and from there to the
+    GPU asynchronously; a buffer is only reused once its copy has finished.
+    On the CPU, batches are passed through.
+    """
+    def __init__(self, iterator, device: torch.device, num_buffers: int=2):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.num_buffers = num_buffers
+        self._buffers = [None] * num_buffers
+        self._events = [None] * num_buffers
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            yield from self.iterator
+            return
+
+        for step, (batch, targets) in enumerate(self.iterator):
+            slot = step % self.num_buffers
+            if self._events[slot] is not None:
+                self._events[slot].synchronize()
+            inputs = batch.inputs
+            buffer = self._buffers[slot]
+            if buffer is None or buffer.numel() < inputs.numel() or buffer.dtype != inputs.dtype:
+                buffer = self._buffers[slot] = torch.empty(inputs.numel(), dtype=inputs.dtype).pin_memory()
+            staged = buffer[:inputs.numel()].view(inputs.shape)
+            staged.copy_(inputs)
+            on_device = batch._replace(inputs=staged).to(self.device, non_blocking=True)
+            self._events[slot] = torch.cuda.Event()
+            self._events[slot].record()
+            yield on_device, targets.to(self.device, non_blocking=True)
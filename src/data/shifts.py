@@ -0,0 +1,200 @@
+# Dataset shift analysis (label prevalence, age and sex)
+#
+# Each dataset is reduced to a `ShiftStats` of counts (records per label, per
+# age bin and per sex). Counts are computed by the header index database
+# (no signals or headers are read), and can be added together, so a new
+# dataset only needs its own summary to be compared with the others.
+
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from src.data.header_index import HeaderIndex
+from src.data.norwegian import RELEVANT_FINDING_RULES, T_WAVE_RULES, classify_reports
+
+# Same bins as shifts.ipynb: under 15, 5 year bins from 15 to 90, 90 and over
+AGE_BIN_EDGES = np.linspace(15, 90, 16)
+SEXES = ["Male", "Female", "Unknown"]
+
+_SEX_NAMES = {"male": "Male", "m": "Male", "female": "Female", "f": "Female"}
+
+
+# Summaries
+# ---------
+
+class ShiftStats():
+    """Counts describing one dataset (or several merged datasets).
+
+    - `num_records`
+    - `label_counts[i]`: records with label `codes[i]`
+    - `age_counts[i]`: records with a known age in bin i of `np.digitize(age, bin_edges)`
+    - `sex_counts[i]`: records of sex `SEXES[i]`
+
+    `a + b` (or `merge`) adds the counts of two summaries.
+    """
+    def __init__(self, codes: List[int], bin_edges: np.ndarray=AGE_BIN_EDGES, num_records: int=0,
+                 label_counts: np.ndarray=None, age_counts: np.ndarray=None, sex_counts: np.ndarray=None):
+        self.codes = [int(code) for code in codes]
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.num_records = int(num_records)
+        self.label_counts = np.zeros(len(self.codes), dtype=np.int64) if label_counts is None else np.asarray(label_counts, dtype=np.int64)
+        self.age_counts = np.zeros(len(self.bin_edges) + 1, dtype=np.int64) if age_counts is None else np.asarray(age_counts, dtype=np.int64)
+        self.sex_counts = np.zeros(len(SEXES), dtype=np.int64) if sex_counts is None else np.asarray(sex_counts, dtype=np.int64)
+
+    def __repr__(self):
+        return f"ShiftStats(num_records={self.num_records}, labels={self.label_counts.sum()}, sexes={self.sex_counts})"
+
+    def __add__(self, other: "ShiftStats") -> "ShiftStats":
+        if self.codes != other.codes or not np.array_equal(self.bin_edges, other.bin_edges):
+            raise ValueError("Can only merge summaries with the same codes and age bins")
+        return ShiftStats(
+            self.codes, self.bin_edges, self.num_records + other.num_records,
+            self.label_counts + other.label_counts, self.age_counts + other.age_counts,
+            self.sex_counts + other.sex_counts,
+        )
+
+    def __radd__(self, other):
+        return self if other == 0 else self.__add__(other)     # sum([...])
+
+    merge = __add__
+
+    def prevalence(self) -> pd.Series:
+        """Fraction of records with each label"""
+        return pd.Series(self.label_counts / max(self.num_records, 1), index=self.codes)
+
+    def save(self, path: Path):
+        np.savez(
+            path, codes=np.array(self.codes, dtype=np.int64), bin_edges=self.bin_edges,
+            num_records=self.num_records, label_counts=self.label_counts,
+            age_counts=self.age_counts, sex_counts=self.sex_counts,
+        )
+
+    @staticmethod
+    def load(path: Path) -> "ShiftStats":
+        f = np.load(path)
+        return ShiftStats(
+            f['codes'].tolist(), f['bin_edges'], int(f['num_records']),
+            f['label_counts'], f['age_counts'], f['sex_counts'],
+        )
+
+def _sex_index(sex) -> int:
+    if sex is None or pd.isna(sex):
+        return SEXES.index("Unknown")
+    return SEXES.index(_SEX_NAMES.get(str(sex).strip().lower(), "Unknown"))
+
+def _age_counts(ages: np.ndarray, counts: np.ndarray, bin_edges: np.ndarray) -> np.ndarray:
+    bins = np.digitize(ages, bin_edges)
+    return np.bincount(bins, weights=counts, minlength=len(bin_edges) + 1).astype(np.int64)
+
+def summarize_index(index: HeaderIndex, dataset_dir: Path, codes: Iterable[int], bin_edges: np.ndarray=AGE_BIN_EDGES,
+                    labels_from: str="dx", chunk_size: int=10000) -> ShiftStats:
+    """Summary of a dataset in a `HeaderIndex` (refresh it first).
+
+    Counts are aggregated by SQLite (`GROUP BY`), so memory doesn't depend
+    on the size of the dataset. `labels_from` is "dx" (SNOMED-CT codes in
+    the headers) or "report"/"machine_report" (single line reports of the
+    Norwegian athlete dataset, labelled with `classify_reports` and
+    `RELEVANT_FINDING_RULES` + `T_WAVE_RULES`, `chunk_size` reports at a time).
+    """
+    dataset = HeaderIndex._key(dataset_dir)
+    codes = [int(code) for code in codes]
+    db = index.db
+
+    num_records = db.execute("SELECT COUNT(*) FROM records WHERE dataset = ?", (dataset,)).fetchone()[0]
+
+    label_counts = np.zeros(len(codes), dtype=np.int64)
+    column = {code: i for i, code in enumerate(codes)}
+    if labels_from == "dx":
+        query = "SELECT code, COUNT(DISTINCT name) FROM dx WHERE dataset = ? GROUP BY code"
+        for code, count in db.execute(query, (dataset,)):
+            if code in column:
+                label_counts[column[code]] = count
+    elif labels_from in ("report", "machine_report"):
+        rules = [rule for rule in RELEVANT_FINDING_RULES + T_WAVE_RULES if rule.code in column]
+        cursor = db.execute(f"SELECT {labels_from} FROM records WHERE dataset = ?", (dataset,))
+        while True:
+            reports = [row[0] for row in cursor.fetchmany(chunk_size)]
+            if not reports:
+                break
+            labels, label_codes, _ = classify_reports(reports, rules)
+            for i, code in enumerate(label_codes):
+                label_counts[column[code]] += labels[:, i].sum()
+    else:
+        raise ValueError(f"Unknown labels_from: {labels_from}")
+
+    query = "SELECT age, COUNT(*) FROM records WHERE dataset = ? AND age IS NOT NULL GROUP BY age"
+    rows = np.array(db.execute(query, (dataset,)).fetchall(), dtype=np.float64).reshape(-1, 2)
+    age_counts = _age_counts(rows[:, 0], rows[:, 1], bin_edges)
+
+    sex_counts = np.zeros(len(SEXES), dtype=np.int64)
+    for sex, count in db.execute("SELECT sex, COUNT(*) FROM records WHERE dataset = ? GROUP BY sex", (dataset,)):
+        sex_counts[_sex_index(sex)] += count
+
+    return ShiftStats(codes, bin_edges, num_records, label_counts, age_counts, sex_counts)
+
+def summarize_table(df: pd.DataFrame, codes: Iterable[int], bin_edges: np.ndarray=AGE_BIN_EDGES) -> ShiftStats:
+    """Summary of a table with `age`, `sex` and `dx` (list of codes) columns,
+    e.g. `HeaderIndex.table()`.
+    """
+    codes = [int(code) for code in codes]
+    counts = df.dx.map(lambda record_codes: list(set(record_codes))).explode().dropna().astype(np.int64).value_counts()
+    label_counts = np.array([counts.get(code, 0) for code in codes], dtype=np.int64)
+
+    ages = pd.to_numeric(df.age, errors='coerce').dropna().to_numpy(dtype=np.float64)
+    age_counts = _age_counts(ages, np.ones(len(ages)), bin_edges)
+    sex_counts = np.bincount([_sex_index(sex) for sex in df.sex], minlength=len(SEXES)).astype(np.int64)
+
+    return ShiftStats(codes, bin_edges, len(df), label_counts, age_counts, sex_counts)
+
+
+# Divergences
+# -----------
+
+def smoothed_distribution(counts: np.ndarray, alpha: float=0.5) -> np.ndarray:
+    """Normalize counts to probabilities, with additive (Laplace) smoothing
+    so that empty bins don't make the KL divergence infinite.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    return (counts + alpha) / (counts.sum(axis=-1, keepdims=True) + alpha * counts.shape[-1])
+
+def kl_divergence(p: np.ndarray, q: np.ndarray) -> float:
+    """KL(P || Q) in nats (same as `sum(scipy.special.rel_entr(p, q))`)"""
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(p > 0, p * np.log(p / q), 0)
+    return float(terms.sum(axis=-1))
+
+def js_divergence(p: np.ndarray, q: np.ndarray) -> float:
+    """Jensen-Shannon divergence in nats (symmetric, at most ln 2)"""
+    m = (np.asarray(p, dtype=np.float64) + np.asarray(q, dtype=np.float64)) / 2
+    return (kl_divergence(p, m) + kl_divergence(q, m)) / 2
+
+def _distributions(stats: ShiftStats, alpha: float) -> Dict[str, np.ndarray]:
+    return {
+        # Distribution over labels (normalized label counts), like shifts.ipynb
+        'labels': smoothed_distribution(stats.label_counts, alpha),
+        'age': smoothed_distribution(stats.age_counts, alpha),
+        'sex': smoothed_distribution(stats.sex_counts[:2], alpha),     # Known sex only
+    }
+
+def compare_datasets(sources: Dict[str, ShiftStats], targets: Dict[str, ShiftStats], alpha: float=0.5) -> pd.DataFrame:
+    """Divergences between every source (P) and target (Q) dataset.
+
+    One row per (source, target, attribute), where attribute is "labels",
+    "age" or "sex", with columns `kl_pq`, `kl_qp` and `js` (nats).
+    """
+    rows = []
+    target_distributions = {name: _distributions(stats, alpha) for name, stats in targets.items()}
+    for source, stats in sources.items():
+        p_all = _distributions(stats, alpha)
+        for target, q_all in target_distributions.items():
+            for attribute, p in p_all.items():
+                q = q_all[attribute]
+                rows.append({
+                    'source': source, 'target': target, 'attribute': attribute,
+                    'kl_pq': kl_divergence(p, q), 'kl_qp': kl_divergence(q, p), 'js': js_divergence(p, q),
+                })
+    return pd.DataFrame(rows)
@@ -0,0 +1,192 @@
+# Binary signal cache for PhysioNet-style (WFDB) datasets
+#
+# Decoding WFDB records (`wfdb.rdrecord`) is slow. This converts a whole
+# dataset once into one contiguous float32 file that can be memory-mapped,
+# with an index of where each record starts.
+
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Tuple, Union
+
+import numpy as np
+import wfdb
+
+from src.data.records import iter_records
+
+SIGNALS_FILE = "signals.f32"
+INDEX_FILE = "index.npz"
+METADATA_FILE = "records.jsonl"
+
+
+def record_path(dataset_dir: Path, entry) -> Path:
+    """Full path to a record returned by `get_all_records` or `iter_records`"""
+    entry = Path(entry)
+    return entry if entry.is_absolute() or entry.parent != Path('.') else dataset_dir / entry
+
+def record_name(dataset_dir: Path, path: Path) -> str:
+    """Record name relative to the dataset directory, e.g. "g1/E00001" """
+    try:
+        return Path(path).relative_to(dataset_dir).as_posix()
+    except ValueError:
+        return Path(path).name
+
+def _read_record(path: Path) -> Tuple[np.ndarray, dict]:
+    record = wfdb.rdrecord(path)
+    signal = np.ascontiguousarray(record.p_signal.transpose(), dtype=np.float32)
+    with open(path.with_suffix('.hea'), 'r') as f:
+        header = f.read()
+    metadata = {
+        'fs': record.fs,
+        'sig_name': record.sig_name,
+        'units': record.units,
+        'comments': record.comments,
+        'header': header,
+    }
+    return signal, metadata
+
+
+class SignalCacheWriter():
+    """Appends lead-major float32 signals to a signal cache directory.
+
+    Used by `build_signal_cache`, and by dataset converters that produce
+    signals directly (e.g. PF12RED XML files). Signals go to a temporary
+    directory next to `cache_dir`, which replaces the cache on `close`; if
+    the `with` block raises, it is removed and the previous cache is kept.
+    """
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        self._tmp_dir = self.cache_dir.with_name(self.cache_dir.name + ".tmp")
+        if self._tmp_dir.exists():
+            shutil.rmtree(self._tmp_dir)
+        self._tmp_dir.mkdir(parents=True)
+        self._signals = open(self._tmp_dir / SIGNALS_FILE, 'wb')
+        self._metadata = open(self._tmp_dir / METADATA_FILE, 'w')
+        self._offsets, self._num_leads, self._lengths = [], [], []
+        self._offset = 0
+
+    def append(self, name: str, signal: np.ndarray, metadata: dict):
+        """`signal` has shape (leads, samples)"""
+        signal = np.ascontiguousarray(signal, dtype=np.float32)
+        self._signals.write(signal.tobytes())
+        self._offsets.append(self._offset)
+        self._num_leads.append(signal.shape[0])
+        self._lengths.append(signal.shape[1])
+        self._offset += signal.size
+        self._metadata.write(json.dumps({'name': name, **metadata}) + '\n')
+
+    def abort(self):
+        """Discard what was written (any previous cache in `cache_dir` is kept)"""
+        self._signals.close()
+        self._metadata.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def close(self):
+        """Publish the cache (replaces any previous cache in `cache_dir`)"""
+        self._signals.close()
+        self._metadata.close()
+        np.savez(
+            self._tmp_dir / INDEX_FILE,
+            offsets=np.array(self._offsets, dtype=np.int64),
+            num_leads=np.array(self._num_leads, dtype=np.int16),
+            lengths=np.array(self._lengths, dtype=np.int64),
+        )
+        if self.cache_dir.exists():
+            shutil.rmtree(self.cache_dir)
+        os.replace(self._tmp_dir, self.cache_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Only publish complete caches
+        if exc[0] is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def build_signal_cache(dataset_dir: Path, cache_dir: Path, records: Iterable=None, processes: int=None):
+    """Decode every record in a dataset once, into a signal cache.
+
+    `records` defaults to `iter_records(dataset_dir)` (every record, sorted). Records are decoded
+    by a pool of `processes` (default: one per core) and written in order.
+    """
+    dataset_dir = Path(dataset_dir)
+    if records is None:
+        records = iter_records(dataset_dir)
+    paths = [record_path(dataset_dir, entry) for entry in records]
+
+    with SignalCacheWriter(cache_dir) as writer, ProcessPoolExecutor(processes) as executor:
+        for path, (signal, metadata) in zip(paths, executor.map(_read_record, paths, chunksize=16)):
+            writer.append(record_name(dataset_dir, path), signal, metadata)
+
+
+class SignalCache():
+    """Read-only view of a signal cache built by `build_signal_cache`.
+
+    ```python
+    cache = SignalCache(cache_dir)
+    signal = cache["g1/E00001"]     # (leads, samples) float32, zero-copy
+    data, header_data = cache.load_challenge_data("g1/E00001")
+    ```
+    """
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        index = np.load(self.cache_dir / INDEX_FILE)
+        self.offsets = index['offsets']
+        self.num_leads = index['num_leads']
+        self.lengths = index['lengths']
+
+        with open(self.cache_dir / METADATA_FILE, 'r') as f:
+            self.metadata = [json.loads(line) for line in f]
+        self.names = [m['name'] for m in self.metadata]
+        self._index_of = {name: i for i, name in enumerate(self.names)}
+
+        self._signals = None
+
+    @property
+    def signals(self) -> np.ndarray:
+        # Opened lazily, so the cache can be passed to worker processes
+        if self._signals is None:
+            self._signals = np.memmap(self.cache_dir / SIGNALS_FILE, dtype=np.float32, mode='r')
+        return self._signals
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_signals'] = None
+        return state
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, key):
+        return key in self._index_of
+
+    def index(self, key: Union[int, str]) -> int:
+        if isinstance(key, (int, np.integer)):
+            return int(key)
+        return self._index_of[str(key)]
+
+    def __getitem__(self, key: Union[int, str]) -> np.ndarray:
+        """Lead-major signal of a record, shape (leads, samples)"""
+        i = self.index(key)
+        start = self.offsets[i]
+        stop = start + int(self.num_leads[i]) * int(self.lengths[i])
+        return self.signals[start:stop].reshape(self.num_leads[i], self.lengths[i])
+
+    def header(self, key: Union[int, str]) -> List[str]:
+        """Lines of the record's `.hea` file (like `readlines()`)"""
+        return self.metadata[self.index(key)]['header'].splitlines(keepends=True)
+
+    def fs(self, key: Union[int, str]) -> float:
+        return self.metadata[self.index(key)]['fs']
+
+    def comments(self, key: Union[int, str]) -> List[str]:
+        return self.metadata[self.index(key)]['comments']
+
+    def load_challenge_data(self, key: Union[int, str]):
+        """Same as `load_challenge_data` in the driver, but float32"""
+        return self[key], self.header(key)
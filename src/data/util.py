@@ -1,6 +1,7 @@
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 
+import numpy as np
 import pandas as pd
 
 diagnosis_codes = {
@@ -22,7 +23,8 @@ diagnosis_codes = {
 def get_all_records(dataset_dir: Path) -> List[Path]:
     """Returns a list of every record in a PhysioNet-style dataset
 
-    Can handle 1 level of nesting.
+    Can handle 1 level of nesting. See `src.data.records.iter_records` for
+    any depth, filtering and sharding.
     """
     records = []
     for item in dataset_dir.iterdir():
@@ -72,3 +74,131 @@ def codes_to_label_vector(codes: List[int], labels: List[int]):
         outcome = 1 if code in codes else 0
         vector.append(outcome)
     return vector
+
+
+# Consolidated prediction store
+# -----------------------------
+
+class PredictionStore():
+    """Model predictions for every record of a dataset, in one directory.
+
+    An alternative to one challenge output CSV per record. Rows are appended
+    (buffered) to flat binary files, so an interrupted run keeps every row
+    that was flushed.
+
+    - `classes.txt`  one SNOMED-CT code per line (column order)
+    - `records.txt`  one record name per line (row order)
+    - `scores.f32`   float32 matrix (records, classes)
+    - `labels.u8`    uint8 matrix (records, classes)
+    """
+    def __init__(self, path: Path, classes: List[str]=None, buffer_size: int=1024):
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self._buffer = []
+
+        classes_file = self.path / "classes.txt"
+        if classes_file.exists():
+            self.classes = classes_file.read_text().split()
+            if classes is not None and list(classes) != self.classes:
+                raise ValueError(f"{self.path} was written with different classes")
+        elif classes is not None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            classes_file.write_text('\n'.join(classes) + '\n')
+            self.classes = list(classes)
+        else:
+            raise FileNotFoundError(f"{classes_file} not found")
+
+        self.records = self._recover()
+
+    def _recover(self) -> List[str]:
+        """Drop rows that were only partially written (e.g. after a crash)"""
+        records_file = self.path / "records.txt"
+        records = records_file.read_text().split() if records_file.exists() else []
+        num_classes = len(self.classes)
+        rows = len(records)
+        for name, itemsize in [("scores.f32", 4), ("labels.u8", 1)]:
+            file = self.path / name
+            size = file.stat().st_size if file.exists() else 0
+            rows = min(rows, size // (num_classes * itemsize))
+
+        for name, itemsize in [("scores.f32", 4), ("labels.u8", 1)]:
+            with open(self.path / name, 'ab') as f:
+                f.truncate(rows * num_classes * itemsize)
+        if rows != len(records):
+            records = records[:rows]
+            records_file.write_text(''.join(r + '\n' for r in records))
+        return records
+
+    def append(self, names: List[str], scores, labels):
+        """Add predictions for some records (written on `flush`)"""
+        self._buffer.append((
+            list(names),
+            np.asarray(scores, dtype=np.float32).reshape(len(names), len(self.classes)),
+            np.asarray(labels, dtype=np.uint8).reshape(len(names), len(self.classes)),
+        ))
+        if sum(len(b[0]) for b in self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        names = [n for b in self._buffer for n in b[0]]
+        scores = np.concatenate([b[1] for b in self._buffer])
+        labels = np.concatenate([b[2] for b in self._buffer])
+
+        # Record names are written last; a row only exists once it is named.
+        with open(self.path / "scores.f32", 'ab') as f:
+            f.write(scores.tobytes())
+        with open(self.path / "labels.u8", 'ab') as f:
+            f.write(labels.tobytes())
+        with open(self.path / "records.txt", 'a') as f:
+            f.write(''.join(n + '\n' for n in names))
+
+        self.records.extend(names)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_predictions(store_dir: Path, records: List[str]=None) -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+    """Get model predictions from a `PredictionStore` as NumPy matrices.
+
+    Returns (scores, labels, records, classes). `scores` and `labels` have 
+    one row per record (in the order of `records`, or every record in the 
+    store if not given) and one column per class. If a record was predicted 
+    more than once, the latest prediction is used. An empty store gives
+    (0, classes) arrays.
+    """
+    store_dir = Path(store_dir)
+    classes = (store_dir / "classes.txt").read_text().split()
+    records_file = store_dir / "records.txt"
+    names = records_file.read_text().split() if records_file.exists() else []
+    num_classes = len(classes)
+
+    def _map(name, dtype):
+        # Empty files can't be memory-mapped (nothing appended yet)
+        path = store_dir / name
+        if not path.exists() or path.stat().st_size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    scores = _map("scores.f32", np.float32)
+    labels = _map("labels.u8", np.uint8)
+    rows = min(len(names), len(scores) // num_classes, len(labels) // num_classes)
+    scores = scores[:rows * num_classes].reshape(rows, num_classes)
+    labels = labels[:rows * num_classes].reshape(rows, num_classes)
+
+    # Accept anything from `get_all_records` (e.g. Path('g1/E00001') or 'E00001')
+    row_of = {name: i for i, name in enumerate(names[:rows])}
+    if records is None:
+        records = list(row_of)
+    records = [Path(r).name for r in records]
+    rows = np.array([row_of[r] for r in records], dtype=np.int64)
+
+    return np.array(scores[rows]), np.array(labels[rows]), records, classes
@@ -0,0 +1,205 @@
+# Utility functions for running the 10-fold DSAIL_SNU ensemble as one model:
+# - Fused module (the folds evaluated in one vectorized call)
+# - Warm start cache (pre-merged, memory-mappable checkpoint)
+
+import copy
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+NUM_FOLDS = 10
+
+
+# Fused ensemble
+# --------------
+
+class EnsembleModel(torch.nn.Module):
+    """Every network in a k-fold ensemble, evaluated as one module.
+
+    The individual networks own their parameters and buffers (they can be
+    indexed, iterated, moved, saved or fine-tuned like the old list of
+    models). For vectorized evaluation, the tensors of every fold are
+    stacked into tensors with shape (folds, ...), which are rebuilt whenever
+    a fold's tensors have changed. While they exist, every weight is in
+    memory twice; they are freed when the module is put in training mode.
+
+    Calling the module returns logits with shape (folds, records, classes).
+    In evaluation mode the folds are run in a single vectorized call using
+    `torch.func.vmap` (PyTorch 2.x). Otherwise each fold is run in turn.
+    """
+    def __init__(self, nets: List[torch.nn.Module], stacked: Dict[str, torch.Tensor]=None):
+        super().__init__()
+        self.nets = torch.nn.ModuleList(nets)
+        self._param_names = [k for k, _ in nets[0].named_parameters()]
+        self._buffer_names = [k for k, _ in nets[0].named_buffers()]
+
+        # Weights from `load_ensemble_cache`: copied into each fold
+        if stacked is not None:
+            with torch.no_grad():
+                for fold, net in enumerate(nets):
+                    for name in self._param_names + self._buffer_names:
+                        _get_tensor(net, name).copy_(stacked[name][fold])
+
+        # Stateless copy of one network, used as a template for vmap (kept out
+        # of the module tree, so `.to(device)` etc. doesn't touch it)
+        self.__dict__['_base'] = copy.deepcopy(nets[0]).to("meta") if _has_vmap() else None
+        self._use_vmap = self._base is not None
+        self._stack_key = None
+        self._stack = None
+
+    def __len__(self):
+        return len(self.nets)
+
+    def __iter__(self):
+        return iter(self.nets)
+
+    def __getitem__(self, idx):
+        return self.nets[idx]
+
+    def train(self, mode: bool=True):
+        if mode:
+            self._stack_key = self._stack = None    # Only used for evaluation
+        return super().train(mode)
+
+    def stacked_state_dict(self) -> Dict[str, torch.Tensor]:
+        """Parameters and buffers of every fold, shape (folds, ...)"""
+        with torch.no_grad():
+            return {
+                name: torch.stack([_get_tensor(net, name) for net in self.nets])
+                for name in self._param_names + self._buffer_names
+            }
+
+    def forward(self, inputs, flags):
+        if self._use_vmap and not self.training and not torch.is_grad_enabled():
+            try:
+                return self._forward_vmap(inputs, flags)
+            except Exception as e:
+                # Some operations can't be vectorized (e.g. data dependent
+                # control flow). Run each fold in turn from now on.
+                print(f"WARNING: Vectorized ensemble evaluation failed ({type(e).__name__}: {e}); "
+                      f"evaluating each fold in turn")
+                self._use_vmap = False
+        return torch.stack([net(inputs, flags) for net in self.nets])
+
+    def stack(self) -> Dict[str, torch.Tensor]:
+        """Build the stacked tensors for vectorized evaluation now (e.g. before
+        forking worker processes, which then share them)
+        """
+        return self._stacked() if self._use_vmap else {}
+
+    def _stacked(self) -> Dict[str, torch.Tensor]:
+        # Restacked only when a fold's tensor was replaced, moved or modified
+        tensors = [_get_tensor(net, name) for name in self._param_names + self._buffer_names for net in self.nets]
+        key = tuple((t.data_ptr(), t._version, t.device, t.dtype) for t in tensors)
+        if key != self._stack_key:
+            self._stack = self.stacked_state_dict()
+            self._stack_key = key
+        return self._stack
+
+    def _forward_vmap(self, inputs, flags):
+        stacked = self._stacked()
+        params = {k: stacked[k] for k in self._param_names}
+        buffers = {k: stacked[k] for k in self._buffer_names}
+        self._base.train(self.training)
+
+        def call(p, b):
+            return torch.func.functional_call(self._base, (p, b), (inputs, flags))
+
+        return torch.func.vmap(call)(params, buffers)
+
+
+def _has_vmap() -> bool:
+    return hasattr(torch, "func") and hasattr(torch.func, "functional_call")
+
+def _get_parent(net: torch.nn.Module, name: str) -> Tuple[torch.nn.Module, str]:
+    *path, leaf = name.split('.')
+    module = net
+    for part in path:
+        module = getattr(module, part)
+    return module, leaf
+
+def _get_tensor(net: torch.nn.Module, name: str) -> torch.Tensor:
+    module, leaf = _get_parent(net, name)
+    return getattr(module, leaf)
+
+
+# Warm start cache
+# ----------------
+
+def checkpoint_hash(output_training_directory) -> str:
+    """Hash of the checkpoint files in a directory (name, size, modified time)
+
+    Used as the key for the warm start cache.
+    """
+    checkpoint_dir = Path(output_training_directory).resolve()
+    h = hashlib.sha256(str(checkpoint_dir).encode())
+    for fold in range(NUM_FOLDS):
+        for name in ('finalized_model_%d.sav' % fold, 'finalized_model_thresholds_%d.npy' % fold):
+            stat = (checkpoint_dir / name).stat()
+            h.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return h.hexdigest()[:16]
+
+def default_cache_dir(output_training_directory) -> Path:
+    """e.g. checkpoints/original -> checkpoints/.cache"""
+    return Path(output_training_directory).resolve().parent / ".cache"
+
+def save_ensemble_cache(cache_path: Path, stacked: Dict[str, torch.Tensor], thresholds: np.ndarray):
+    """Write stacked ensemble weights as one flat, memory-mappable file.
+
+    Layout of `cache_path`:
+    - `weights.bin` raw bytes of every tensor (64-byte aligned)
+    - `index.json`  name, dtype, shape and byte offset of every tensor
+    - `thresholds.npy` class thresholds averaged over folds
+    """
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir(parents=True)
+
+    index = []
+    offset = 0
+    with open(tmp_path / "weights.bin", 'wb') as f:
+        for name, tensor in stacked.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            padding = -offset % 64
+            f.write(b'\0' * padding)
+            offset += padding
+            index.append({
+                'name': name,
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+                'offset': offset,
+            })
+            f.write(array.tobytes())
+            offset += array.nbytes
+    with open(tmp_path / "index.json", 'w') as f:
+        json.dump(index, f)
+    np.save(tmp_path / "thresholds.npy", thresholds)
+
+    # Only publish complete caches (other processes may be reading)
+    if cache_path.exists():
+        shutil.rmtree(cache_path)
+    os.replace(tmp_path, cache_path)
+
+def load_ensemble_cache(cache_path: Path) -> Tuple[Dict[str, torch.Tensor], np.ndarray]:
+    """Memory-map stacked ensemble weights written by `save_ensemble_cache`"""
+    with open(cache_path / "index.json", 'r') as f:
+        index = json.load(f)
+
+    # Copy-on-write, so pages are only read (or copied) when used
+    blob = np.memmap(cache_path / "weights.bin", dtype=np.uint8, mode='c')
+    stacked = {}
+    for entry in index:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        array = blob[entry['offset']:entry['offset'] + count * dtype.itemsize]
+        stacked[entry['name']] = torch.from_numpy(array.view(dtype).reshape(entry['shape']))
+
+    thresholds = np.load(cache_path / "thresholds.npy")
+    return stacked, thresholds
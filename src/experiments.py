@@ -0,0 +1,300 @@
+# Content-addressed cache of benchmark results
+#
+# Benchmarks used to be rerun whenever their output directory didn't exist,
+# which reuses stale results after a config or checkpoint changes, and reruns
+# everything when a dataset grows. Here every result is keyed by content:
+# - a model key: hash of the checkpoint files (weights and thresholds), every
+#   `*.json` in the config directory and the preprocessing options
+# - a record key: hash of the record's header and signal files
+#
+# Each model key has one `PredictionStore` (`src.data.util`) whose rows are
+# named by record key, so only records whose key isn't in the store yet are
+# classified, whatever dataset they come from. Layout of the cache directory:
+# - `<model key>/`        `PredictionStore`, plus `run.json` (checkpoint and
+#                         config directories, datasets, last use)
+# - `record_hashes.json`  hashes of record files by path, reused while their
+#                         size and modified time don't change
+#
+# Whole model entries are evicted least recently used first (`evict`).
+#
+# ```python
+# cache = ExperimentCache(data_dir / "benchmark" / ".cache")
+# scores, labels, records, classes = cache.run(checkpoint_dir, config_dir, dataset_dir)
+# ```
+#
+# `python -m src.experiments` runs, lists and evicts cached benchmarks.
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from src.data.records import iter_records
+from src.data.util import PredictionStore, read_predictions
+from src.ensemble import NUM_FOLDS
+from src.preprocess import PREPROCESS_CONFIG, read_preprocess_spec
+
+CACHE_VERSION = 1
+HASHES_FILE = "record_hashes.json"
+RUN_FILE = "run.json"
+
+
+# Keys
+# ----
+
+def _file_hash(path: Path, h=None) -> str:
+    h = h or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def model_key(checkpoint_dir: Path, config_dir: Path) -> str:
+    """Hash of the contents of the checkpoint files, config JSON files and
+    preprocessing options (unlike `checkpoint_hash`, which only uses file
+    sizes and modified times)
+    """
+    import dsail.config as config
+
+    checkpoint_dir, config_dir = Path(checkpoint_dir), Path(config_dir)
+    h = hashlib.sha256(f"version:{CACHE_VERSION};".encode())
+    for fold in range(NUM_FOLDS):
+        for name in ('finalized_model_%d.sav' % fold, 'finalized_model_thresholds_%d.npy' % fold):
+            h.update(f"{name}:{_file_hash(checkpoint_dir / name)};".encode())
+    for path in sorted(config_dir.glob("*.json")):
+        h.update(f"{path.name}:{_file_hash(path)};".encode())
+    preprocess_cfg = config.PreprocessConfig(config_dir / PREPROCESS_CONFIG)
+    h.update(f"preprocess:{tuple(read_preprocess_spec(config_dir / PREPROCESS_CONFIG, preprocess_cfg))};".encode())
+    return h.hexdigest()[:32]
+
+def record_files(record: Path) -> List[Path]:
+    """Header and signal files of a WFDB record (path without a suffix)"""
+    header = Path(record).with_suffix('.hea')
+    files = [header]
+    with open(header, 'r') as f:
+        lines = [line for line in f if line.strip() and not line.startswith('#')]
+    for line in lines[1:]:
+        file = header.parent / line.split()[0]
+        if file not in files:
+            files.append(file)
+    return files
+
+def record_key(record: Path) -> str:
+    """Hash of the contents of a record's header and signal files"""
+    h = hashlib.sha256()
+    for file in record_files(record):
+        h.update(f"{file.name}:".encode())
+        _file_hash(file, h)
+    return h.hexdigest()[:32]
+
+
+# Cache
+# -----
+
+class Run(NamedTuple):
+    """A cached model entry (see `ExperimentCache.runs`)"""
+    key: str
+    checkpoint_dir: str
+    config_dir: str
+    datasets: List[str]
+    records: int            # Distinct records with results
+    size: int               # Bytes on disk
+    last_used: float        # time.time()
+
+def _dir_size(path: Path) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def _write_json(path: Path, data):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+class ExperimentCache():
+    """Benchmark results of (checkpoints, config, dataset) triples, keyed by
+    content (see the top of `src/experiments.py`).
+
+    `max_size` (bytes) and `max_runs` bound the cache after every `run`
+    (least recently used model entries are evicted first).
+    """
+    def __init__(self, cache_dir: Path, max_size: int=None, max_runs: int=None):
+        self.path = Path(cache_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.max_runs = max_runs
+        self._hashes = None
+
+    def record_keys(self, records: List[Path]) -> List[str]:
+        """`record_key` of each record, reusing hashes of unchanged files"""
+        if self._hashes is None:
+            hashes_file = self.path / HASHES_FILE
+            self._hashes = json.loads(hashes_file.read_text()) if hashes_file.exists() else {}
+        keys, changed = [], False
+        for record in records:
+            path = str(Path(record).resolve())
+            stats = [[file.stat().st_size, file.stat().st_mtime_ns] for file in record_files(Path(record))]
+            cached = self._hashes.get(path)
+            if cached is None or cached[0] != stats:
+                cached = self._hashes[path] = [stats, record_key(Path(record))]
+                changed = True
+            keys.append(cached[1])
+        if changed:
+            _write_json(self.path / HASHES_FILE, self._hashes)
+        return keys
+
+    def _touch(self, key: str, checkpoint_dir: Path=None, config_dir: Path=None, dataset_dir: Path=None):
+        run_file = self.path / key / RUN_FILE
+        run = json.loads(run_file.read_text()) if run_file.exists() else {'datasets': []}
+        if checkpoint_dir is not None:
+            run['checkpoint_dir'] = str(Path(checkpoint_dir).resolve())
+            run['config_dir'] = str(Path(config_dir).resolve())
+        if dataset_dir is not None and str(Path(dataset_dir).resolve()) not in run['datasets']:
+            run['datasets'].append(str(Path(dataset_dir).resolve()))
+        run['last_used'] = time.time()
+        _write_json(run_file, run)
+
+    def query(self, checkpoint_dir: Path, config_dir: Path, dataset_dir: Path, key: str=None
+              ) -> Tuple[np.ndarray, np.ndarray, List[str], List[str], List[str]]:
+        """Cached results of a model on a dataset, without classifying anything.
+
+        Returns (scores, labels, records, classes, missing) like
+        `read_predictions`, with the records of `dataset_dir` (names relative
+        to it) that have results, and the names of those that don't.
+        """
+        key = key or model_key(checkpoint_dir, config_dir)
+        records = list(iter_records(dataset_dir))
+        record_keys = self.record_keys([r.path for r in records])
+        store_dir = self.path / key
+        cached = set((store_dir / "records.txt").read_text().split()) if (store_dir / "records.txt").exists() else set()
+
+        found = [i for i, k in enumerate(record_keys) if k in cached]
+        missing = [records[i].name for i, k in enumerate(record_keys) if k not in cached]
+        if not found:
+            return np.zeros((0, 0), np.float32), np.zeros((0, 0), np.uint8), [], [], missing
+        scores, labels, _, classes = read_predictions(store_dir, [record_keys[i] for i in found])
+        self._touch(key)
+        return scores, labels, [records[i].name for i in found], classes, missing
+
+    def run(self, checkpoint_dir: Path, config_dir: Path, dataset_dir: Path, batch_size: int=32,
+            chunk_size: int=512) -> Tuple[np.ndarray, np.ndarray, List[str], List[str]]:
+        """Results of a model on every record of a dataset, classifying only
+        records that aren't cached yet (`chunk_size` records are read at a
+        time). Returns (scores, labels, records, classes).
+        """
+        import dsail.config as config
+        from PhysioNet2020_driver import load_challenge_data
+        from src.run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier_batch
+
+        key = model_key(checkpoint_dir, config_dir)
+        records = list(iter_records(dataset_dir))
+        record_keys = self.record_keys([r.path for r in records])
+        classes = config.DataConfig(Path(config_dir) / "data.json").scored_classes
+
+        with PredictionStore(self.path / key, classes) as store:
+            cached = set(store.records)
+            todo, seen = [], set()
+            for record, k in zip(records, record_keys):
+                if k not in cached and k not in seen:
+                    todo.append((record, k))
+                    seen.add(k)
+            print(f"{len(records) - len(todo)} of {len(records)} records cached for model {key}")
+
+            if todo:
+                eval_list = load_12ECG_model(checkpoint_dir, Path(config_dir))
+                for start in range(0, len(todo), chunk_size):
+                    chunk = todo[start:start + chunk_size]
+                    loaded = [load_challenge_data(record.path) for record, _ in chunk]
+                    labels, scores, _ = run_12ECG_classifier_batch(
+                        [d for d, _ in loaded], [h for _, h in loaded], eval_list, batch_size=batch_size
+                    )
+                    store.append([k for _, k in chunk], scores, labels)
+                    store.flush()
+        self._touch(key, checkpoint_dir, config_dir, dataset_dir)
+
+        if self.max_size is not None or self.max_runs is not None:
+            self.evict(self.max_size, self.max_runs, keep=[key])
+        scores, labels, _, classes = read_predictions(self.path / key, record_keys)
+        return scores, labels, [r.name for r in records], classes
+
+    def runs(self) -> List[Run]:
+        """Every model entry, most recently used first"""
+        runs = []
+        for entry in self.path.iterdir():
+            if not (entry / RUN_FILE).exists():
+                continue
+            run = json.loads((entry / RUN_FILE).read_text())
+            records_file = entry / "records.txt"
+            records = len(set(records_file.read_text().split())) if records_file.exists() else 0
+            runs.append(Run(entry.name, run.get('checkpoint_dir', ''), run.get('config_dir', ''), run['datasets'],
+                            records, _dir_size(entry), run['last_used']))
+        return sorted(runs, key=lambda run: -run.last_used)
+
+    def evict(self, max_size: int=None, max_runs: int=None, keep: List[str]=()) -> List[Run]:
+        """Remove least recently used model entries until there are at most
+        `max_runs` and they take at most `max_size` bytes. Entries in `keep`
+        are never removed. Returns the removed entries.
+        """
+        runs = self.runs()
+        size = sum(run.size for run in runs)
+        removed = []
+        for run in reversed(runs):
+            over_size = max_size is not None and size > max_size
+            over_runs = max_runs is not None and len(runs) - len(removed) > max_runs
+            if not (over_size or over_runs):
+                break
+            if run.key in keep:
+                continue
+            shutil.rmtree(self.path / run.key)
+            size -= run.size
+            removed.append(run)
+        return removed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cached benchmark results of checkpoints on datasets.')
+    parser.add_argument('--cache-dir', type=Path, required=True, help='e.g. <datasets>/benchmark/.cache')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='classify the records of a dataset that aren\'t cached yet')
+    run_parser.add_argument('checkpoint_dir', type=Path, help='directory with finalized_model_*.sav checkpoints')
+    run_parser.add_argument('config_dir', type=Path, help='directory with data.json, model.json etc.')
+    run_parser.add_argument('dataset_dir', type=Path)
+    run_parser.add_argument('--export', type=Path, default=None,
+                            help='also write one challenge output CSV per record to this directory')
+    run_parser.add_argument('--batch-size', type=int, default=32)
+    run_parser.add_argument('--max-size-gb', type=float, default=None, help='evict old runs beyond this size')
+    run_parser.add_argument('--max-runs', type=int, default=None, help='evict old runs beyond this number')
+
+    commands.add_parser('list', help='list cached runs, most recently used first')
+
+    evict_parser = commands.add_parser('evict', help='remove least recently used runs')
+    evict_parser.add_argument('--max-size-gb', type=float, default=None)
+    evict_parser.add_argument('--max-runs', type=int, default=None)
+    args = parser.parse_args()
+
+    max_size = int(args.max_size_gb * 2**30) if getattr(args, 'max_size_gb', None) is not None else None
+    if args.command == 'run':
+        cache = ExperimentCache(args.cache_dir, max_size, args.max_runs)
+        scores, labels, records, classes = cache.run(args.checkpoint_dir, args.config_dir, args.dataset_dir,
+                                                     batch_size=args.batch_size)
+        if args.export is not None:
+            from PhysioNet2020_driver import save_challenge_predictions
+            args.export.mkdir(parents=True, exist_ok=True)
+            for name, score, label in zip(records, scores.astype(np.float64), labels):
+                save_challenge_predictions(args.export, Path(name).name, score, label, classes)
+    elif args.command == 'list':
+        for run in ExperimentCache(args.cache_dir).runs():
+            print(f"{run.key}  {run.records:7d} records  {run.size / 2**20:8.1f} MB  "
+                  f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(run.last_used))}  "
+                  f"{run.checkpoint_dir}  {run.config_dir}")
+            for dataset in run.datasets:
+                print(f"    {dataset}")
+    else:
+        for run in ExperimentCache(args.cache_dir).evict(max_size, args.max_runs):
+            print(f"Removed {run.key} ({run.checkpoint_dir}, {run.size / 2**20:.1f} MB)")
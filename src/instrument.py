@@ -0,0 +1,293 @@
+# Opt-in timing hooks for the classifier pipeline
+#
+# Stages of the pipeline (reading records, preprocessing, chunking, forward
+# pass, ...) are wrapped in `span`s. While no sink is enabled, `span` returns
+# a shared no-op object, so the hooks cost about one function call. Enabled
+# sinks receive one event per span: stage name, duration, and fields like
+# the number of records, tensor shapes or bytes read.
+#
+# ```python
+# from src import instrument
+# stats = instrument.enable(instrument.Aggregator(), instrument.JsonLinesSink("events.jsonl"))[0]
+# ... run the classifier ...
+# instrument.disable()
+# stats.print_summary()
+# ```
+#
+# Durations are wall clock time. CUDA kernels run asynchronously, so their
+# time shows up in the stage that copies results to the CPU.
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+_sinks = []
+
+
+# Spans
+# -----
+
+class _NullSpan():
+    """Returned by `span` while instrumentation is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __bool__(self):
+        return False
+
+    def set(self, **fields):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Span():
+    """Times a block of code and sends an event to every sink on exit.
+
+    Fields can be added inside the block with `set`, e.g. the shape of a
+    tensor once it exists.
+    """
+    __slots__ = ('stage', 'fields', '_start', '_contexts')
+
+    def __init__(self, stage: str, fields: dict):
+        self.stage = stage
+        self.fields = fields
+        self._contexts = [sink.span_context(stage) for sink in _sinks if hasattr(sink, 'span_context')]
+
+    def __enter__(self):
+        for context in self._contexts:
+            context.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self._start
+        for context in reversed(self._contexts):
+            context.__exit__(*exc)
+        event = {'stage': self.stage, 'start': time.time() - duration, 'duration': duration, **self.fields}
+        for sink in _sinks:
+            sink.record(event)
+        return False
+
+    def __bool__(self):
+        return True
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+def span(stage: str, **fields):
+    """Context manager timing one stage (a no-op unless a sink is enabled).
+
+    Common fields: `records` (number of records processed), `shape` (of the
+    main tensor), `bytes` (read from disk).
+    """
+    if not _sinks:
+        return _NULL_SPAN
+    return Span(stage, fields)
+
+def enabled() -> bool:
+    return bool(_sinks)
+
+def enable(*sinks) -> list:
+    """Send events to `sinks` (added to any sinks already enabled). Returns `sinks`."""
+    for sink in sinks:
+        if hasattr(sink, 'open'):
+            sink.open()
+        _sinks.append(sink)
+    return list(sinks)
+
+def disable():
+    """Remove (and close) every sink"""
+    while _sinks:
+        sink = _sinks.pop()
+        if hasattr(sink, 'close'):
+            sink.close()
+
+def flush():
+    """Write buffered events of every sink (e.g. before forking workers)"""
+    for sink in _sinks:
+        if hasattr(sink, 'flush'):
+            sink.flush()
+
+def sinks() -> list:
+    return list(_sinks)
+
+
+# Sinks
+# -----
+
+class Aggregator():
+    """In-memory totals per stage: calls, time, records, bytes and shapes.
+
+    Totals from other processes (`state()` of their own aggregator) can be
+    added with `merge`.
+    """
+    MAX_SHAPES = 8      # Distinct shapes kept per stage
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, event: dict):
+        with self._lock:
+            stats = self.stages.get(event['stage'])
+            if stats is None:
+                stats = self.stages[event['stage']] = {
+                    'calls': 0, 'seconds': 0., 'max_seconds': 0., 'records': 0, 'bytes': 0, 'shapes': [],
+                }
+            stats['calls'] += 1
+            stats['seconds'] += event['duration']
+            stats['max_seconds'] = max(stats['max_seconds'], event['duration'])
+            stats['records'] += event.get('records', 0)
+            stats['bytes'] += event.get('bytes', 0)
+            shape = event.get('shape')
+            if shape is not None:
+                shape = list(shape)
+                if shape not in stats['shapes'] and len(stats['shapes']) < self.MAX_SHAPES:
+                    stats['shapes'].append(shape)
+
+    def state(self) -> Dict[str, dict]:
+        """Totals so far (picklable / JSON serializable)"""
+        with self._lock:
+            return json.loads(json.dumps(self.stages))
+
+    def reset(self) -> Dict[str, dict]:
+        """Totals so far, then start again from zero"""
+        with self._lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages: Dict[str, dict]):
+        with self._lock:
+            for name, other in stages.items():
+                stats = self.stages.setdefault(name, {
+                    'calls': 0, 'seconds': 0., 'max_seconds': 0., 'records': 0, 'bytes': 0, 'shapes': [],
+                })
+                for key in ('calls', 'seconds', 'records', 'bytes'):
+                    stats[key] += other[key]
+                stats['max_seconds'] = max(stats['max_seconds'], other['max_seconds'])
+                for shape in other['shapes']:
+                    if shape not in stats['shapes'] and len(stats['shapes']) < self.MAX_SHAPES:
+                        stats['shapes'].append(shape)
+
+    def summary(self) -> List[dict]:
+        """One row per stage, slowest first"""
+        total = sum(stats['seconds'] for stats in self.stages.values()) or 1.
+        rows = []
+        for name, stats in self.stages.items():
+            rows.append({
+                'stage': name,
+                'calls': stats['calls'],
+                'records': stats['records'],
+                'seconds': stats['seconds'],
+                'percent': 100 * stats['seconds'] / total,
+                'mean_ms': 1000 * stats['seconds'] / stats['calls'],
+                'max_ms': 1000 * stats['max_seconds'],
+                'records_per_s': stats['records'] / stats['seconds'] if stats['records'] and stats['seconds'] else None,
+                'mb': stats['bytes'] / 2**20,
+                'shapes': stats['shapes'],
+            })
+        return sorted(rows, key=lambda row: -row['seconds'])
+
+    def print_summary(self):
+        print(f"{'stage':<12} {'calls':>7} {'records':>8} {'time (s)':>9} {'%':>6} {'mean (ms)':>10} "
+              f"{'max (ms)':>9} {'records/s':>10} {'MB':>8}  shapes")
+        for row in self.summary():
+            rate = f"{row['records_per_s']:10.1f}" if row['records_per_s'] is not None else f"{'':>10}"
+            shapes = ' '.join('x'.join(map(str, shape)) for shape in row['shapes'][:3])
+            print(f"{row['stage']:<12} {row['calls']:7d} {row['records']:8d} {row['seconds']:9.2f} {row['percent']:6.1f} "
+                  f"{row['mean_ms']:10.2f} {row['max_ms']:9.2f} {rate} {row['mb']:8.1f}  {shapes}")
+
+class JsonLinesSink():
+    """Every event as one line of JSON, appended to `path`.
+
+    Lines are buffered and written with a single `write` on an `O_APPEND`
+    file, so worker processes can share the file (call `flush` before
+    forking, and in each worker before it returns results).
+    """
+    def __init__(self, path: Path, buffer_size: int=256):
+        self.path = Path(path)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def record(self, event: dict):
+        line = json.dumps({**event, 'pid': os.getpid()}, default=str) + '\n'
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.buffer_size:
+                self._write()
+
+    def _write(self):
+        if self._buffer:
+            os.write(self._fd, ''.join(self._buffer).encode())
+            self._buffer = []
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def close(self):
+        if self._fd is not None:
+            self.flush()
+            os.close(self._fd)
+            self._fd = None
+
+class TorchProfilerSink():
+    """Runs `torch.profiler` while enabled, with a labelled range for every
+    span, and exports a Chrome trace (chrome://tracing, Perfetto) on close.
+
+    Only profiles the process that enabled it (not worker processes).
+    """
+    def __init__(self, trace_path: Path, record_shapes: bool=True, profile_memory: bool=False):
+        self.trace_path = Path(trace_path)
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self._profiler = None
+
+    def open(self):
+        import torch
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(
+            activities=activities, record_shapes=self.record_shapes, profile_memory=self.profile_memory,
+        )
+        self._profiler.__enter__()
+        self._pid = os.getpid()
+
+    def span_context(self, stage: str):
+        import torch
+        return torch.profiler.record_function(stage)
+
+    def record(self, event: dict):
+        pass
+
+    def close(self):
+        if self._profiler is None or os.getpid() != self._pid:
+            return
+        self._profiler.__exit__(None, None, None)
+        self._profiler.export_chrome_trace(str(self.trace_path))
+        self._profiler = None
+
+def for_worker_process(aggregator: Aggregator):
+    """In a worker process: keep JSON-lines sinks (inherited when forked, or
+    enabled by the worker), replace every other sink by `aggregator` (whose
+    `reset()` the worker sends back to the parent, e.g. with its results).
+    """
+    inherited = [sink for sink in _sinks if isinstance(sink, JsonLinesSink)]
+    for sink in inherited:
+        sink._buffer = []   # Already flushed by the parent
+    _sinks[:] = inherited + [aggregator]
@@ -0,0 +1,374 @@
+# Batched preprocessing of recordings, without a dataset per record
+#
+# The challenge entry preprocesses each recording by putting it in
+# `data_cfg.data` and building a one-record dataset with
+# `get_dataset_from_configs`. `BatchPreprocessor` applies the resampling,
+# filtering and scaling of `preprocess.json` to a whole batch instead:
+# - recordings are grouped by sampling rate, and recordings of similar length
+#   are zero-padded into one array and resampled together (`resample_poly`
+#   pads with zeros anyway, so the result is the same)
+# - the anti-aliasing filter of each resampling ratio, and the band-pass /
+#   notch filters of each sampling rate, are designed once and cached
+#
+# Options read from `preprocess.json` (or the `PreprocessConfig` attributes of
+# the same name):
+# ```
+# {"fs": 500, "bandpass": [0.5, 40], "filter_order": 4, "notch": 50, "scale": 0.1}
+# ```
+# `fs` is the sampling rate after resampling; `bandpass` ([low, high] Hz,
+# zero-phase Butterworth) and `notch` (Hz) are optional; signals are
+# multiplied by `scale`.
+#
+# The options may not describe everything dsail's preprocessing does, so the
+# first batch is also preprocessed record by record, and the engine is only
+# used if both agree (otherwise a warning is printed and every batch takes
+# the per-record path). Fields other than the signal (flags, labels) are
+# still built per record, by `get_dataset_from_configs` on the first second
+# of each recording, and the first batch also checks that they match the
+# fields of the full recording. `load_12ECG_model` only uses the engine with
+# `batch_preprocess=True`.
+#
+# `python -m src.preprocess` compares both paths on local records.
+
+import argparse
+import copy
+import json
+import threading
+import time
+from fractions import Fraction
+from functools import lru_cache
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+from scipy import signal as sps
+from dsail.data import get_dataset_from_configs
+
+PREPROCESS_CONFIG = "preprocess.json"
+
+
+class PreprocessSpec(NamedTuple):
+    fs: float                                       # Sampling rate after resampling
+    bandpass: Optional[Tuple[float, float]] = None  # Hz
+    filter_order: int = 4
+    notch: Optional[float] = None                   # Hz
+    notch_q: float = 30.
+    scale: float = 1.
+
+def read_preprocess_spec(path: Path, preprocess_cfg=None, default_fs: float=500) -> PreprocessSpec:
+    """Options of `preprocess.json` at `path` (any missing ones from the
+    attributes of `preprocess_cfg`, then the defaults)
+    """
+    options = {}
+    if path is not None and Path(path).exists():
+        with open(path, 'r') as f:
+            options = json.load(f)
+
+    def option(name, default):
+        value = options.get(name, getattr(preprocess_cfg, name, None))
+        return default if value is None else value
+
+    bandpass = option('bandpass', None)
+    return PreprocessSpec(
+        fs=float(option('fs', default_fs)),
+        bandpass=tuple(float(f) for f in bandpass) if bandpass is not None else None,
+        filter_order=int(option('filter_order', 4)),
+        notch=float(option('notch', 0)) or None,
+        notch_q=float(option('notch_q', 30.)),
+        scale=float(option('scale', 1.)),
+    )
+
+
+# Filters
+# -------
+
+def record_fs(header: List[str]) -> float:
+    """Sampling rate on the first line of a WFDB header"""
+    return float(header[0].split()[2].split('/')[0])
+
+@lru_cache(maxsize=None)
+def resample_ratio(fs_in: float, fs_out: float) -> Tuple[int, int]:
+    """(up, down) factors of a polyphase resampler from `fs_in` to `fs_out`"""
+    ratio = Fraction(fs_out).limit_denominator(10**6) / Fraction(fs_in).limit_denominator(10**6)
+    return ratio.numerator, ratio.denominator
+
+@lru_cache(maxsize=None)
+def resample_window(up: int, down: int) -> np.ndarray:
+    """Anti-aliasing FIR filter `resample_poly` designs for (up, down)"""
+    max_rate = max(up, down)
+    h = sps.firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+    h.flags.writeable = False
+    return h
+
+@lru_cache(maxsize=None)
+def bandpass_sos(fs: float, low: float, high: float, order: int) -> np.ndarray:
+    return sps.butter(order, [low, high], btype='bandpass', fs=fs, output='sos')
+
+@lru_cache(maxsize=None)
+def notch_ba(fs: float, freq: float, q: float) -> Tuple[np.ndarray, np.ndarray]:
+    return sps.iirnotch(freq, q, fs=fs)
+
+
+# Engine
+# ------
+
+def _length_buckets(lengths: List[int], indices: List[int], max_padding: float):
+    """`indices` sorted by length and split so that no recording is padded by
+    more than `max_padding` (fraction of its length)
+    """
+    bucket = []
+    for i in sorted(indices, key=lambda i: lengths[i]):
+        if bucket and lengths[i] > lengths[bucket[0]] * (1 + max_padding):
+            yield bucket
+            bucket = []
+        bucket.append(i)
+    if bucket:
+        yield bucket
+
+def preprocess_signals(data_list: List[np.ndarray], fs_list: List[float], spec: PreprocessSpec,
+                       max_padding: float=0.25) -> List[np.ndarray]:
+    """Resampled, filtered and scaled (leads, samples) float64 signals"""
+    lengths = [data.shape[-1] for data in data_list]
+    outputs = [None] * len(data_list)
+
+    # Resample recordings of each sampling rate (and number of leads) together
+    groups = {}
+    for i, (data, fs) in enumerate(zip(data_list, fs_list)):
+        groups.setdefault((fs, data.shape[0]), []).append(i)
+    for (fs, num_leads), indices in groups.items():
+        up, down = resample_ratio(fs, spec.fs)
+        if up == down:
+            for i in indices:
+                outputs[i] = np.asarray(data_list[i], dtype=np.float64)
+            continue
+        for bucket in _length_buckets(lengths, indices, max_padding):
+            stacked = np.zeros((len(bucket), num_leads, max(lengths[i] for i in bucket)))
+            for j, i in enumerate(bucket):
+                stacked[j, :, :lengths[i]] = data_list[i]
+            stacked = sps.resample_poly(stacked, up, down, axis=-1, window=resample_window(up, down))
+            for j, i in enumerate(bucket):
+                n_out = -(-lengths[i] * up // down)
+                outputs[i] = stacked[j, :, :n_out]
+
+    # Filters don't treat padding like the end of a recording: filter
+    # recordings of exactly the same length together
+    if spec.bandpass is not None or spec.notch is not None:
+        same_length = {}
+        for i, output in enumerate(outputs):
+            same_length.setdefault(output.shape, []).append(i)
+        for indices in same_length.values():
+            stacked = np.stack([outputs[i] for i in indices])
+            if spec.bandpass is not None:
+                stacked = sps.sosfiltfilt(bandpass_sos(spec.fs, *spec.bandpass, spec.filter_order), stacked, axis=-1)
+            if spec.notch is not None:
+                stacked = sps.filtfilt(*notch_ba(spec.fs, spec.notch, spec.notch_q), stacked, axis=-1)
+            for j, i in enumerate(indices):
+                outputs[i] = stacked[j]
+
+    if spec.scale != 1:
+        outputs = [output * spec.scale for output in outputs]
+    return outputs
+
+def dataset_samples(data_list: List[np.ndarray], header_list: List[List[str]], data_cfg, preprocess_cfg) -> list:
+    """Items of `get_dataset_from_configs`, one dataset per recording (the
+    challenge entry's preprocessing)
+    """
+    data_cfg = copy.copy(data_cfg)
+    samples = []
+    for data, header in zip(data_list, header_list):
+        data_cfg.data = data
+        data_cfg.header = header
+        dataset = get_dataset_from_configs(data_cfg, preprocess_cfg)
+        samples.extend(dataset[i] for i in range(len(dataset)))
+    return samples
+
+def _as_array(x) -> Optional[np.ndarray]:
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    if isinstance(x, np.ndarray):
+        return x
+    return None
+
+def _same_field(a, b) -> bool:
+    a_array, b_array = _as_array(a), _as_array(b)
+    if a_array is not None or b_array is not None:
+        return (a_array is not None and b_array is not None and a_array.shape == b_array.shape
+                and a_array.dtype == b_array.dtype and np.array_equal(a_array, b_array))
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+class BatchPreprocessor():
+    """Drop-in replacement for `dataset_samples`, taking the place of
+    `preprocess_cfg` in the `eval_list` of `load_12ECG_model`.
+
+    The first time a batch has recordings of a new (sampling rate, leads)
+    group, up to `check_records` of them are also preprocessed by
+    `get_dataset_from_configs`. If every signal agrees within `atol` (+
+    `rtol` of the signal's scale), and the other item fields of each
+    recording match those built from its first `probe_seconds`, the engine
+    is used for that group from then on. Otherwise every batch is
+    preprocessed record by record.
+    """
+    def __init__(self, preprocess_cfg, spec: PreprocessSpec, check_records: int=8,
+                 rtol: float=1e-5, atol: float=1e-6, probe_seconds: float=1.):
+        self.config = preprocess_cfg
+        self.spec = spec
+        self.check_records = check_records
+        self.rtol, self.atol = rtol, atol
+        self.probe_seconds = probe_seconds
+        self.verified = None            # None until the first batch, False once any group doesn't match
+        self.verified_groups = set()    # (fs, leads) of recordings checked so far
+        self.max_difference = None
+        self._signal_like = None        # Signal field of the per-record path (type of each output)
+        self._signal_index = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def samples(self, data_list: List[np.ndarray], header_list: List[List[str]], data_cfg) -> list:
+        """Preprocessed items (like `dataset_samples`) of a batch of recordings"""
+        fs_list = [record_fs(h) for h in header_list]
+        groups = [(fs, np.shape(data)[0]) for fs, data in zip(fs_list, data_list)]
+        if self.verified is not False and not self.verified_groups.issuperset(groups):
+            with self._lock:
+                for group in dict.fromkeys(groups):
+                    if self.verified is False:
+                        break
+                    if group in self.verified_groups:
+                        continue
+                    members = [i for i, g in enumerate(groups) if g == group][:self.check_records]
+                    self._verify([data_list[i] for i in members], [header_list[i] for i in members], data_cfg)
+                    if self.verified:
+                        self.verified_groups.add(group)
+        if not self.verified:
+            return dataset_samples(data_list, header_list, data_cfg, self.config)
+
+        outputs = preprocess_signals(list(data_list), fs_list, self.spec)
+        index, like = self._signal_index, self._signal_like
+        samples = []
+        for item, output in zip(self._fields(data_list, header_list, data_cfg), outputs):
+            if isinstance(like, torch.Tensor):
+                output = torch.from_numpy(output.astype(np.float32 if like.dtype == torch.float32 else np.float64))
+            else:
+                output = output.astype(like.dtype)
+            samples.append((*item[:index], output, *item[index + 1:]))
+        return samples
+
+    def _fields(self, data_list, header_list, data_cfg) -> list:
+        # Items of the first `probe_seconds` of each recording: every field
+        # but the signal is that of the recording, at a fraction of the cost
+        probes = [np.asarray(data)[:, :max(1, int(np.ceil(self.probe_seconds * record_fs(header))))]
+                  for data, header in zip(data_list, header_list)]
+        return dataset_samples(probes, header_list, data_cfg, self.config)
+
+    def _verify(self, data_list, header_list, data_cfg):
+        expected = []
+        for data, header in zip(data_list, header_list):
+            items = dataset_samples([data], [header], data_cfg, self.config)
+            if len(items) != 1:
+                return self._disable(f"{len(items)} dataset items per recording")
+            expected.append(items[0])
+        outputs = preprocess_signals(list(data_list), [record_fs(h) for h in header_list], self.spec)
+
+        if self._signal_index is None:
+            # The signal is the item field with the shape of the engine's output
+            candidates = [i for i, x in enumerate(expected[0])
+                          if _as_array(x) is not None and _as_array(x).shape == outputs[0].shape]
+            if len(candidates) != 1:
+                return self._disable(f"no item field matches the shape {outputs[0].shape} of the preprocessed signal")
+            self._signal_index = candidates[0]
+            self._signal_like = expected[0][self._signal_index]
+        index = self._signal_index
+
+        try:
+            fields = self._fields(data_list, header_list, data_cfg)
+        except Exception as e:
+            return self._disable(f"item fields of the first {self.probe_seconds:g} s failed: {e}")
+        if len(fields) != len(expected):
+            return self._disable(f"{len(fields)} dataset items for {len(expected)} recordings")
+
+        difference = self.max_difference or 0.
+        for item, probe, output in zip(expected, fields, outputs):
+            if len(item) != len(probe):
+                return self._disable(f"{len(probe)} item fields instead of {len(item)}")
+            for i, (field, probe_field) in enumerate(zip(item, probe)):
+                if i != index and not _same_field(field, probe_field):
+                    return self._disable(f"item field {i} depends on more than the first {self.probe_seconds:g} s")
+            reference = _as_array(item[index]).astype(np.float64)
+            if reference.shape != output.shape:
+                return self._disable(f"shape {output.shape} instead of {reference.shape}")
+            tolerance = self.atol + self.rtol * np.max(np.abs(reference), initial=0.)
+            difference = max(difference, float(np.max(np.abs(reference - output), initial=0.)))
+            if difference > tolerance:
+                return self._disable(f"signals differ by up to {difference:.3g}")
+
+        self.max_difference = difference
+        self.verified = True
+
+    def _disable(self, reason: str):
+        print(f"WARNING: Batched preprocessing ({self.spec}) doesn't match get_dataset_from_configs ({reason}); "
+              f"preprocessing record by record")
+        self.verified = False
+
+def apply_preprocess(eval_list, config_dir: Path, check_records: int=8):
+    """`eval_list` from `load_12ECG_model`, preprocessing whole batches with
+    the options in `preprocess.json`
+    """
+    data_cfg, preprocess_cfg = eval_list[0], eval_list[1]
+    if isinstance(preprocess_cfg, BatchPreprocessor):
+        return eval_list
+    spec = read_preprocess_spec(Path(config_dir) / PREPROCESS_CONFIG, preprocess_cfg,
+                                default_fs=getattr(data_cfg, 'fs', None) or 500)
+    engine = BatchPreprocessor(preprocess_cfg, spec, check_records)
+    return [data_cfg, engine, *eval_list[2:]]
+
+def preprocess_config(preprocess_cfg):
+    """dsail's `PreprocessConfig`, whether or not it's wrapped by a `BatchPreprocessor`"""
+    return preprocess_cfg.config if isinstance(preprocess_cfg, BatchPreprocessor) else preprocess_cfg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare batched preprocessing with get_dataset_from_configs.')
+    parser.add_argument('config_dir', type=Path, help='directory with data.json, preprocess.json etc.')
+    parser.add_argument('dataset_dir', type=Path, help='records to compare on')
+    parser.add_argument('--records', type=int, default=500, help='number of records to compare on')
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    import dsail.config as config
+    from PhysioNet2020_driver import load_challenge_data
+    from src.data.records import iter_records
+
+    data_cfg = config.DataConfig(args.config_dir / "data.json")
+    preprocess_cfg = config.PreprocessConfig(args.config_dir / PREPROCESS_CONFIG)
+    engine = apply_preprocess([data_cfg, preprocess_cfg, None, None, None], args.config_dir,
+                              check_records=args.batch_size)[1]
+    print(engine.spec)
+
+    loaded = [load_challenge_data(r.path) for _, r in zip(range(args.records), iter_records(args.dataset_dir))]
+    data, headers = [d for d, _ in loaded], [h for _, h in loaded]
+
+    seconds = {}
+    for name, run in (("per-record", lambda d, h: dataset_samples(d, h, data_cfg, preprocess_cfg)),
+                      ("batched", lambda d, h: engine.samples(d, h, data_cfg))):
+        run(data[:args.batch_size], headers[:args.batch_size])     # Warm up (and verify)
+        start = time.perf_counter()
+        for i in range(0, len(data), args.batch_size):
+            run(data[i:i + args.batch_size], headers[i:i + args.batch_size])
+        seconds[name] = time.perf_counter() - start
+
+    if engine.verified:
+        print(f"Batched preprocessing matches (max |diff| {engine.max_difference:.3g})")
+    for name, s in seconds.items():
+        print(f"    {name:<10} {len(data) / s:10.1f} records/s")
+    print(f"    speedup    {seconds['per-record'] / seconds['batched']:10.2f}x")
@@ -5,25 +5,52 @@ import os
 import numpy as np
 from collections import OrderedDict
 from pathlib import Path
+from typing import List
 
 import torch
 
 import dsail.config as config
-from dsail.data import get_dataset_from_configs, collate_into_list, get_loss_weights_and_flags
+from dsail.data import collate_into_list, get_loss_weights_and_flags
 from dsail.model.model_utils import get_model
-from dsail.train import Trainer
 
+from src import instrument
+from src.backends import apply_backend
+from src.ensemble import (
+    NUM_FOLDS, EnsembleModel, checkpoint_hash, default_cache_dir, load_ensemble_cache, save_ensemble_cache
+)
+from src.preprocess import BatchPreprocessor, apply_preprocess, dataset_samples
+from src.train import evaluate, evaluate_stream
 
-def load_12ECG_model(output_training_directory, config_dir: Path):
+
+def load_12ECG_model(output_training_directory, config_dir: Path, cache_dir: Path=None, use_cache: bool=True,
+                     backend: str=None, batch_preprocess: bool=False):
     # load the model from disk
+    # `backend` overrides the inference backend in config_dir/backend.json (see src.backends)
+    # `batch_preprocess` preprocesses whole batches at once, if that matches dsail's preprocessing (see src.preprocess);
+    # off by default, as the options it reads from preprocess.json aren't checked against dsail's config
     data_cfg = config.DataConfig(config_dir / "data.json")
     preprocess_cfg = config.PreprocessConfig(config_dir / "preprocess.json")
     model_cfg = config.ModelConfig(config_dir / "model.json")
     run_cfg = config.RunConfig(config_dir / "run.json")
 
-    models, thresholds = [], []
-    for fold in range(10):
+    models = []
+    for fold in range(NUM_FOLDS):
         model, _ = get_model(model_cfg, data_cfg.num_channels, len(data_cfg.scored_classes))
+        models.append(model)
+
+    # Warm start: pre-merged weights of every fold, keyed by checkpoint hash
+    if cache_dir is None:
+        cache_dir = default_cache_dir(output_training_directory)
+    cache_path = Path(cache_dir) / checkpoint_hash(output_training_directory)
+    if use_cache and (cache_path / "index.json").exists():
+        stacked, thresholds = load_ensemble_cache(cache_path)
+        ensemble = EnsembleModel(models, stacked)
+        eval_list = [data_cfg, preprocess_cfg, run_cfg, ensemble, thresholds]
+        eval_list = apply_backend(eval_list, config_dir, backend)
+        return apply_preprocess(eval_list, config_dir) if batch_preprocess else eval_list
+
+    thresholds = []
+    for fold, model in enumerate(models):
         checkpoint = torch.load(os.path.join(output_training_directory, 'finalized_model_%d.sav' % fold),
                                 map_location=torch.device("cpu"))
         state_dict = OrderedDict()
@@ -31,48 +58,108 @@ def load_12ECG_model(output_training_directory, config_dir: Path):
             if k.startswith("module."): k = k[7:]
             state_dict[k] = v
         model.load_state_dict(state_dict, strict=False)
-        models.append(model)
 
         threshold = np.load(os.path.join(output_training_directory, 'finalized_model_thresholds_%d.npy' % fold))
         thresholds.append(threshold)
 
     thresholds = np.average(np.stack(thresholds, axis=0), axis=0)
-    eval_list = [data_cfg, preprocess_cfg, run_cfg, models, thresholds]
+    ensemble = EnsembleModel(models)
 
-    return eval_list
+    if use_cache:
+        try:
+            save_ensemble_cache(cache_path, ensemble.stacked_state_dict(), thresholds)
+        except OSError as e:
+            print(f"WARNING: Couldn't write ensemble cache to {cache_path} ({e})")
+
+    eval_list = [data_cfg, preprocess_cfg, run_cfg, ensemble, thresholds]
+    eval_list = apply_backend(eval_list, config_dir, backend)
+
+    return apply_preprocess(eval_list, config_dir) if batch_preprocess else eval_list
 
 
 def run_12ECG_classifier(data, header, eval_list):
     # Use your classifier here to obtain a label and score for each class.
-    data_cfg, preprocess_cfg, run_cfg, models, thresholds = eval_list
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    data_cfg.data = data
-    data_cfg.header = header
-    dataset_val = get_dataset_from_configs(data_cfg, preprocess_cfg)
-    iterator_val = torch.utils.data.DataLoader(dataset_val, 1, collate_fn=collate_into_list)
+    labels, scores, classes = run_12ECG_classifier_batch([data], [header], eval_list)
+    return labels[0], scores[0], classes
 
-    outputs_list = []
-    for model in models:
-        loss_weights_and_flags = get_loss_weights_and_flags(data_cfg, run_cfg)
-        trainer = Trainer(model, data_cfg, run_cfg.multilabel, loss_weights_and_flags)
-        trainer.set_device(device, data_parallel=False)
 
-        for B, batch in enumerate(iterator_val):
-            trainer.evaluate(batch)
+def preprocess_batch(data_list: List[np.ndarray], header_list: List[List[str]], eval_list):
+    """Preprocessed recordings as one batch (`collate_into_list`), for `ensemble_outputs`"""
+    data_cfg, preprocess_cfg = eval_list[0], eval_list[1]
+    with instrument.span("preprocess", records=len(data_list)):
+        if isinstance(preprocess_cfg, BatchPreprocessor):
+            samples = preprocess_cfg.samples(data_list, header_list, data_cfg)
+        else:
+            samples = dataset_samples(data_list, header_list, data_cfg, preprocess_cfg)
+        return collate_into_list(samples)
 
-        outputs = trainer.logger_eval.scalar_outputs[0][0]
-        outputs_list.append(outputs)
 
+def ensemble_outputs(batch, eval_list, micro_batch_size: int=None):
+    """Scores of each network of the ensemble for a batch from `preprocess_batch`,
+    shape (folds, records, classes)
+    """
+    data_cfg, preprocess_cfg, run_cfg, models, thresholds = eval_list
+    device = torch.device("cuda" if torch.cuda.is_available() and not getattr(models, "cpu_only", False) else "cpu")
+    loss_weights_and_flags = get_loss_weights_and_flags(data_cfg, run_cfg)
+    if micro_batch_size is None:
+        run = evaluate
+    else:
+        run = lambda *args: evaluate_stream(*args, micro_batch_size=micro_batch_size)
+
+    if isinstance(models, EnsembleModel):
+        return run(models, batch, device, loss_weights_and_flags)
+    return torch.stack([run(model, batch, device, loss_weights_and_flags) for model in models])
+
+
+def _iter_fold_outputs(data_list: List[np.ndarray], header_list: List[List[str]], eval_list, batch_size: int=32,
+                       micro_batch_size: int=None):
+    # Yields (start, stop, scores of each network with shape (folds, records, classes))
+    num_records = len(data_list)
+    for start in range(0, num_records, batch_size):
+        stop = min(start + batch_size, num_records)
+        batch = preprocess_batch(data_list[start:stop], header_list[start:stop], eval_list)
+        yield start, stop, ensemble_outputs(batch, eval_list, micro_batch_size)
+
+
+def run_12ECG_classifier_batch(data_list: List[np.ndarray], header_list: List[List[str]], eval_list, batch_size: int=32,
+                               micro_batch_size: int=None):
+    """Classify many recordings at once with every network in the ensemble.
+
+    Recordings are preprocessed and chunked (`collate_into_block`) 
+    `batch_size` at a time, so the per-record setup cost of the challenge 
+    entry (a new DataLoader and Trainer for every fold) is only paid once.
+
+    If `micro_batch_size` is given, chunks are evaluated in micro-batches of 
+    that size (`evaluate_stream`), so memory doesn't grow with recording 
+    length (e.g. Holter recordings).
+
+    Returns an (N, classes) array of thresholded labels, an (N, classes) 
+    array of scores averaged over the ensemble, and the list of classes.
+    """
+    data_cfg, thresholds = eval_list[0], eval_list[4]
     classes = data_cfg.scored_classes
-    num_classes = len(classes)
-    current_label = np.zeros(num_classes, dtype=int)
-    current_score = np.zeros(num_classes)
-    for i in range(num_classes):
-        for j in range(len(outputs_list)):
-            current_score[i] += outputs_list[j][i]
-        current_score[i] = current_score[i] / len(outputs_list)
-        if current_score[i] > thresholds[i]: current_label[i] = 1
+    current_score = np.zeros((len(data_list), len(classes)))
+
+    for start, stop, outputs in _iter_fold_outputs(data_list, header_list, eval_list, batch_size, micro_batch_size):
+        with instrument.span("average", records=stop - start, shape=tuple(outputs.shape)):
+            current_score[start:stop] = outputs.mean(dim=0).cpu().numpy()
+
+    current_label = (current_score > thresholds).astype(int)
 
     return current_label, current_score, classes
 
+
+def run_12ECG_classifier_folds(data_list: List[np.ndarray], header_list: List[List[str]], eval_list, batch_size: int=32,
+                               micro_batch_size: int=None):
+    """Scores of every network in the ensemble, before averaging.
+
+    Returns a (folds, N, classes) float32 array and the list of classes 
+    (e.g. for `src.thresholds`).
+    """
+    classes = eval_list[0].scored_classes
+    fold_scores = np.zeros((len(eval_list[3]), len(data_list), len(classes)), dtype=np.float32)
+
+    for start, stop, outputs in _iter_fold_outputs(data_list, header_list, eval_list, batch_size, micro_batch_size):
+        fold_scores[:, start:stop] = outputs.cpu().numpy()
+
+    return fold_scores, classes
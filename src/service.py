@@ -0,0 +1,393 @@
+# Local scoring service for the DSAIL_SNU ensemble
+#
+# Loads the ensemble once (`load_12ECG_model`) and classifies recordings sent
+# over HTTP, on a TCP port or a Unix socket. Concurrent requests are queued
+# and coalesced into micro-batches (`run_12ECG_classifier_batch`): a batch is
+# started once it is full, or when its oldest request has waited
+# `max_latency` seconds. Batches run on a thread pool, so the event loop
+# keeps accepting and answering requests while the model runs.
+#
+# Endpoints:
+# - POST /classify  {"signal": [[...], ...], "header": "<.hea text>"}
+#                   or {"signal_b64": "<float32 bytes>", "shape": [12, N], "header": ...}
+#                   -> {"labels": [...], "scores": [...], "classes": [...]}
+# - GET  /stats     request/batch counts, batch sizes and latency percentiles
+# - GET  /health
+#
+# Example usage:
+# ```
+# python -m src.service checkpoints/original config --port 8080
+# python -m src.service checkpoints/original config --unix /tmp/ecg.sock
+# ```
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from src.backends import BACKENDS
+from src.preprocess import record_fs
+from src.run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier_batch
+
+MAX_BODY_SIZE = 256 * 2**20
+NUM_LEADS = 12      # The ensemble classifies 12-lead recordings
+
+
+# Micro-batching
+# --------------
+
+class MicroBatcher():
+    """Coalesces single-recording requests into batches for the ensemble.
+
+    `await batcher.classify(data, header)` returns (labels, scores) for one
+    recording, the same as `run_12ECG_classifier`. Up to `workers` batches
+    run at once, each on its own thread. If a batch fails, its recordings
+    are classified one at a time, so only the bad ones fail.
+    """
+    def __init__(self, eval_list, max_batch_size: int=32, max_latency: float=0.01, workers: int=1,
+                 micro_batch_size: int=None, window: int=10000):
+        self.eval_list = eval_list
+        self.classes = list(eval_list[0].scored_classes)
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.micro_batch_size = micro_batch_size
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="classify")
+        self._slots = asyncio.Semaphore(workers)
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._running = set()   # Tasks of batches being classified
+
+        # Statistics (latencies of the last `window` requests)
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.compute_times = deque(maxlen=window)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """Stop batching: finish the running batches, fail queued requests"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.gather(*self._running, return_exceptions=True)
+        while not self._queue.empty():
+            self._fail([self._queue.get_nowait()], RuntimeError("The service is shutting down"))
+        self._executor.shutdown(wait=True)
+
+    def _fail(self, batch, error: Exception):
+        for *_, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def classify(self, data: np.ndarray, header: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((time.perf_counter(), data, header, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                deadline = batch[0][0] + self.max_latency
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Anything that arrived meanwhile joins this batch (no extra wait)
+                while len(batch) < self.max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+
+                await self._slots.acquire()
+                task = loop.create_task(self._classify_batch(batch))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                batch = []
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError("The service is shutting down"))
+            raise
+
+    def _compute(self, data_list, header_list):
+        start = time.perf_counter()
+        labels, scores, _ = run_12ECG_classifier_batch(
+            data_list, header_list, self.eval_list, batch_size=len(data_list), micro_batch_size=self.micro_batch_size
+        )
+        return labels, scores, time.perf_counter() - start
+
+    def _compute_each(self, data_list, header_list):
+        # After a batch failed: (labels, scores) or the exception of each recording
+        start = time.perf_counter()
+        results = []
+        for data, header in zip(data_list, header_list):
+            try:
+                labels, scores, _ = self._compute([data], [header])
+                results.append((labels[0], scores[0]))
+            except Exception as e:
+                results.append(e)
+        return results, time.perf_counter() - start
+
+    async def _classify_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        data_list, header_list = [b[1] for b in batch], [b[2] for b in batch]
+        try:
+            try:
+                labels, scores, compute_time = await loop.run_in_executor(
+                    self._executor, self._compute, data_list, header_list
+                )
+                results = list(zip(labels, scores))
+            except Exception as e:
+                if len(batch) == 1:
+                    results, compute_time = [e], None
+                else:
+                    results, compute_time = await loop.run_in_executor(
+                        self._executor, self._compute_each, data_list, header_list
+                    )
+        finally:
+            self._slots.release()
+
+        now = time.perf_counter()
+        succeeded = sum(not isinstance(result, Exception) for result in results)
+        self.errors += len(batch) - succeeded
+        if succeeded:
+            self.batches += 1
+            self.requests += succeeded
+            self.batch_sizes.append(succeeded)
+            self.compute_times.append(compute_time)
+        for (received, _, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                if not future.done():
+                    future.set_exception(result)
+                continue
+            self.latencies.append(now - received)
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        latencies = np.asarray(self.latencies) * 1000
+        latency = {'window': len(latencies)}
+        for q in (50, 95, 99):
+            latency[f'p{q}'] = float(np.percentile(latencies, q)) if len(latencies) else None
+        return {
+            'uptime_s': time.time() - self.started,
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'queued': self._queue.qsize(),
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+            'mean_compute_ms': float(np.mean(self.compute_times)) * 1000 if self.compute_times else None,
+            'latency_ms': latency,
+            'max_batch_size': self.max_batch_size,
+            'max_latency_ms': self.max_latency * 1000,
+        }
+
+
+# HTTP
+# ----
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error"}
+
+def parse_request(body: bytes) -> Tuple[np.ndarray, List[str]]:
+    """(data, header lines) of a /classify request body"""
+    try:
+        request = json.loads(body)
+    except ValueError as e:
+        raise HTTPError(400, f"Invalid JSON ({e})")
+    if not isinstance(request, dict) or not isinstance(request.get('header'), str):
+        raise HTTPError(400, "Expected an object with 'header' (text of the .hea file)")
+
+    if 'signal_b64' in request:
+        try:
+            data = np.frombuffer(base64.b64decode(request['signal_b64']), dtype='<f4')
+            data = data.reshape(request['shape']).astype(np.float64)
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPError(400, f"Invalid 'signal_b64'/'shape' ({e})")
+    elif 'signal' in request:
+        try:
+            data = np.asarray(request['signal'], dtype=np.float64)
+        except (ValueError, TypeError) as e:
+            raise HTTPError(400, f"Invalid 'signal' ({e})")
+    else:
+        raise HTTPError(400, "Expected 'signal' (leads x samples) or 'signal_b64' and 'shape'")
+
+    header = request['header'].splitlines(keepends=True)
+    if data.ndim != 2 or data.shape[1] == 0:
+        raise HTTPError(400, f"Signal must have shape (leads, samples), got {data.shape}")
+    if data.shape[0] != NUM_LEADS:
+        raise HTTPError(400, f"Signal has {data.shape[0]} leads, expected {NUM_LEADS}")
+    if not np.all(np.isfinite(data)):
+        raise HTTPError(400, "Signal has non-finite values")
+    try:
+        num_leads = int(header[0].split()[1])
+    except (IndexError, ValueError):
+        raise HTTPError(400, "Invalid header")
+    if data.shape[0] != num_leads:
+        raise HTTPError(400, f"Signal has {data.shape[0]} leads, header has {num_leads}")
+    try:
+        fs = record_fs(header)
+    except (IndexError, ValueError):
+        raise HTTPError(400, "Header has no sampling frequency")
+    if not fs > 0:
+        raise HTTPError(400, f"Invalid sampling frequency {fs}")
+    return data, header
+
+class Service():
+    """HTTP front end of a `MicroBatcher` (HTTP/1.1, keep-alive)"""
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+
+    async def handle(self, method: str, path: str, body: bytes) -> dict:
+        if path == '/classify':
+            if method != 'POST':
+                raise HTTPError(405, "Use POST")
+            data, header = parse_request(body)
+            labels, scores = await self.batcher.classify(data, header)
+            return {
+                'labels': [int(label) for label in labels],
+                'scores': [float(score) for score in scores],
+                'classes': self.batcher.classes,
+            }
+        if path == '/stats':
+            return self.batcher.stats()
+        if path == '/health':
+            return {'status': 'ok'}
+        raise HTTPError(404, f"Unknown path {path}")
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, {'error': "Malformed request line"}, close=True)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, {'error': "Invalid Content-Length"}, close=True)
+                    break
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, {'error': "Request too large"}, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                try:
+                    status, response = 200, await self.handle(method, target.split('?')[0], body)
+                except HTTPError as e:
+                    status, response = e.status, {'error': str(e)}
+                except Exception as e:
+                    status, response = 500, {'error': f"{type(e).__name__}: {e}"}
+                await self._respond(writer, status, response, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, response: dict, close: bool=False):
+        body = json.dumps(response).encode()
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+async def serve(eval_list, host: str="127.0.0.1", port: int=8080, unix_socket: Path=None, max_batch_size: int=32,
+                max_latency: float=0.01, workers: int=1, micro_batch_size: int=None, ready: asyncio.Event=None):
+    """Run the service until cancelled"""
+    batcher = MicroBatcher(eval_list, max_batch_size, max_latency, workers, micro_batch_size)
+    batcher.start()
+    service = Service(batcher)
+    if unix_socket is not None:
+        if Path(unix_socket).exists():
+            os.unlink(unix_socket)
+        server = await asyncio.start_unix_server(service.serve_connection, path=str(unix_socket))
+        print(f"Listening on {unix_socket}")
+    else:
+        server = await asyncio.start_server(service.serve_connection, host, port)
+        print(f"Listening on http://{host}:{port}")
+    if ready is not None:
+        ready.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the 12ECG classifier over HTTP (TCP port or Unix socket).')
+    parser.add_argument('model_input', help='directory with finalized_model_*.sav checkpoints')
+    parser.add_argument('model_config', type=Path, help='directory with data.json, model.json etc.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', type=Path, default=None, help='listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--max-batch-size', type=int, default=32, help='most recordings classified together')
+    parser.add_argument('--max-latency-ms', type=float, default=10, help='longest a request waits for its batch to fill')
+    parser.add_argument('--workers', type=int, default=1, help='batches classified at the same time (threads)')
+    parser.add_argument('--threads', type=int, default=None, help='PyTorch threads (default: cores)')
+    parser.add_argument('--micro-batch-size', type=int, default=None,
+                        help='evaluate long recordings this many chunks at a time (bounded memory)')
+    parser.add_argument('--backend', choices=BACKENDS, default=None,
+                        help='inference backend (default: from model_config/backend.json, else eager)')
+    args = parser.parse_args()
+
+    import torch
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    print('Loading 12ECG model...')
+    eval_list = load_12ECG_model(args.model_input, args.model_config, backend=args.backend)
+    try:
+        asyncio.run(serve(
+            eval_list, args.host, args.port, args.unix, args.max_batch_size, args.max_latency_ms / 1000,
+            args.workers, args.micro_batch_size,
+        ))
+    except KeyboardInterrupt:
+        pass
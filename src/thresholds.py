@@ -0,0 +1,269 @@
+# Per-class decision thresholds for the DSAIL_SNU ensemble
+#
+# `load_12ECG_model` averages the thresholds stored with each fold
+# (`finalized_model_thresholds_%d.npy`). These functions find new thresholds
+# for another cohort (e.g. athletes, or after fine-tuning) from cached scores
+# and labels, and write them in the same layout.
+#
+# Both searches sort the scores of a class once and evaluate every possible
+# cut with cumulative sums, instead of re-scoring each candidate threshold.
+
+import argparse
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from src.data.header_index import read_header
+from src.data.norwegian import RELEVANT_FINDING_RULES, T_WAVE_RULES, classify_reports
+from src.data.metrics import EQUIVALENT_CLASSES, NORMAL_CLASS, challenge_score, load_weights
+from src.ensemble import NUM_FOLDS
+
+
+# Search
+# ------
+
+def _cuts(sorted_scores: np.ndarray) -> np.ndarray:
+    # Valid numbers of positives when thresholding descending scores: 0, N
+    # and every position between two different scores (ties go together)
+    inner = np.flatnonzero(sorted_scores[:-1] != sorted_scores[1:]) + 1
+    return np.concatenate([[0], inner, [len(sorted_scores)]])
+
+def _threshold_for_cut(sorted_scores: np.ndarray, k: int) -> float:
+    # Threshold such that `scores > threshold` are the first k (descending)
+    if k == 0:
+        return float(sorted_scores[0])
+    if k == len(sorted_scores):
+        return float(np.nextafter(sorted_scores[-1], -np.inf))
+    return float((np.float64(sorted_scores[k - 1]) + np.float64(sorted_scores[k])) / 2)
+
+def best_f1_thresholds(labels: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """Threshold of each class that maximizes its F1 score, shape (classes,)"""
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    thresholds = np.zeros(scores.shape[1])
+    for c in range(scores.shape[1]):
+        order = np.argsort(-scores[:, c])
+        sorted_scores = scores[order, c]
+        cuts = _cuts(sorted_scores)
+        tp = np.concatenate([[0], np.cumsum(labels[order, c])])[cuts]
+        positives = tp[-1]
+        # F1 = 2 tp / (predicted + actual positives)
+        f1 = np.where(cuts + positives > 0, 2 * tp / np.maximum(cuts + positives, 1), 0)
+        thresholds[c] = _threshold_for_cut(sorted_scores, cuts[np.argmax(f1)])
+    return thresholds
+
+def best_challenge_thresholds(labels: np.ndarray, scores: np.ndarray, weights: np.ndarray, classes: List[str],
+                              initial: np.ndarray=None, max_iter: int=10,
+                              normal_class: str=NORMAL_CLASS) -> Tuple[np.ndarray, float]:
+    """Per-class thresholds that maximize the challenge score.
+
+    Classes interact through the score's per-record normalization, so this
+    is a coordinate ascent: each class's threshold is optimized in turn with
+    the others fixed, until a full pass doesn't improve the score. Starts
+    from `initial` (default: the best F1 thresholds).
+
+    Returns the thresholds (classes,) and their challenge score.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64)
+    thresholds = best_f1_thresholds(labels, scores) if initial is None else np.array(initial, dtype=np.float64)
+    label_weights = labels @ np.asarray(weights, dtype=np.float64)
+    orders = [np.argsort(-scores[:, c]) for c in range(scores.shape[1])]
+
+    # Per record: reward (labels @ weights . outputs) and |labels U outputs|
+    outputs = scores > thresholds
+    reward = np.sum(label_weights * outputs, axis=1)
+    union = np.sum(labels | outputs, axis=1)
+
+    best = -np.inf
+    for _ in range(max_iter):
+        for c in range(scores.shape[1]):
+            # Contribution of every record with output c off/on
+            reward_rest = reward - label_weights[:, c] * outputs[:, c]
+            union_rest = union - (outputs[:, c] & ~labels[:, c])
+            off = reward_rest / np.maximum(union_rest, 1)
+            on = (reward_rest + label_weights[:, c]) / np.maximum(union_rest + ~labels[:, c], 1)
+
+            order = orders[c]
+            sorted_scores = scores[order, c]
+            cuts = _cuts(sorted_scores)
+            gain = np.concatenate([[0], np.cumsum(on[order] - off[order])])[cuts]
+            k = cuts[np.argmax(gain)]
+            thresholds[c] = _threshold_for_cut(sorted_scores, k)
+
+            outputs[:, c] = scores[:, c] > thresholds[c]
+            reward = reward_rest + label_weights[:, c] * outputs[:, c]
+            union = union_rest + (outputs[:, c] & ~labels[:, c])
+
+        score = challenge_score(labels, outputs, weights, classes, normal_class)
+        if score <= best + 1e-12:
+            break
+        best = score
+
+    return thresholds, float(best)
+
+def optimize_thresholds(labels: np.ndarray, scores: np.ndarray, metric: str="challenge",
+                        weights: np.ndarray=None, classes: List[str]=None) -> np.ndarray:
+    """Best thresholds for (records, classes) scores, or (folds, records, classes)
+    scores of each network (thresholds for every fold, shape (folds, classes)).
+
+    `metric` is "challenge" (needs `weights` and `classes`) or "f1".
+    """
+    scores = np.asarray(scores)
+    if scores.ndim == 3:
+        return np.stack([optimize_thresholds(labels, s, metric, weights, classes) for s in scores])
+    if metric == "f1":
+        return best_f1_thresholds(labels, scores)
+    if metric == "challenge":
+        if weights is None or classes is None:
+            raise ValueError("The challenge metric needs weights and classes")
+        return best_challenge_thresholds(labels, scores, weights, classes)[0]
+    raise ValueError(f"Unknown metric: {metric}")
+
+
+# Checkpoint files
+# ----------------
+
+def load_thresholds(checkpoint_dir: Path) -> np.ndarray:
+    """Thresholds of every fold, shape (folds, classes)"""
+    checkpoint_dir = Path(checkpoint_dir)
+    return np.stack([
+        np.load(checkpoint_dir / ('finalized_model_thresholds_%d.npy' % fold)) for fold in range(NUM_FOLDS)
+    ])
+
+def save_thresholds(checkpoint_dir: Path, thresholds: np.ndarray):
+    """Write `finalized_model_thresholds_%d.npy` for every fold.
+
+    `thresholds` has shape (classes,) (same for every fold) or (folds,
+    classes). The first time a file is replaced, the original is kept as
+    `finalized_model_thresholds_%d.orig.npy`.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    thresholds = np.broadcast_to(np.asarray(thresholds, dtype=np.float64), (NUM_FOLDS, np.shape(thresholds)[-1]))
+    for fold in range(NUM_FOLDS):
+        path = checkpoint_dir / ('finalized_model_thresholds_%d.npy' % fold)
+        backup = checkpoint_dir / ('finalized_model_thresholds_%d.orig.npy' % fold)
+        if path.exists() and not backup.exists():
+            shutil.copy2(path, backup)
+        np.save(path, thresholds[fold])
+
+def scored_labels(records: List[Path], classes: List[str], return_known: bool=False):
+    """(records, classes) labels, counting equivalent codes (e.g. 59118001)
+    as the class they are scored as. Every record is kept (no age filter).
+
+    Records without Dx codes (norwegian-athlete-ecg) are labelled from their
+    cardiologist's report (`classify_reports`), so only the classes of
+    `RELEVANT_FINDING_RULES` and `T_WAVE_RULES` can be positive there. With
+    `return_known`, also returns a (classes,) mask of the classes every
+    record has a label source for. Raises ValueError if no record has any
+    label.
+    """
+    classes = [str(c) for c in classes]
+    column = {c: i for i, c in enumerate(classes)}
+    column.update({code: column[target] for code, target in EQUIVALENT_CLASSES.items() if target in column})
+
+    with ThreadPoolExecutor(8) as executor:
+        headers = list(executor.map(read_header, records))
+    labels = np.zeros((len(headers), len(classes)), dtype=bool)
+    known = np.ones(len(classes), dtype=bool)
+    for i, header in enumerate(headers):
+        labels[i, [column[str(code)] for code in header['dx'] if str(code) in column]] = True
+
+    # Athletes: labels from the reports
+    reported = [i for i, header in enumerate(headers) if not header['dx'] and header['report']]
+    if reported:
+        report_labels, codes, _ = classify_reports(
+            [headers[i]['report'] for i in reported], RELEVANT_FINDING_RULES + T_WAVE_RULES
+        )
+        for j, code in enumerate(codes):
+            if str(code) in column:
+                labels[reported, column[str(code)]] |= report_labels[:, j].astype(bool)
+        known &= np.isin(np.arange(len(classes)), [column[str(c)] for c in codes if str(c) in column])
+
+    if not labels.any():
+        raise ValueError(f"None of the {len(records)} records has a label of the scored classes "
+                         "(no Dx codes or reports in the headers?)")
+    return (labels, known) if return_known else labels
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-derive per-class thresholds of an ensemble for a dataset, e.g. '
+                    'python -m src.thresholds checkpoints/original config data/norwegian-athlete-ecg/1.0.0 config/weights.csv'
+    )
+    parser.add_argument('checkpoint_dir', type=Path, help='directory with finalized_model_*.sav checkpoints')
+    parser.add_argument('config_dir', type=Path, help='directory with data.json, model.json etc.')
+    parser.add_argument('dataset_dir', type=Path)
+    parser.add_argument('weights', type=Path, nargs='?', default=None, help='challenge weights.csv')
+    parser.add_argument('--metric', choices=['challenge', 'f1'], default='challenge')
+    parser.add_argument('--per-fold', action='store_true',
+                        help='optimize each network on its own scores (default: the averaged ensemble scores)')
+    parser.add_argument('--scores', type=Path, default=None,
+                        help='.npy cache of fold scores (computed and saved if it does not exist)')
+    parser.add_argument('--predictions', type=Path, default=None,
+                        help='read the ensemble scores from a PredictionStore (e.g. the driver\'s "predictions") '
+                             'instead of classifying the records')
+    parser.add_argument('--experiments', type=Path, default=None,
+                        help='read the ensemble scores from an ExperimentCache (src.experiments), classifying '
+                             'only the records it is missing')
+    parser.add_argument('--chunk-size', type=int, default=256, help='records loaded and classified at a time')
+    parser.add_argument('--dry-run', action='store_true', help="print the thresholds, don't write them")
+    args = parser.parse_args()
+    if (args.predictions or args.experiments) is not None and args.per_fold:
+        parser.error("--per-fold needs the scores of every network, cached predictions only have the ensemble's")
+
+    from src.data.records import iter_records
+    from src.data.util import read_predictions
+    from src.run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier_folds
+    from PhysioNet2020_driver import load_challenge_data
+
+    eval_list = load_12ECG_model(args.checkpoint_dir, args.config_dir)
+    classes = eval_list[0].scored_classes
+    records = [record.path for record in iter_records(args.dataset_dir)]
+
+    if (args.predictions or args.experiments) is not None:
+        if args.predictions is not None:
+            cached_scores, _, _, cached_classes = read_predictions(args.predictions, records)
+        else:
+            from src.experiments import ExperimentCache
+            cached_scores, _, _, cached_classes = ExperimentCache(args.experiments).run(
+                args.checkpoint_dir, args.config_dir, args.dataset_dir, chunk_size=args.chunk_size
+            )
+        if list(cached_classes) != [str(c) for c in classes]:
+            raise ValueError("The cached predictions have different classes")
+        fold_scores = cached_scores[np.newaxis]
+    elif args.scores is not None and args.scores.exists():
+        fold_scores = np.load(args.scores)
+    else:
+        # A chunk of records in memory at a time
+        fold_scores = np.zeros((len(eval_list[3]), len(records), len(classes)), dtype=np.float32)
+        for start in range(0, len(records), args.chunk_size):
+            loaded = [load_challenge_data(record) for record in records[start:start + args.chunk_size]]
+            fold_scores[:, start:start + len(loaded)] = run_12ECG_classifier_folds(
+                [d for d, _ in loaded], [h for _, h in loaded], eval_list
+            )[0]
+            print(f"    {start + len(loaded)}/{len(records)}...")
+        if args.scores is not None:
+            np.save(args.scores, fold_scores)
+
+    labels, known = scored_labels(records, classes, return_known=True)
+    weights = load_weights(args.weights, classes)[1] if args.weights is not None else None
+    scores = fold_scores if args.per_fold else fold_scores.mean(axis=0)
+    thresholds = optimize_thresholds(labels, scores, args.metric, weights, classes)
+
+    # Reports only label a few classes; the others are unknown, not negative
+    if not known.all():
+        print(f"WARNING: {int((~known).sum())} classes have no labels in this dataset; keeping their thresholds")
+        current = load_thresholds(args.checkpoint_dir) if args.per_fold else eval_list[4]
+        thresholds = np.where(known, thresholds, current)
+
+    print(np.array2string(np.asarray(thresholds), precision=4))
+    if weights is not None:
+        old = challenge_score(labels, fold_scores.mean(axis=0) > eval_list[4], weights, classes)
+        new = challenge_score(labels, fold_scores.mean(axis=0) > np.mean(np.atleast_2d(thresholds), axis=0), weights, classes)
+        print(f"Challenge score: {old:.4f} -> {new:.4f}")
+    if not args.dry_run:
+        save_thresholds(args.checkpoint_dir, thresholds)
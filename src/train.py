@@ -1,9 +1,17 @@
 # Modified from DSAIL_SNU Trainer class in train.py
 
+import copy
+import shutil
+from pathlib import Path
+
 import numpy as np
 import torch
 import torch.nn.functional as F
-from dsail.data import collate_into_block
+import wfdb
+from dsail.data import collate_into_block, collate_into_list, get_dataset_from_configs
+
+from src import instrument
+from src.data.shared_dataset import BlockBatch
 
 #
 # Random helper functions
@@ -45,7 +53,13 @@ def get_loss(outputs, labels, class_weight, confusion_weight, multilabel_flag, c
 
 def evaluate(model, batch, device, loss_weights_and_flags):
     # evaluation of the model
-    batch = collate_into_block(batch, 2048, 1536) # self.chunk_length, self.chunk_stride
+    # `batch` is from `collate_into_list`, or a `BlockBatch` (already chunked, e.g. by a DataLoader worker)
+    if isinstance(batch, BlockBatch):
+        batch = batch.blocks()
+    else:
+        with instrument.span("collate", records=len(batch[0])) as span:
+            batch = collate_into_block(batch, 2048, 1536) # self.chunk_length, self.chunk_stride
+            span.set(shape=tuple(batch[0].shape))
 
     batch = set_device(batch, device)
     model = model.to(device)
@@ -56,7 +70,7 @@ def evaluate(model, batch, device, loss_weights_and_flags):
     class_weight, confusion_weight, confusion_weight_flag = loss_weights_and_flags
 
 
-    with torch.no_grad():
+    with torch.no_grad(), instrument.span("forward", records=len(labels), shape=tuple(inputs.shape)):
         outputs = model(inputs, flags)
         # loss = get_loss(outputs, labels, class_weight, confusion_weight,
         #                 True, confusion_weight_flag)
@@ -74,37 +88,394 @@ def evaluate(model, batch, device, loss_weights_and_flags):
 
     return scalar_outputs
 
+def get_label_indices(classes, athlete_labels) -> torch.Tensor:
+    """Index of each athlete label (SNOMED-CT code) in the model outputs"""
+    classes = [int(code) for code in classes]
+    missing = [code for code in athlete_labels if int(code) not in classes]
+    if missing:
+        raise ValueError(f"Model has no output for {missing}")
+    return torch.tensor([classes.index(int(code)) for code in athlete_labels], dtype=torch.long)
+
+def _record_batch(batch, i, x=None):
+    """Batch (from `collate_into_list`) with only record `i`, or part `x` of its signal"""
+    X, flags, labels = batch
+    return [[X[i] if x is None else x], flags[i:i+1], labels[i:i+1]]
+
+def _segment_batch(batch, records, segments):
+    """Batch (like `collate_into_list`) of `segments`, each part of the signal of record `records[j]`"""
+    X, flags, labels = batch
+    return [list(segments), flags[records], labels[records]]
+
+def _num_chunks(length, chunk_length=2048, chunk_stride=1536) -> int:
+    # Chunks of a signal on the grid of `collate_into_block` (padded to whole chunks)
+    return max(1, -(-(length - chunk_length) // chunk_stride) + 1)
+
+def iter_segments(x, windows_per_segment, chunk_length=2048, chunk_stride=1536):
+    """Split a (leads, samples) signal into segments of whole chunks.
+
+    Each segment covers `windows_per_segment` chunks of the grid used by 
+    `collate_into_block`, except the last one, which runs to the end of the 
+    signal (so the end of the recording is chunked exactly as before).
+    """
+    length = x.shape[-1]
+    segment_length = (windows_per_segment - 1) * chunk_stride + chunk_length
+    step = windows_per_segment * chunk_stride
+    start = 0
+    while length - (start + step) >= chunk_length:
+        yield x[..., start:start + segment_length]
+        start += step
+    yield x[..., start:]
+
+def evaluate_stream(model, batch, device, loss_weights_and_flags, micro_batch_size=64,
+                    chunk_length=2048, chunk_stride=1536):
+    """Same as `evaluate`, with bounded memory for long recordings.
+
+    Instead of pushing every chunk of every recording through the model at 
+    once, chunks are produced lazily from each signal, and segments of
+    consecutive recordings are packed into micro-batches of up to about
+    `micro_batch_size` chunks. Model outputs are combined incrementally as a
+    running mean over the chunks of each recording, which matches the
+    model's own aggregation over the chunks of a recording (averaging).
+    """
+    model = model.to(device)
+    model.eval()
+
+    X = batch[0]
+    totals, counts = [None] * len(X), [0] * len(X)
+
+    def run(pending):
+        # pending: (record, segment number, segment) of one micro-batch
+        records = [i for i, _, _ in pending]
+        started = sum(j == 0 for _, j, _ in pending)
+        with instrument.span("collate", records=started) as span:
+            inputs, flags, _ = set_device(
+                collate_into_block(_segment_batch(batch, records, [x for _, _, x in pending]),
+                                   chunk_length, chunk_stride), device
+            )
+            span.set(shape=tuple(inputs.shape))
+        with instrument.span("forward", records=started, shape=tuple(inputs.shape)):
+            outputs = model(inputs, flags)
+        # Outputs of each segment are along the second to last dimension (the mean of its chunks)
+        for k, (i, chunks) in enumerate(zip(records, torch.bincount(flags, minlength=len(pending)).tolist())):
+            total = outputs[..., k, :] * chunks
+            totals[i] = total if totals[i] is None else totals[i] + total
+            counts[i] += chunks
+
+    with torch.no_grad():
+        pending, pending_chunks = [], 0
+        for i, x in enumerate(X):
+            for j, segment in enumerate(iter_segments(x, micro_batch_size, chunk_length, chunk_stride)):
+                chunks = _num_chunks(segment.shape[-1], chunk_length, chunk_stride)
+                if pending and pending_chunks + chunks > micro_batch_size:
+                    run(pending)
+                    pending, pending_chunks = [], 0
+                pending.append((i, j, segment))
+                pending_chunks += chunks
+        if pending:
+            run(pending)
+
+    # Records are along the second to last dimension (e.g. EnsembleModel outputs are (folds, records, classes))
+    return torch.stack([torch.sigmoid(total / count) for total, count in zip(totals, counts)], dim=-2)
+
 # Based on evaluate()
-def train(model, batch, device, optimizer, classes, athlete_labels, actual_scores):
-    batch = collate_into_block(batch, 2048, 1536) # self.chunk_length, self.chunk_stride
+def train(model, batch, device, optimizer, classes, athlete_labels, actual_scores, label_indices=None, bf16=False):
+    """One optimizer step on a batch (from `collate_into_list`, or a `BlockBatch`).
+
+    Only the outputs for `athlete_labels` are trained. `actual_scores` are 
+    the binary labels for those outputs, shape (labels,) or (records, labels).
+    Returns the sigmoid outputs (all classes) and the loss. If the loss isn't
+    finite, the weights are left unchanged.
+    """
+    if isinstance(batch, BlockBatch):
+        batch = batch.blocks()
+    else:
+        batch = collate_into_block(batch, 2048, 1536) # self.chunk_length, self.chunk_stride
 
     batch = set_device(batch, device)
     model = model.to(device)
+    if label_indices is None:
+        label_indices = get_label_indices(classes, athlete_labels)
+    label_indices = label_indices.to(device)
+    labels = torch.as_tensor(actual_scores, dtype=torch.float32, device=device).reshape(-1, len(label_indices))
 
     model.train()
-    inputs, flags, labels = batch
+    inputs, flags, _ = batch
 
-    # 1. Forward pass, get relevant scores for training only (athlete labels)
-    outputs = model(inputs, flags)
-    scalar_outputs = torch.sigmoid(outputs)
-    predicted_scores = np.zeros(len(athlete_labels))
-    for i, code in enumerate(classes):
-        if int(code) in athlete_labels:
-            index = athlete_labels.index(int(code))
-            predicted_scores[index] = scalar_outputs[0][i]
-
-    # 2. Calculate cross-entropy loss on athlete labels
-    loss_fn = torch.nn.CrossEntropyLoss()
-    pred = torch.Tensor(predicted_scores)
-    loss = loss_fn(pred.requires_grad_(), torch.Tensor(actual_scores))
-
-    # 3. Zero optimizer gradients
+    # 1. Forward pass, get relevant outputs for training only (athlete labels)
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+        outputs = model(inputs, flags)
+    outputs = outputs.float().index_select(1, label_indices)
+
+    # 2. Calculate (binary) cross-entropy loss on athlete labels
+    class_weight = torch.ones(len(label_indices), device=device)
+    loss = get_loss(outputs, labels, class_weight, None, True, False)
+    scalar_outputs = torch.sigmoid(outputs.detach())
+
+    # 3. Skip the step on a NaN/inf loss (it would poison the weights)
+    if not torch.isfinite(loss):
+        return scalar_outputs, loss.detach()
+
+    # 4. Zero optimizer gradients
     optimizer.zero_grad()
 
-    # 4. Performa backpropagation on loss function
+    # 5. Performa backpropagation on loss function
     loss.backward()
 
-    # 5. Gradient descent
+    # 6. Gradient descent
     optimizer.step()
 
-    return scalar_outputs, loss
+    return scalar_outputs, loss.detach()
+
+
+#
+# Mini-batch training over a whole dataset
+#
+
+class ECGRecordDataset(torch.utils.data.Dataset):
+    """Preprocessed records with athlete labels, for a DataLoader.
+
+    Records are read (`wfdb.rdrecord`, or a `SignalCache`) and preprocessed
+    (`get_dataset_from_configs`) on access, so DataLoader workers do this in
+    parallel. `targets` has shape (records, athlete labels).
+    """
+    def __init__(self, records, targets, data_cfg, preprocess_cfg, signal_cache=None):
+        self.records = list(records)
+        self.targets = torch.as_tensor(np.asarray(targets), dtype=torch.float32)
+        self.data_cfg = data_cfg
+        self.preprocess_cfg = preprocess_cfg
+        self.signal_cache = signal_cache
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        record = self.records[idx]
+        if self.signal_cache is not None:
+            data, header = self.signal_cache.load_challenge_data(record)
+        else:
+            data = wfdb.rdrecord(record).p_signal.transpose()
+            with open(Path(record).with_suffix('.hea'), 'r') as f:
+                header = f.readlines()
+
+        data_cfg = copy.copy(self.data_cfg)
+        data_cfg.data = data
+        data_cfg.header = header
+        dataset = get_dataset_from_configs(data_cfg, self.preprocess_cfg)
+        return dataset[0], self.targets[idx]
+
+def collate_records(samples):
+    """collate_fn for `ECGRecordDataset` -> (batch for `train`, targets)"""
+    items, targets = zip(*samples)
+    return collate_into_list(list(items)), torch.stack(targets)
+
+def get_record_iterator(dataset, batch_size=16, shuffle=True, num_workers=0, seed=None):
+    generator = None
+    if seed is not None:
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+    return torch.utils.data.DataLoader(
+        dataset, batch_size, shuffle=shuffle, collate_fn=collate_records,
+        num_workers=num_workers, pin_memory=torch.cuda.is_available(),
+        persistent_workers=num_workers > 0, generator=generator,
+    )
+
+def predict_dataset(model, iterator, device, loss_weights_and_flags, num_records: int) -> torch.Tensor:
+    """`evaluate` every batch of an iterator of (`BlockBatch`, targets), e.g.
+    `get_batch_iterator` of `src.data.shared_dataset`.
+
+    Returns scores in dataset order, shape (records, classes), or (folds,
+    records, classes) for an `EnsembleModel`.
+    """
+    scores = None
+    for batch, _ in iterator:
+        outputs = evaluate(model, batch, device, loss_weights_and_flags).cpu()
+        if scores is None:
+            scores = outputs.new_zeros((*outputs.shape[:-2], num_records, outputs.shape[-1]))
+        scores[..., batch.records.cpu(), :] = outputs
+    return scores
+
+def train_epoch(model, iterator, device, optimizer, label_indices, bf16=False) -> float:
+    """Train on every batch in `iterator`. Returns the mean loss of the
+    batches (as they were trained on, while the weights changed).
+    """
+    total, count, skipped = 0., 0, 0
+    for batch, targets in iterator:
+        _, loss = train(model, batch, device, optimizer, None, None, targets, label_indices, bf16)
+        if not torch.isfinite(loss):    # `train` skipped this batch
+            skipped += 1
+            continue
+        total += loss.item() * len(targets)
+        count += len(targets)
+    if skipped:
+        print(f"WARNING: Skipped {skipped} batches with a non-finite loss")
+    return total / max(count, 1)
+
+def train_ensemble(models, iterator, device, classes, athlete_labels, lr=0.001, epochs=10,
+                   bf16=False, checkpoint_dir: Path=None, seed=2020):
+    """Fine-tune every network in the ensemble on mini-batches from `iterator`.
+
+    If `checkpoint_dir` is given, weights are saved after every epoch 
+    (`model_{fold}_epoch_{epoch}.sav`) and the epoch with the lowest mean
+    training loss is copied to `finalized_model_{fold}.sav`. That loss is
+    measured while the epoch trains, not on held-out data. Returns the mean
+    training loss of every (fold, epoch).
+    """
+    label_indices = get_label_indices(classes, athlete_labels).to(device)
+    if isinstance(models, torch.nn.Module):
+        models.to(device)   # e.g. EnsembleModel (moves every fold at once)
+
+    losses = np.zeros((len(models), epochs))
+    for fold, net in enumerate(models):
+        print(f"Finetuning network {fold+1} / {len(models)} over {epochs} epochs")
+        torch.manual_seed(seed)
+        trainable = [param for param in net.parameters() if param.requires_grad]
+        optimizer = torch.optim.SGD(params=trainable, lr=lr)
+        for epoch in range(epochs):
+            losses[fold, epoch] = train_epoch(net, iterator, device, optimizer, label_indices, bf16)
+            if checkpoint_dir is not None:
+                torch.save(net.state_dict(), Path(checkpoint_dir) / f"model_{fold}_epoch_{epoch}.sav")
+
+        best = int(np.argmin(losses[fold]))
+        print(f"\tmean training loss, epoch 0: \t{losses[fold, 0]}")
+        print(f"\tlowest mean training loss, epoch {best}: \t{losses[fold, best]}")
+        if checkpoint_dir is not None:
+            shutil.copyfile(
+                Path(checkpoint_dir) / f"model_{fold}_epoch_{best}.sav",
+                Path(checkpoint_dir) / f"finalized_model_{fold}.sav"
+            )
+    return losses
+
+
+#
+# Linear head fine-tuning on cached backbone features
+#
+
+def extract_features(model, batch, device):
+    """Inputs to `model.linear` (the 256-d penultimate embeddings).
+
+    Returns (features, counts), where `counts[i]` is the number of rows of
+    `features` that belong to record `i` of the batch (one per chunk from
+    `collate_into_block`, or one per record if the model pools chunks
+    before the linear layer).
+    """
+    X = batch[0]
+    chunks = [
+        len(collate_into_block(_record_batch(batch, i), 2048, 1536)[0])
+        for i in range(len(X))
+    ]
+
+    captured = []
+    hook = model.linear.register_forward_hook(lambda module, args, output: captured.append(args[0].detach()))
+    try:
+        evaluate(model, batch, device, (None, None, None))
+    finally:
+        hook.remove()
+    features = torch.cat(captured).float().cpu()
+
+    if len(features) == sum(chunks):
+        counts = chunks
+    elif len(features) == len(X):
+        counts = [1] * len(X)
+    else:
+        raise ValueError(f"Can't match {len(features)} feature rows to {len(X)} records")
+    return features, counts
+
+def build_feature_cache(models, iterator, device, cache_dir: Path):
+    """Run the (frozen) backbone of every fold once over a dataset.
+
+    `iterator` yields (batch, targets), e.g. from `get_record_iterator` with
+    `shuffle=False`. Writes to `cache_dir`:
+    - `features_{fold}.f32` float32 rows of 256-d embeddings
+    - `index.npz` row offsets of each record, targets, feature size
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    files = [open(cache_dir / f"features_{fold}.f32", 'wb') for fold in range(len(models))]
+    counts, targets, dim = [], [], 0
+    try:
+        for batch, batch_targets in iterator:
+            for fold, net in enumerate(models):
+                features, batch_counts = extract_features(net, batch, device)
+                files[fold].write(features.numpy().tobytes())
+            counts.extend(batch_counts)
+            targets.append(np.asarray(batch_targets, dtype=np.float32))
+            dim = features.shape[1]
+    finally:
+        for f in files:
+            f.close()
+
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    np.savez(cache_dir / "index.npz", offsets=offsets, targets=np.concatenate(targets), dim=dim)
+
+def load_feature_cache(cache_dir: Path):
+    """Returns (features of each fold, offsets, targets) from `build_feature_cache`"""
+    cache_dir = Path(cache_dir)
+    index = np.load(cache_dir / "index.npz")
+    dim = int(index['dim'])
+    features = []
+    fold = 0
+    while (cache_dir / f"features_{fold}.f32").exists():
+        features.append(np.memmap(cache_dir / f"features_{fold}.f32", dtype=np.float32, mode='r').reshape(-1, dim))
+        fold += 1
+    return features, index['offsets'], index['targets']
+
+def train_linear_head(linear, features, offsets, targets, label_indices, lr=0.1, epochs=100,
+                      batch_size=None, device=torch.device("cpu"), seed=2020):
+    """Fine-tune `linear` (e.g. `net.linear`) on cached features only.
+
+    Outputs of each record are the mean of the outputs of its rows, like the 
+    aggregation over chunks in the full model. Trains on all records at once
+    unless `batch_size` is given. Returns the loss of every epoch.
+    """
+    features = torch.as_tensor(np.array(features, dtype=np.float32), device=device)
+    targets = torch.as_tensor(np.asarray(targets), dtype=torch.float32, device=device)
+    label_indices = label_indices.to(device)
+    counts = torch.as_tensor(np.diff(offsets), device=device)
+    num_records = len(counts)
+    record_of_row = torch.repeat_interleave(torch.arange(num_records, device=device), counts)
+
+    linear = linear.to(device)
+    optimizer = torch.optim.SGD(params=linear.parameters(), lr=lr)
+    class_weight = torch.ones(len(label_indices), device=device)
+    generator = torch.Generator().manual_seed(seed)
+
+    losses = []
+    for epoch in range(epochs):
+        if batch_size is None:
+            batches = [torch.arange(num_records, device=device)]
+        else:
+            order = torch.randperm(num_records, generator=generator).to(device)
+            batches = order.split(batch_size)
+
+        total = 0.
+        for records in batches:
+            rows = torch.isin(record_of_row, records) if batch_size is not None else slice(None)
+            outputs = F.linear(
+                features[rows],
+                linear.weight.index_select(0, label_indices),
+                linear.bias.index_select(0, label_indices),
+            )
+            # Mean over the rows (chunks) of each record
+            row_records = record_of_row[rows]
+            summed = torch.zeros(num_records, len(label_indices), device=device).index_add(0, row_records, outputs)
+            outputs = (summed / counts.unsqueeze(1))[records]
+
+            loss = get_loss(outputs, targets[records], class_weight, None, True, False)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item() * len(records)
+        losses.append(total / num_records)
+    return losses
+
+def train_ensemble_heads(models, cache_dir: Path, classes, athlete_labels, **kwargs):
+    """`train_linear_head` for every fold, using a cache from `build_feature_cache`.
+
+    Returns the loss of every (fold, epoch).
+    """
+    features, offsets, targets = load_feature_cache(cache_dir)
+    label_indices = get_label_indices(classes, athlete_labels)
+    losses = []
+    for fold, net in enumerate(models):
+        losses.append(train_linear_head(net.linear, features[fold], offsets, targets, label_indices, **kwargs))
+    return np.array(losses)